@@ -0,0 +1,111 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Availability:
+    """
+    The pieces each peer has, as packed rows of a bit matrix with one row per
+    peer, along with the number of peers having each piece. Both are kept up
+    to date as peers come and go and announce pieces, so picking a piece is a
+    few vectorized operations instead of loops over every peer and piece.
+
+    Requires NumPy, PieceManager goes without it when it is not installed.
+    """
+    def __init__(self, pieces: int, capacity: int = 64):
+        """
+        :param pieces: The number of pieces in the torrent
+        :param capacity: The number of peers room is made for up front, grows
+                         as needed
+        """
+        self.pieces = pieces
+        self._width = (pieces + 7) // 8
+        self._matrix = numpy.zeros((capacity, self._width), dtype=numpy.uint8)
+        self._rows = {}  # peer_id -> row of the matrix
+        self._free = list(range(capacity - 1, -1, -1))
+        # The number of peers having each piece
+        self.counts = numpy.zeros(pieces, dtype=numpy.int32)
+
+    def add(self, peer_id, bitfield: bytes):
+        """
+        Add the peer with the given (packed) bitfield, replacing the one it
+        had before.
+        """
+        if peer_id in self._rows:
+            self.remove(peer_id)
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        self._rows[peer_id] = row
+        packed = numpy.frombuffer(bytes(bitfield[:self._width]),
+                                  dtype=numpy.uint8)
+        self._matrix[row, :len(packed)] = packed
+        if self.pieces % 8:
+            # The spare bits at the end of the bitfield aren't pieces
+            self._matrix[row, -1] &= (0xff << (8 - self.pieces % 8)) & 0xff
+        self.counts += self._unpack(row)
+
+    def have(self, peer_id, index: int):
+        """
+        The peer announced having another piece.
+        """
+        row = self._rows.get(peer_id)
+        if row is None or not 0 <= index < self.pieces:
+            return
+        byte, bit = divmod(index, 8)
+        mask = 0x80 >> bit
+        if not self._matrix[row, byte] & mask:
+            self._matrix[row, byte] |= mask
+            self.counts[index] += 1
+
+    def remove(self, peer_id):
+        row = self._rows.pop(peer_id, None)
+        if row is None:
+            return
+        self.counts -= self._unpack(row)
+        self._matrix[row] = 0
+        self._free.append(row)
+
+    def mask(self, indexes) -> 'numpy.ndarray':
+        """
+        A mask over all pieces with the given piece indexes set.
+        """
+        mask = numpy.zeros(self.pieces, dtype=bool)
+        mask[list(indexes)] = True
+        return mask
+
+    def interesting(self, peer_id, wanted) -> 'numpy.ndarray':
+        """
+        The pieces the peer has that are set in the `wanted` mask, typically
+        the pieces we're missing.
+        """
+        return self._unpack(self._rows[peer_id]).astype(bool) & wanted
+
+    def rarest(self, peer_id, wanted) -> int:
+        """
+        The index of the interesting piece held by the fewest peers, the one
+        with the lowest index among equally rare pieces, or None.
+        """
+        interesting = self.interesting(peer_id, wanted)
+        if not interesting.any():
+            return None
+        return int(numpy.argmin(numpy.where(
+            interesting, self.counts, numpy.iinfo(numpy.int32).max)))
+
+    def first(self, peer_id, wanted) -> int:
+        """
+        The lowest index of the interesting pieces, or None.
+        """
+        indexes = numpy.flatnonzero(self.interesting(peer_id, wanted))
+        return int(indexes[0]) if len(indexes) else None
+
+    def _unpack(self, row: int) -> 'numpy.ndarray':
+        return numpy.unpackbits(self._matrix[row], count=self.pieces)
+
+    def _grow(self):
+        capacity = len(self._matrix)
+        matrix = numpy.zeros((capacity * 2, self._width), dtype=numpy.uint8)
+        matrix[:capacity] = self._matrix
+        self._matrix = matrix
+        self._free.extend(range(capacity * 2 - 1, capacity - 1, -1))
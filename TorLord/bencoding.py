@@ -53,135 +53,130 @@ class Decoder:
             raise RuntimeError('Invalid token read at {0}'.format(
                 str(self._index)))
 
-        def _peek(self):
-            if self._index + 1 >= len(self._data):
-                return None
-            return self._data[self._index:self._index + 1]
-
-        def _consume(self) -> bytes:
-            """
-            Read (and therefore consume) the next character from the data
-            """
-            self._index += 1
-
-        def _read(self, length: int) -> bytes:
-            """
-            Read the `length` number of bytes from data and return the result
-            """
-            if self._index + length > len(self._data):
-                raise IndexError('Cannot read {0} bytes from current position {1}'
-                                 .format(str(length), str(self._index)))
-            res = self._data[self._index:self._index + length]
-            self._index += length
-            return res
-
-        def _read_until(self, token: bytes) -> bytes:
-            """
-            Read from the bencoded data until the given token is found and return
-            the characters read.
-            """
-            try:
-                occurrence = self._data.index(token, self._index)
-                result = self._data[self._index:occurrence]
-                self._index = occurrence + 1
-                return result
-            except ValueError:
-                raise RuntimeError('Unable to find token {0}'.format(
-                    str(token)))
-
-        def _decode_int(self):
-            return int(self._read_until(TOKEN_END))
-
-        def _decode_list(self):
-            res = []
-            # Recursive decode the content of the list
-            while self._data[self._index: self._index + 1] != TOKEN_END:
-                res.append(self.decode())
-            self._consume()  # The END token
-            return res
-
-        def _decode_dict(self):
-            res = OrderedDict()
-            while self._data[self._index: self._index + 1] != TOKEN_END:
-                key = self.decode()
-                obj = self.decode()
-                res[key] = obj
-            self._consume()  # The END token
-            return res
-
-        def _decode_string(self):
-            bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
-            data = self._read(bytes_to_read)
-            return data
-
-    class Encoder:
-        """
-        Encodes a python object to a bencoded sequence of bytes.
-
-        Supported python types is:
-            - str
-            - int
-            - list
-            - dict
-            - bytes
+    def _peek(self):
+        if self._index >= len(self._data):
+            return None
+        return self._data[self._index:self._index + 1]
 
-        Any other type will simply be ignored.
+    def _consume(self) -> bytes:
         """
+        Read (and therefore consume) the next character from the data
+        """
+        self._index += 1
 
-        def __init__(self, data):
-            self._data = data
-
-        def encode(self) -> bytes:
-            """
-            Encode a python object to a bencoded binary string
-
-            :return The bencoded binary data
-            """
-            return self.encode_next(self._data)
-
-        def encode_next(self, data):
-            if type(data) == str:
-                return self._encode_string(data)
-            elif type(data) == int:
-                return self._encode_int(data)
-            elif type(data) == list:
-                return self._encode_list(data)
-            elif type(data) == dict or type(data) == OrderedDict:
-                return self._encode_dict(data)
-            elif type(data) == bytes:
-                return self._encode_bytes(data)
-            else:
-                return None
-
-        def _encode_int(self, value):
-            return str.encode('i' + str(value) + 'e')
-
-        def _encode_string(self, value: str):
-            res = str(len(value)) + ':' + value
-            return str.encode(res)
-
-        def _encode_bytes(self, value: str):
-            result = bytearray()
-            result += str.encode(str(len(value)))
-            result += b':'
-            result += value
+    def _read(self, length: int) -> bytes:
+        """
+        Read the `length` number of bytes from data and return the result
+        """
+        if self._index + length > len(self._data):
+            raise IndexError('Cannot read {0} bytes from current position {1}'
+                             .format(str(length), str(self._index)))
+        res = self._data[self._index:self._index + length]
+        self._index += length
+        return res
+
+    def _read_until(self, token: bytes) -> bytes:
+        """
+        Read from the bencoded data until the given token is found and return
+        the characters read.
+        """
+        try:
+            occurrence = self._data.index(token, self._index)
+            result = self._data[self._index:occurrence]
+            self._index = occurrence + 1
             return result
+        except ValueError:
+            raise RuntimeError('Unable to find token {0}'.format(
+                str(token)))
+
+    def _decode_int(self):
+        return int(self._read_until(TOKEN_END))
+
+    def _decode_list(self):
+        res = []
+        # Recursive decode the content of the list
+        while self._data[self._index: self._index + 1] != TOKEN_END:
+            res.append(self.decode())
+        self._consume()  # The END token
+        return res
+
+    def _decode_dict(self):
+        res = OrderedDict()
+        while self._data[self._index: self._index + 1] != TOKEN_END:
+            key = self.decode()
+            obj = self.decode()
+            res[key] = obj
+        self._consume()  # The END token
+        return res
+
+    def _decode_string(self):
+        bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
+        data = self._read(bytes_to_read)
+        return data
+
+
+class Encoder:
+    """
+    Encodes a python object to a bencoded sequence of bytes.
 
-        def _encode_list(self, data):
-            result = bytearray('l', 'utf-8')
-            result += b''.join([self.encode_next(item) for item in data])
-            result += b'e'
-            return result
+    Supported python types is:
+        - str
+        - int
+        - list
+        - dict
+        - bytes
 
-        def _encode_dict(self, data: dict) -> bytes:
-            result = bytearray('d', 'utf-8')
-            for k, v in data.items():
-                key = self.encode_next(k)
-                value = self.encode_next(v)
-                if key and value:
-                    result += key
-                    result += value
-                else:
-                    raise RuntimeError('Bad dict')
-            result += b'e'
-            return result
\ No newline at end of file
+    Any other type will simply be ignored.
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def encode(self) -> bytes:
+        """
+        Encode a python object to a bencoded binary string
+
+        :return The bencoded binary data
+        """
+        return self.encode_next(self._data)
+
+    def encode_next(self, data):
+        # The parts are joined once at the end, rather than copying the
+        # encoded values into every enclosing list and dict
+        parts = []
+        if not self._append(data, parts):
+            return None
+        return b''.join(parts)
+
+    def _append(self, data, parts: list) -> bool:
+        kind = type(data)
+        if kind == bytes:
+            parts.append(str(len(data)).encode())
+            parts.append(TOKEN_STRING_SEPARATOR)
+            parts.append(data)
+        elif kind == str:
+            parts.append(str.encode(str(len(data)) + ':' + data))
+        elif kind == int:
+            parts.append(str.encode('i' + str(data) + 'e'))
+        elif kind == list:
+            self._append_list(data, parts)
+        elif kind == dict or kind == OrderedDict:
+            self._append_dict(data, parts)
+        else:
+            return False
+        return True
+
+    def _append_list(self, data, parts: list):
+        parts.append(TOKEN_LIST)
+        for item in data:
+            if not self._append(item, parts):
+                raise TypeError('Cannot encode {kind}'.format(
+                    kind=type(item).__name__))
+        parts.append(TOKEN_END)
+
+    def _append_dict(self, data: dict, parts: list):
+        parts.append(TOKEN_DICT)
+        for k, v in data.items():
+            if not (self._append(k, parts) and self._append(v, parts)):
+                raise RuntimeError('Bad dict')
+        parts.append(TOKEN_END)
@@ -1,37 +1,201 @@
 import argparse
 import asyncio
+import os
 import signal
+import sys
 import logging
+import time
 
 from concurrent.futures import CancelledError
 
+from TorLord import profiling
+from TorLord.create import create_torrent, save_torrent
+from TorLord.peercache import PeerCache, default_directory
 from TorLord.torrent import Torrent
-from TorLord.client import TorrentClient
+from TorLord.session import Session
+from TorLord.sharding import ShardedClient
+from TorLord.tuning import SocketOptions, new_event_loop, \
+    DEFAULT_STREAM_LIMIT
+
+# The port listened on for incoming peers unless given
+DEFAULT_PORT = 6889
 
 
 def main():
+    if sys.argv[1:2] == ['create']:
+        return create(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('torrent',
-                        help='the .torrent to download')
+    parser.add_argument('torrent', nargs='+',
+                        help='the .torrent(s) to download')
+    parser.add_argument('-p', '--port', type=int,
+                        help='the port to listen on for incoming peers, '
+                             '{port} by default'.format(port=DEFAULT_PORT))
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='enable verbose output')
+    parser.add_argument('--uvloop', action='store_true',
+                        help='run on uvloop, when installed')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='download each torrent with this many worker '
+                             'processes, each with its own event loop')
+    parser.add_argument('--rcvbuf', type=int,
+                        help='the peer socket receive buffer size (bytes)')
+    parser.add_argument('--sndbuf', type=int,
+                        help='the peer socket send buffer size (bytes)')
+    parser.add_argument('--nodelay', action='store_true',
+                        help='set TCP_NODELAY on peer sockets')
+    parser.add_argument('--stream-limit', type=int,
+                        default=DEFAULT_STREAM_LIMIT,
+                        help='the peer stream reader buffer limit (bytes)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this local port')
+    parser.add_argument('--peer-cache', metavar='DIR',
+                        help='remember the peers that sent us data in DIR, '
+                             'and dial them first on the next start, by '
+                             'default in the user cache directory')
+    parser.add_argument('--no-peer-cache', action='store_true',
+                        help='do not remember peers across restarts')
+    parser.add_argument('--lsd', action='store_true',
+                        help='find peers on the local network through '
+                             'multicast (BEP 14)')
+    parser.add_argument('--stage-timing', action='store_true',
+                        help='time the parse, pick, hash and write stages')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run into FILE, a cProfile dump if '
+                             'it ends with .prof, otherwise collapsed stacks '
+                             'for flame graphs')
 
     args = parser.parse_args()
+    if args.workers > 1:
+        # The workers each run a bare client of their own, none of these
+        # would take effect
+        unsupported = [option for option, value in [
+            ('--port', args.port is not None),
+            ('--metrics-port', args.metrics_port is not None),
+            ('--peer-cache', args.peer_cache is not None),
+            ('--lsd', args.lsd),
+            ('--stage-timing', args.stage_timing),
+            ('--profile', args.profile is not None)] if value]
+        if unsupported:
+            parser.error('{options} can not be used with --workers'.format(
+                options=', '.join(unsupported)))
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
-    loop = asyncio.get_event_loop()
-    client = TorrentClient(Torrent(args.torrent))
-    task = loop.create_task(client.start())
+    if args.stage_timing:
+        profiling.enable_spans()
+    profiler = profiling.Profiler(args.profile) if args.profile else None
+
+    loop = new_event_loop(args.uvloop)
+    asyncio.set_event_loop(loop)
+    socket_options = SocketOptions(rcvbuf=args.rcvbuf,
+                                   sndbuf=args.sndbuf,
+                                   nodelay=args.nodelay,
+                                   stream_limit=args.stream_limit)
+    if args.workers > 1:
+        # Every torrent gets worker processes of its own, each listening on
+        # an ephemeral port rather than the one given
+        clients = [ShardedClient(filename, args.workers,
+                                 socket_options=socket_options,
+                                 use_uvloop=args.uvloop)
+                   for filename in args.torrent]
+
+        async def run():
+            for client in clients:
+                client.start()
+            await asyncio.gather(*[client.wait() for client in clients])
+
+        task = loop.create_task(run())
+
+        def stop():
+            # The workers stop gracefully, ending the task
+            for client in clients:
+                client.stop()
+    else:
+        session = Session(port=DEFAULT_PORT if args.port is None
+                          else args.port,
+                          socket_options=socket_options,
+                          metrics_port=args.metrics_port,
+                          peer_cache=None if args.no_peer_cache
+                          else PeerCache(args.peer_cache or
+                                         default_directory()),
+                          local_discovery=args.lsd)
+
+        async def run():
+            await session.start()
+            for filename in args.torrent:
+                session.add(Torrent(filename))
+            await session.wait()
+            await session.close()
+
+        task = loop.create_task(run())
+
+        def stop():
+            session.stop()
+            task.cancel()
 
     def signal_handler(*_):
         logging.info('Exiting, please wait until everything is shutdown...')
-        client.stop()
-        task.cancel()
+        stop()
 
     signal.signal(signal.SIGINT, signal_handler)
 
+    if profiler:
+        profiler.start()
     try:
         loop.run_until_complete(task)
-    except CancelledError:
-        logging.warning('Event loop was canceled')
\ No newline at end of file
+    except (CancelledError, asyncio.CancelledError):
+        logging.warning('Event loop was canceled')
+    finally:
+        if profiler:
+            profiler.stop()
+        loop.close()
+
+
+def create(argv):
+    parser = argparse.ArgumentParser(prog='TorLord create')
+    parser.add_argument('path', help='the file or directory to share')
+    parser.add_argument('-t', '--tracker', required=True,
+                        help='the announce URL of the tracker')
+    parser.add_argument('-o', '--output',
+                        help='the .torrent file to write, named after the '
+                             'shared file or directory by default')
+    parser.add_argument('--piece-length', type=int,
+                        help='the piece length (bytes), chosen from the '
+                             'size of the content by default')
+    parser.add_argument('--workers', type=int,
+                        help='hash the pieces with this many processes, one '
+                             'per CPU by default')
+    parser.add_argument('--web-seed', action='append', default=[],
+                        help='the URL of a web seed holding the content')
+    parser.add_argument('--comment', help='a comment to add')
+    parser.add_argument('--private', action='store_true',
+                        help='mark the torrent private')
+
+    args = parser.parse_args(argv)
+    if args.piece_length is not None and (
+            args.piece_length < 1 or
+            args.piece_length & (args.piece_length - 1)):
+        parser.error('the piece length must be a power of two')
+    output = args.output or \
+        os.path.basename(os.path.abspath(args.path)) + '.torrent'
+
+    started = time.monotonic()
+    meta_info = create_torrent(args.path, args.tracker,
+                               piece_length=args.piece_length,
+                               url_list=args.web_seed,
+                               comment=args.comment,
+                               private=args.private,
+                               workers=args.workers)
+    save_torrent(meta_info, output)
+    elapsed = time.monotonic() - started
+
+    info = meta_info[b'info']
+    size = sum(f[b'length'] for f in info[b'files']) \
+        if b'files' in info else info[b'length']
+    print('Created {output}: {size} bytes in {pieces} pieces of {length} '
+          'bytes, hashed at {rate:.1f} MB/s'.format(
+              output=output, size=size,
+              pieces=len(info[b'pieces']) // 20,
+              length=info[b'piece length'],
+              rate=size / max(elapsed, 1e-6) / 1e6))
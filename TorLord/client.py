@@ -1,70 +1,527 @@
+import aiohttp
 import asyncio
+import heapq
+import itertools
 import logging
 import math
-import os
 import time
-from asyncio import Queue
-from collections import namedtuple, defaultdict
+from asyncio import PriorityQueue
+from collections import defaultdict
 from hashlib import sha1
 
+import bitstring
+
+from TorLord.availability import Availability, numpy
+from TorLord.metrics import TorrentMetrics
+from TorLord.pex import PeerExchange
+from TorLord.picker import RarestFirst
+from TorLord.profiling import span
 from TorLord.protocol import PeerConnection, REQUEST_SIZE
+from TorLord.ratelimit import TokenBucket
+from TorLord.storage import Storage
+from TorLord.streaming import TorrentReader
 from TorLord.tracker import Tracker
+from TorLord.webseed import WebSeed
 
 MAX_PEER_CONNECTIONS = 20
 
+# Seconds between announces when the tracker doesn't tell, and the fewest
+# seconds between announces when the tracker doesn't tell that either
+ANNOUNCE_INTERVAL = 30 * 60
+MIN_ANNOUNCE_INTERVAL = 60
+
+# Seconds to wait before announcing again when the tracker could not be
+# reached
+ANNOUNCE_RETRY_INTERVAL = 60
+
+# The tracker is asked for more peers before the interval is up once less
+# than this share of the connection budget is connected and no more peers
+# are waiting to be dialed
+STARVATION_RATIO = 0.5
+
+# Seconds the tracker gets to acknowledge that we stopped
+STOPPED_ANNOUNCE_TIMEOUT = 5
+
+# How often (in seconds) snubbing peers are looked for, peer exchange
+# messages are sent and idle connections kept alive
+MAINTENANCE_INTERVAL = 5
+
+# Bounds (in seconds) of the time a peer gets to respond to a request before
+# the block is requested again, see `RequestTimer`
+MIN_REQUEST_TIMEOUT = 1
+MAX_REQUEST_TIMEOUT = 60
+INITIAL_REQUEST_TIMEOUT = 5
+
+# A peer not sending a block for this many seconds while unchoked is
+# snubbing us, and is not asked for blocks until it is given another chance.
+# One snubbed peer gets that chance every OPTIMISTIC_UNSNUB_INTERVAL seconds
+SNUB_TIMEOUT = 30
+OPTIMISTIC_UNSNUB_INTERVAL = 30
+
+# File priorities, pieces of files with a higher priority are started first
+# and pieces only holding data of skipped files are not downloaded at all
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 4
+PRIORITY_HIGH = 7
+
+# Peers with a higher priority are connected to before the others, such as
+# peers on the local network
+PEER_PRIORITY_NORMAL = 0
+PEER_PRIORITY_LOCAL = 1
+
+
+class PeerQueue(PriorityQueue):
+    """
+    The (ip, port) of the peers to connect to, taken in the order they were
+    put in except for peers given a higher priority, which go first.
+    """
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._count = itertools.count()
+
+    def put_nowait(self, peer, priority: int = PEER_PRIORITY_NORMAL):
+        super().put_nowait((-priority, next(self._count), peer))
+
+    def _get(self):
+        return super()._get()[2]
+
+    @property
+    def peers(self) -> set:
+        """
+        The peers waiting to be connected to.
+        """
+        return {entry[2] for entry in self._queue}
+
+    def remove(self, peers: set):
+        """
+        Drop the given peers, if still waiting.
+        """
+        self._queue = [entry for entry in self._queue
+                       if entry[2] not in peers]
+        heapq.heapify(self._queue)
+
+
 class TorrentClient:
-    def __init__(self, torrent):
-        self.tracker = Tracker(torrent)
-        self.available_peers = Queue()
+    def __init__(self, torrent, tracker=None,
+                 max_peer_connections=MAX_PEER_CONNECTIONS,
+                 max_ongoing_pieces=None,
+                 download_limiter=None, upload_limiter=None,
+                 socket_options=None, download_dir: str = '',
+                 metrics=None, peer_cache=None):
+        """
+        :param torrent: The torrent to download
+        :param tracker: The tracker to announce to, when running within a
+                        `Session` this tracker shares the session's HTTP client
+        :param max_peer_connections: The number of peers to connect to
+        :param max_ongoing_pieces: The number of pieces kept in memory while
+                                   being downloaded, or None for no limit
+        :param download_limiter: The session wide `TokenBucket` the download
+                                 limit of this torrent is subject to
+        :param upload_limiter: The session wide `TokenBucket` the upload limit
+                               of this torrent is subject to
+        :param socket_options: The `SocketOptions` used for peer connections
+        :param download_dir: The directory to save the downloaded data in,
+                             defaults to the current working directory
+        :param metrics: The `MetricsRegistry` to keep the metrics of this
+                        torrent in, defaults to the global one
+        :param peer_cache: The `PeerCache` remembering the peers that sent us
+                           data across restarts, None to not remember them
+        """
+        self.tracker = tracker if tracker else Tracker(torrent)
+        self.available_peers = PeerQueue()
         self.peers = []
-        self.piece_manager = PieceManager(torrent) #This will be a class later on!
+        self.metrics = TorrentMetrics(torrent.info_hash, metrics)
+        self.piece_manager = PieceManager(torrent, download_dir, self.metrics) #This will be a class later on!
+        self.piece_manager.max_ongoing_pieces = max_ongoing_pieces
+        self.piece_manager.on_ban = self._on_ban
+        self.piece_manager.on_have = self._on_have
+        self.max_peer_connections = max_peer_connections
+        # The IPs of banned peers, never connected to again
+        self.banned_ips = set()
+        # Peers learned about through peer exchange
+        self.pex = PeerExchange(self.tracker.port, self._on_pex_peers)
+        self._pex_peers = set()
+        # The peers queued from the last tracker response, replaced by the
+        # peers of the next
+        self._tracker_peers = set()
+        # Bandwidth is limited per torrent and per peer, both unlimited until
+        # changed through `set_rate_limits`
+        self.download_limiter = TokenBucket(parent=download_limiter)
+        self.upload_limiter = TokenBucket(parent=upload_limiter)
+        self.peer_download_rate = None
+        self.peer_upload_rate = None
+        self.socket_options = socket_options
+        self.snub_timeout = SNUB_TIMEOUT
+        # Whether to skip telling peers about pieces they have themselves
+        self.suppress_have = False
+        self.peer_cache = peer_cache
+        # The HTTP servers of the torrent's url-list, started along with the
+        # peers
+        self.web_seeds = []
+        self._last_unsnub = time.monotonic()
+        # When (in time.monotonic) to announce next, and the earliest we may
+        # announce when starving for peers
+        self._next_announce = 0
+        self._earliest_announce = 0
+        self._wakeup = asyncio.Event()
+        # Whether the tracker knows about us, and must be told we stopped
+        self._announced = False
+        self.stopped_announce = None
         self.abort = False
 
     async def start(self):
-        self.peers = [PeerConnection(self.available_peers,
-                                     self.tracker.torrent.info_hash,
-                                     self.tracker.peer_id,
-                                     self.piece_manager,
-                                     self._on_block_retrieved)
-                      for _ in range(MAX_PEER_CONNECTIONS)]
-        previous = None
-        interval = 30*60
+        self.peers = [self._new_peer()
+                      for _ in range(self.max_peer_connections)]
+        if self.peer_cache:
+            # Peers known from earlier sessions are dialed while the tracker
+            # is being asked for more
+            for peer in self.peer_cache.peers(self.tracker.torrent.info_hash):
+                if peer[0] not in self.banned_ips:
+                    self.available_peers.put_nowait(peer)
+        # Shares the HTTP client of the tracker when within a session
+        torrent = self.tracker.torrent
+        self.web_seeds = [WebSeed(url, torrent, self.piece_manager,
+                                  http_client=self.tracker.http_client,
+                                  limiter=self.download_limiter,
+                                  metrics=self.metrics)
+                          for url in torrent.url_list]
+        for web_seed in self.web_seeds:
+            web_seed.start()
 
+        maintenance = asyncio.ensure_future(self._maintain())
+        try:
+            await self._schedule_announces()
+        finally:
+            maintenance.cancel()
+        self.stop()
+
+    async def _schedule_announces(self):
+        """
+        Announce when the tracker's interval is up, or as soon as its minimum
+        interval allows when we're running out of peers. Sleeps in between
+        until woken up by a peer disconnecting, the download completing or
+        the client being stopped.
+        """
+        event = 'started'
         while True:
-            if self.piece_manager.complete:
-                logging.info('Torrent fully downloaded!')
-                break
             if self.abort:
                 logging.info('Aborting download...')
                 break
+            if self.piece_manager.complete:
+                logging.info('Torrent fully downloaded!')
+                await self._announce('completed')
+                break
 
-            current = time.time()
-            if (not previous) or (previous + interval < current):
-                response = await self.tracker.connect(
-                    first=previous if previous else False,
-                    uploaded=self.piece_manager.bytes_uploaded,
-                    downloaded=self.piece_manager.bytes_downloaded)
-
-                if response:
-                    previous = current
-                    interval = response.interval
-                    self._empty_queue()
-                    for peer in response.peers:
-                        self.available_peers.put_nowait(peer)
-            else:
-                await asyncio.sleep(5)
-        self.stop()
+            now = time.monotonic()
+            if now >= self._next_announce or \
+                    (self._starving() and now >= self._earliest_announce):
+                if await self._announce(event):
+                    event = None
+                now = time.monotonic()
+
+            timeout = self._next_announce - now
+            if self._starving():
+                timeout = min(timeout, self._earliest_announce - now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
 
-    def _empty_queue(self):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
+    async def _announce(self, event: str = None) -> bool:
+        """
+        :return: Whether the tracker could be reached
+        """
+        now = time.monotonic()
+        try:
+            response = await self.tracker.connect(
+                event=event,
+                uploaded=self.piece_manager.bytes_uploaded,
+                downloaded=self.piece_manager.bytes_downloaded,
+                left=self._bytes_left(),
+                numwant=self._numwant())
+        except (aiohttp.ClientError, ConnectionError,
+                asyncio.TimeoutError) as e:
+            # Keep going with the peers we have, cached ones or otherwise,
+            # and ask again later
+            logging.warning('Announce failed: {error}'.format(error=e))
+            self._next_announce = now + ANNOUNCE_RETRY_INTERVAL
+            self._earliest_announce = self._next_announce
+            return False
+
+        self._announced = True
+        interval = response.interval or ANNOUNCE_INTERVAL
+        min_interval = response.min_interval
+        if min_interval is None:
+            min_interval = min(interval, MIN_ANNOUNCE_INTERVAL)
+        self._next_announce = now + interval
+        self._earliest_announce = now + min_interval
+        self._replace_tracker_peers(response.peers)
+        return True
+
+    async def _announce_stopped(self):
+        try:
+            await asyncio.wait_for(self.tracker.connect(
+                event='stopped',
+                uploaded=self.piece_manager.bytes_uploaded,
+                downloaded=self.piece_manager.bytes_downloaded,
+                left=self._bytes_left(),
+                numwant=0), STOPPED_ANNOUNCE_TIMEOUT)
+        except (aiohttp.ClientError, ConnectionError,
+                asyncio.TimeoutError) as e:
+            logging.warning('Announce failed: {error}'.format(error=e))
+        finally:
+            self.tracker.close()
+
+    def _bytes_left(self) -> int:
+        return self.piece_manager.bytes_left
+
+    def _starving(self) -> bool:
+        return self.available_peers.empty() and \
+            self.connections < self.max_peer_connections * STARVATION_RATIO
+
+    def _numwant(self) -> int:
+        # Enough peers to fill the free connection slots
+        return max(self.max_peer_connections - self.connections, 0)
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            try:
+                self._check_snubbed()
+                self.pex.update(self.peers)
+                now = time.monotonic()
+                for peer in self.peers:
+                    peer.keep_alive(now)
+            except Exception:
+                # A single misbehaving peer mustn't end the maintenance for
+                # every other peer
+                logging.exception('Peer maintenance failed')
+
+    def _new_peer(self, inbound=None):
+        return PeerConnection(self.available_peers,
+                              self.tracker.torrent.info_hash,
+                              self.tracker.peer_id,
+                              self.piece_manager,
+                              self._on_block_retrieved,
+                              inbound=inbound,
+                              download_limiter=TokenBucket(
+                                  self.peer_download_rate,
+                                  parent=self.download_limiter),
+                              upload_limiter=TokenBucket(
+                                  self.peer_upload_rate,
+                                  parent=self.upload_limiter),
+                              socket_options=self.socket_options,
+                              metrics=self.metrics,
+                              pex=self.pex,
+                              on_close=self._on_peer_closed)
+
+    @property
+    def connections(self) -> int:
+        """
+        The number of peers we currently have an open connection to.
+        """
+        return len([p for p in self.peers if p.connected])
+
+    def set_limits(self, max_peer_connections: int, max_ongoing_pieces=None):
+        """
+        Change the connection and memory budget of this torrent while it is
+        running. Workers are started or stopped to match the new connection
+        budget.
+        """
+        self.piece_manager.max_ongoing_pieces = max_ongoing_pieces
+        self.max_peer_connections = max_peer_connections
+        # More slots may have to be filled
+        self._wakeup.set()
+        if self.abort or not self.peers:
+            # Not started (or already stopped), picked up by `start`
+            return
+        # Workers finished serving an inbound peer are of no further use
+        self.peers = [p for p in self.peers if not p.future.done()]
+        workers = [p for p in self.peers if not p.inbound]
+        while len(workers) < max_peer_connections:
+            peer = self._new_peer()
+            workers.append(peer)
+            self.peers.append(peer)
+        # Prefer stopping workers that are idle waiting for a peer
+        workers.sort(key=lambda p: p.connected)
+        for peer in workers[:len(workers) - max_peer_connections]:
+            peer.stop()
+            self.peers.remove(peer)
+
+    def set_rate_limits(self, download: float = None, upload: float = None,
+                        peer_download: float = None,
+                        peer_upload: float = None):
+        """
+        Change the bandwidth limits (in bytes per second) of this torrent and
+        of each of its peers, None means unlimited. Takes effect immediately,
+        also for peers already connected.
+        """
+        self.download_limiter.rate = download
+        self.upload_limiter.rate = upload
+        self.peer_download_rate = peer_download
+        self.peer_upload_rate = peer_upload
+        for peer in self.peers:
+            peer.download_limiter.rate = peer_download
+            peer.upload_limiter.rate = peer_upload
+
+    def add_inbound(self, reader, writer, handshake) -> bool:
+        """
+        Hand over a connection accepted by a session listener.
+
+        :return: False if the connection budget is exhausted, the caller is
+                 then responsible for closing the connection
+        """
+        if self.abort or self.connections >= self.max_peer_connections:
+            return False
+        if writer.get_extra_info('peername')[0] in self.banned_ips:
+            return False
+        self.peers.append(self._new_peer(inbound=(reader, writer, handshake)))
+        return True
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Read data of the torrent while it is downloading. Pieces not yet
+        downloaded are fetched before any other piece, and waited for.
+
+        :param offset: The offset (in bytes) within the torrent's data
+        :param length: The number of bytes to read, less are returned at the
+                       end of the data
+        """
+        if self.abort:
+            raise ValueError('Can not read from a stopped torrent')
+        total_size = self.piece_manager.torrent.total_size
+        if offset < 0 or length < 0 or offset > total_size:
+            raise ValueError('Can not read {length} bytes at {offset}'
+                             .format(length=length, offset=offset))
+        length = min(length, total_size - offset)
+        if not length:
+            return b''
+        if self.piece_manager.skips(offset, length):
+            raise ValueError('Can not read data of a skipped file')
+        piece_length = self.piece_manager.torrent.piece_length
+        first = offset // piece_length
+        last = (offset + length - 1) // piece_length
+        for index in range(first, last + 1):
+            self.piece_manager.prioritize(index)
+        for index in range(first, last + 1):
+            await self.piece_manager.wait_for(index)
+        return self.piece_manager.read(offset, length)
+
+    def open(self, offset: int = 0, size: int = None):
+        """
+        A file-like `TorrentReader` over (part of) the torrent's data.
+        """
+        return TorrentReader(self, offset, size)
+
+    def set_file_priorities(self, priorities: [int]):
+        """
+        Change the priority of each file of the torrent, one of the
+        PRIORITY_* constants. Takes effect for pieces not yet started.
+        """
+        self.piece_manager.set_file_priorities(priorities)
+        for peer in self.peers:
+            peer.update_interest()
+
+    def _check_snubbed(self):
+        now = time.monotonic()
+        for peer in self.peers:
+            if peer.is_snubbing(now, self.snub_timeout):
+                peer.snub()
+
+        snubbed = [p for p in self.peers if p.snubbed]
+        if snubbed and now - self._last_unsnub >= OPTIMISTIC_UNSNUB_INTERVAL:
+            self._last_unsnub = now
+            # Rotate through the snubbed peers, longest snubbed first
+            min(snubbed, key=lambda p: p.snubbed_at).unsnub()
+
+    def _on_pex_peers(self, peers):
+        connected = {p.listen_address for p in self.peers}
+        for peer in peers:
+            if peer in connected or peer in self._pex_peers or \
+                    peer[0] in self.banned_ips:
+                continue
+            self._pex_peers.add(peer)
+            self.available_peers.put_nowait(peer)
+
+    def add_peer(self, peer: tuple, priority: int = PEER_PRIORITY_NORMAL):
+        """
+        Connect to the peer at the given (ip, port) unless already
+        connected, ahead of the peers of a lower priority.
+        """
+        if self.abort or peer[0] in self.banned_ips or \
+                peer in {p.listen_address for p in self.peers}:
+            return
+        self.available_peers.put_nowait(peer, priority)
+
+    def _on_ban(self, peer_id):
+        for peer in [p for p in self.peers if p.remote_id == peer_id]:
+            if peer.address:
+                self.banned_ips.add(peer.address.rpartition(':')[0])
+            peer.stop()
+            self.peers.remove(peer)
+            if not peer.inbound and not self.abort:
+                # Keep the number of workers connecting to peers
+                self.peers.append(self._new_peer())
+
+    def _on_have(self, index: int):
+        # Every peer is told, and peers having nothing else we want are told
+        # we're no longer interested
+        for peer in self.peers:
+            peer.announce_have(index, self.suppress_have)
+            peer.update_interest()
+        if self.piece_manager.complete:
+            self._wakeup.set()
+
+    def _on_peer_closed(self, peer):
+        # We may be running out of peers
+        self._wakeup.set()
+        if not self.peer_cache or not peer.listen_address:
+            return
+        info_hash = self.tracker.torrent.info_hash
+        if peer.connected_at is None:
+            self.peer_cache.forget(info_hash, peer.listen_address)
+        elif peer.downloaded:
+            elapsed = max(time.monotonic() - peer.connected_at, 1)
+            self.peer_cache.record(info_hash, peer.listen_address,
+                                   peer.downloaded / elapsed)
+
+    def _replace_tracker_peers(self, peers):
+        # Peers found otherwise, local ones in particular, keep their place
+        # in the queue
+        self.available_peers.remove(self._tracker_peers)
+        queued = self.available_peers.peers
+        connected = {p.listen_address for p in self.peers if p.connected}
+        self._tracker_peers = set()
+        for peer in peers:
+            if peer[0] in self.banned_ips or peer in queued or \
+                    peer in connected or peer in self._tracker_peers:
+                continue
+            self._tracker_peers.add(peer)
+            self.available_peers.put_nowait(peer)
+        # Peers told about through PEX may be queued again once dialed
+        self._pex_peers &= queued
 
     def stop(self):
         self.abort = True
+        self._wakeup.set()
+        if self.peer_cache:
+            for peer in self.peers:
+                if peer.connected:
+                    self._on_peer_closed(peer)
+            self.peer_cache.save(self.tracker.torrent.info_hash)
         for peer in self.peers:
             peer.stop()
+        for web_seed in self.web_seeds:
+            web_seed.stop()
         self.piece_manager.close()
-        self.tracker.close()
+        if self._announced:
+            self._announced = False
+            self.stopped_announce = asyncio.ensure_future(
+                self._announce_stopped())
+        elif not self.stopped_announce:
+            self.tracker.close()
 
     def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
         self.piece_manager.block_received(
@@ -82,16 +539,28 @@ class Block:
         self.length = length
         self.status = Block.Missing
         self.data = None
+        self.retries = 0  # Times the request for this block timed out
+        self.peer = None  # The peer the data was received from
 
 class Piece: #The piece is a part of of the torrents content
     def __init__(self, index: int, blocks: [], hash_value):
         self.index = index
         self.blocks = blocks
         self.hash = hash_value
+        self.started = None  # When the first block was requested
+        # Peers that supplied blocks for a copy failing the hash check, that
+        # are passed over when another peer is able to supply the blocks
+        self.excluded = set()
+
+    @property
+    def length(self) -> int:
+        return sum(b.length for b in self.blocks)
 
     def reset(self):
         for block in self.blocks:
             block.status = Block.Missing
+            block.data = None
+            block.peer = None
 
     def next_request(self) -> Block:
         missing = [b for b in self.blocks if b.status is Block.Missing]
@@ -100,19 +569,26 @@ class Piece: #The piece is a part of of the torrents content
             return missing[0]
         return None
 
-    def block_received(self, offset: int, data: bytes):
+    def block_received(self, offset: int, data: bytes, peer_id=None) -> bool:
+        """
+        :return: False if the block was retrieved already (or does not exist)
+        """
         matches = [b for b in self.blocks if b.offset == offset]
         block = matches[0] if matches else None
         if block:
+            if block.status == Block.Retrieved:
+                return False
             block.status = Block.Retrieved
             block.data = data
-        else:
-            logging.warning('Trying to complete a non-existing block {offset}'
-                            .format(offset=offset))
+            block.peer = peer_id
+            return True
+        logging.warning('Trying to complete a non-existing block {offset}'
+                        .format(offset=offset))
+        return False
 
     def is_complete(self) -> bool:
         blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) is 0
+        return len(blocks) == 0
 
     def is_hash_matching(self):
         piece_hash = sha1(self.data).digest()
@@ -124,20 +600,108 @@ class Piece: #The piece is a part of of the torrents content
         blocks_data = [b.data for b in retrieved]
         return b''.join(blocks_data)
 
-PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
+class PendingRequest:
+    def __init__(self, block: Block, peer_id, added: float, deadline: float,
+                 retry: bool = False):
+        self.block = block
+        self.peer_id = peer_id
+        self.added = added
+        self.deadline = deadline
+        self.retry = retry  # Requested before, so its RTT is ambiguous
+        self.active = True  # False once answered, left in the heap till due
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class RequestTimer:
+    """
+    Estimates how long to wait for a peer to respond to a request from the
+    round trip times measured so far, the same way TCP computes its
+    retransmission timeout (RFC 6298).
+    """
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = INITIAL_REQUEST_TIMEOUT
+
+    def update(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(MAX_REQUEST_TIMEOUT,
+                           max(MIN_REQUEST_TIMEOUT,
+                               self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        self.timeout = min(MAX_REQUEST_TIMEOUT, self.timeout * 2)
+
 
 class PieceManager: #The class that was missing previous commit!!
-    def __init__(self, torrent):
+    def __init__(self, torrent, download_dir: str = '', metrics=None):
         self.torrent = torrent
+        self.metrics = metrics if metrics \
+            else TorrentMetrics(torrent.info_hash)
         self.peers = {}
-        self.pending_blocks = []
+        # Requests awaiting a block by (piece, offset), and the same requests
+        # in a heap ordered by deadline
+        self.pending_blocks = {}
+        self._deadlines = []
+        self._timers = {}  # peer_id -> RequestTimer
         self.missing_pieces = []
         self.ongoing_pieces = []
         self.have_pieces = []
-        self.max_pending_time = 300 * 1000  # 5 minutes (its not that im mister fancy pants it just is)
+        # Peers caught sending corrupt data, and the hashes of the blocks of
+        # failed pieces by (piece, offset) -> {peer_id: hash} that tell who
+        # sent the corrupt data once the piece is downloaded correctly
+        self.banned = set()
+        self._suspects = defaultdict(dict)
+        # Called with the peer_id of a banned peer
+        self.on_ban = None
+        # Decides which piece to start next, may be changed at any time
+        self.picker = RarestFirst()
+        # Pieces someone is waiting for, downloaded before any other, and
+        # the futures waiting by piece index
+        self.priority_pieces = set()
+        self._waiters = defaultdict(list)
+        self._have = set()
+        # Bounds the memory used for buffering blocks of pieces not yet
+        # complete, None means no limit
+        self.max_ongoing_pieces = None
         self.missing_pieces = self._initiate_pieces()
         self.total_pieces = len(torrent.pieces)
-        self.fd = os.open(self.torrent.output_file, os.O_RDWR | os.O_CREAT)
+        self._pieces = list(self.missing_pieces)  # Every piece by index
+        # With NumPy installed, the pieces of the peers are kept in a bit
+        # matrix and the pieces not yet started in a mask
+        self.availability = None
+        self._wanted = None
+        if numpy is not None:
+            self.availability = Availability(self.total_pieces)
+            self._wanted = numpy.ones(self.total_pieces, dtype=bool)
+        self._bytes_downloaded = 0
+        self.storage = Storage(torrent, download_dir)
+        # Pieces of skipped files only, left out of the picker altogether
+        self.skipped_pieces = []
+        self.file_priorities = [PRIORITY_NORMAL] * len(torrent.files)
+        # The priority of each piece, None while all files share the same
+        # priority
+        self.piece_priorities = None
+        self._skipped_files = set()
+        # Verified pieces at a file boundary whose data of skipped files was
+        # dropped, by index -> indexes of those files
+        self._dropped = {}
+        # The only pieces to download, or None for all of them
+        self.shard = None
+        # The pieces we still want, and the number of those each peer has,
+        # i.e. whether we're interested in the peer
+        self._wanted_bits = bitstring.BitArray(length=self.total_pieces)
+        self._wanted_bits.set(True)
+        self._interesting = {}
+        # Called with the index of every piece downloaded
+        self.on_have = None
 
     def _initiate_pieces(self) -> [Piece]:
         torrent = self.torrent
@@ -151,7 +715,8 @@ class PieceManager: #The class that was missing previous commit!!
                           for offset in range(std_piece_blocks)]
 
             else:
-                last_length = torrent.total_size % torrent.piece_length
+                last_length = torrent.total_size - \
+                    torrent.piece_length * (total_pieces - 1)
                 num_blocks = math.ceil(last_length / REQUEST_SIZE)
                 blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
                           for offset in range(num_blocks)]
@@ -163,129 +728,481 @@ class PieceManager: #The class that was missing previous commit!!
         return pieces
 
     def close(self):
-        if self.fd:
-            os.close(self.fd)
+        self.storage.close()
+        # Nothing will be downloaded anymore, don't keep readers waiting
+        for futures in self._waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(
+                        ValueError('The torrent was stopped'))
+        self._waiters.clear()
 
 
     @property
     def complete(self):
-        return len(self.have_pieces) == self.total_pieces
+        return not self.missing_pieces and not self.ongoing_pieces
 
     @property
     def bytes_downloaded(self) -> int:
-        return len(self.have_pieces) * self.torrent.piece_length
+        return self._bytes_downloaded
+
+    @property
+    def bitfield(self) -> bitstring.BitArray:
+        """
+        The pieces we have.
+        """
+        bitfield = bitstring.BitArray(length=self.total_pieces)
+        for piece in self.have_pieces:
+            bitfield[piece.index] = True
+        return bitfield
+
+    @property
+    def bytes_left(self) -> int:
+        """
+        The bytes still to download, not counting pieces only holding data
+        of skipped files.
+        """
+        return sum(p.length for p in self.missing_pieces) + \
+            sum(p.length for p in self.ongoing_pieces)
 
     @property
     def bytes_uploaded(self) -> int:
         return 0
 
     def add_peer(self, peer_id, bitfield):
+        if peer_id in self.banned:
+            return
         self.peers[peer_id] = bitfield
+        self._interesting[peer_id] = self._count_interesting(bitfield)
+        if self.availability is not None:
+            self.availability.add(peer_id, bitfield.tobytes())
 
     def update_peer(self, peer_id, index: int):
         if peer_id in self.peers:
+            if not self.peers[peer_id][index] and self._wanted_bits[index]:
+                self._interesting[peer_id] += 1
             self.peers[peer_id][index] = 1
+            if self.availability is not None:
+                self.availability.have(peer_id, index)
 
     def remove_peer(self, peer_id):
         if peer_id in self.peers:
             del self.peers[peer_id]
+            del self._interesting[peer_id]
+            if self.availability is not None:
+                self.availability.remove(peer_id)
+        self._timers.pop(peer_id, None)
+
+    def interesting(self, peer_id) -> bool:
+        """
+        Whether the peer has any piece we still want.
+        """
+        return self._interesting.get(peer_id, 0) > 0
 
-    def next_request(self, peer_id) -> Block:
+    def _count_interesting(self, bitfield) -> int:
+        bits = bitstring.BitArray(bitfield[:self.total_pieces])
+        if len(bits) < self.total_pieces:
+            bits.append(self.total_pieces - len(bits))
+        return (bits & self._wanted_bits).count(1)
+
+    def next_request(self, peer_id, pieces=None,
+                     expires: bool = True) -> Block:
+        """
+        :param pieces: When given, only blocks of pieces with these indexes
+                       are requested, e.g. the allowed fast pieces
+        :param expires: False to keep the block pending until it's received
+                        or released, e.g. for web seeds fetching it in a run
+                        of blocks that only completes as a whole
+        """
         if peer_id not in self.peers:
             return None
 
-        block = self._expired_requests(peer_id)
-        if not block:
-            block = self._next_ongoing(peer_id)
-            if not block:
-                block = self._get_rarest_piece(peer_id).next_request()
+        # Expired blocks are missing again, and picked up by `_next_ongoing`
+        self._expire_requests()
+        block = self._next_ongoing(peer_id, pieces)
+        if not block and not self._ongoing_limit_reached():
+            piece = self._pick_piece(peer_id, pieces)
+            block = piece.next_request() if piece else None
+        if block:
+            self._add_pending(block, peer_id, expires)
         return block
 
+    def peer_rtt(self, peer_id) -> float:
+        """
+        The smoothed round trip time of requests to the given peer, before
+        any is measured the initial request timeout.
+        """
+        timer = self._timers.get(peer_id)
+        if timer is None or timer.srtt is None:
+            return INITIAL_REQUEST_TIMEOUT
+        return timer.srtt
+
+    def request_timeout(self, peer_id) -> float:
+        """
+        The number of seconds the given peer gets to respond to a request.
+        """
+        timer = self._timers.get(peer_id)
+        return timer.timeout if timer else INITIAL_REQUEST_TIMEOUT
+
+    def _ongoing_limit_reached(self) -> bool:
+        # Pieces someone is waiting for may always be started
+        return self.max_ongoing_pieces is not None and \
+            len(self.ongoing_pieces) >= self.max_ongoing_pieces and \
+            not self.priority_pieces
+
     def block_received(self, peer_id, piece_index, block_offset, data):
-        logging.debug('Received block {block_offset} for piece {piece_index} '
-                      'from peer {peer_id}: '.format(block_offset=block_offset,
-                                                     piece_index=piece_index,
-                                                     peer_id=peer_id))
-
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-                    request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
+        logging.debug('Received block %s for piece %s from peer %s',
+                      block_offset, piece_index, peer_id)
+
+        request = self.pending_blocks.pop((piece_index, block_offset), None)
+        if request:
+            request.active = False
+            rtt = time.monotonic() - request.added
+            self.metrics.request_rtt.observe(rtt)
+            # Like Karn's algorithm, a block requested more than once can't
+            # tell which request it answers
+            if not request.retry and request.deadline is not None:
+                self._timer(request.peer_id).update(rtt)
 
         pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
         piece = pieces[0] if pieces else None
         if piece:
-            piece.block_received(block_offset, data)
+            if not piece.block_received(block_offset, data, peer_id):
+                self.metrics.duplicate_bytes.inc(len(data))
+                return
             if piece.is_complete():
-                if piece.is_hash_matching():
-                    self._write(piece)
+                completed = time.monotonic()
+                with span('hash'):
+                    matching = piece.is_hash_matching()
+                verified = time.monotonic()
+                self.metrics.hash_time.observe(verified - completed)
+                if matching:
+                    with span('write'):
+                        self._write(piece)
+                    self.metrics.write_time.observe(
+                        time.monotonic() - verified)
+                    if piece.started is not None:
+                        self.metrics.piece_latency.observe(
+                            verified - piece.started)
+                    if piece.excluded:
+                        self._ban_culprits(piece)
+                    self._bytes_downloaded += piece.length
                     self.ongoing_pieces.remove(piece)
                     self.have_pieces.append(piece)
-                    complete = (self.total_pieces -
-                                len(self.missing_pieces) -
-                                len(self.ongoing_pieces))
+                    self._on_have(piece)
+                    complete = len(self.have_pieces)
+                    total = complete + len(self.missing_pieces) + \
+                        len(self.ongoing_pieces)
                     logging.info(
                         '{complete} / {total} pieces downloaded {per:.3f} %'
                         .format(complete=complete,
-                                total=self.total_pieces,
-                                per=(complete / self.total_pieces) * 100))
+                                total=total,
+                                per=(complete / total) * 100))
                 else:
                     logging.info('Discarding corrupt piece {index}'
                                  .format(index=piece.index))
+                    self.metrics.hash_failures.inc()
+                    self.metrics.wasted_bytes.inc(piece.length)
+                    self._on_hash_failure(piece)
                     piece.reset()
         else:
+            # Most likely a block requested from several peers
+            self.metrics.duplicate_bytes.inc(len(data))
             logging.warning('Trying to update piece that is not ongoing!')
 
 
-    def _expired_requests(self, peer_id) -> Block:
-        current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
-                if request.added + self.max_pending_time < current:
-                    logging.info('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                        block=request.block.offset,
-                        piece=request.block.piece))
-                    # Reset expiration timer
-                    request.added = current
-                    return request.block
-        return None
+    def have(self, index: int) -> bool:
+        """
+        Whether the piece was downloaded and verified.
+        """
+        return index in self._have
+
+    def prioritize(self, index: int):
+        """
+        Download the given piece before any other piece not yet started.
+        """
+        if index not in self._have:
+            self.priority_pieces.add(index)
+
+    async def wait_for(self, index: int):
+        """
+        Prioritize the given piece and wait until it is downloaded.
+        """
+        if index in self._have:
+            return
+        self.prioritize(index)
+        future = asyncio.get_event_loop().create_future()
+        self._waiters[index].append(future)
+        await future
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Read data of pieces already downloaded from disk.
+        """
+        return self.storage.read(offset, length)
+
+    def set_file_priorities(self, priorities: [int]):
+        """
+        Change the priority of each file of the torrent. A piece gets the
+        highest priority of the files it holds data of, pieces already
+        started are downloaded regardless.
+        """
+        if len(priorities) != len(self.file_priorities) or \
+                any(p < PRIORITY_SKIP for p in priorities):
+            raise ValueError('Invalid file priorities {priorities}'.format(
+                priorities=priorities))
+        self.file_priorities = list(priorities)
+        self._skipped_files = {index for index, priority
+                               in enumerate(priorities)
+                               if priority == PRIORITY_SKIP}
+        piece_priorities = [PRIORITY_SKIP] * self.total_pieces
+        for index, priority in enumerate(priorities):
+            for piece in self.storage.pieces(index):
+                piece_priorities[piece] = max(piece_priorities[piece],
+                                              priority)
+        if self.shard is not None:
+            for index in range(self.total_pieces):
+                if index not in self.shard:
+                    piece_priorities[index] = PRIORITY_SKIP
+
+        pieces = self.missing_pieces + self.skipped_pieces
+        # Pieces at the boundary of a file no longer skipped lack that
+        # file's data on disk, so they're downloaded again
+        for index, dropped in list(self._dropped.items()):
+            if dropped - self._skipped_files:
+                piece = self._pieces[index]
+                del self._dropped[index]
+                self.have_pieces.remove(piece)
+                self._have.discard(index)
+                piece.reset()
+                pieces.append(piece)
+        self.missing_pieces = sorted(
+            [p for p in pieces if piece_priorities[p.index] != PRIORITY_SKIP],
+            key=lambda p: p.index)
+        self.skipped_pieces = [p for p in pieces if
+                               piece_priorities[p.index] == PRIORITY_SKIP]
+        wanted = {p for p in piece_priorities if p != PRIORITY_SKIP}
+        self.piece_priorities = piece_priorities if len(wanted) > 1 else None
+        if self.availability is not None:
+            self._wanted = self.availability.mask(
+                p.index for p in self.missing_pieces)
+        # Pieces already started are downloaded regardless
+        self._wanted_bits = bitstring.BitArray(length=self.total_pieces)
+        for piece in self.missing_pieces + self.ongoing_pieces:
+            self._wanted_bits[piece.index] = True
+        self._interesting = {peer_id: self._count_interesting(bitfield)
+                             for peer_id, bitfield in self.peers.items()}
+
+    def set_shard(self, pieces: range):
+        """
+        Only download the given pieces, the share of one of several
+        processes downloading the torrent together. Pieces outside the shard
+        are left out like the pieces of skipped files.
+        """
+        self.shard = pieces
+        self.set_file_priorities(self.file_priorities)
+
+    def skips(self, offset: int, length: int) -> bool:
+        """
+        Whether the given range of the torrent's data touches a skipped file.
+        """
+        return any(index in self._skipped_files for index, _, _ in
+                   self.storage.spans(offset, length))
+
+    def _on_have(self, piece):
+        self._have.add(piece.index)
+        self.priority_pieces.discard(piece.index)
+        self._wanted_bits[piece.index] = False
+        for peer_id, bitfield in self.peers.items():
+            if bitfield[piece.index]:
+                self._interesting[peer_id] -= 1
+        # The data is on disk now, read back from there when needed
+        for block in piece.blocks:
+            block.data = None
+        for future in self._waiters.pop(piece.index, []):
+            if not future.done():
+                future.set_result(None)
+        if self.on_have:
+            self.on_have(piece.index)
+
+    def reject_request(self, peer_id, piece_index: int, block_offset: int):
+        """
+        The peer won't send the given block, so it may be requested again.
+        """
+        request = self.pending_blocks.get((piece_index, block_offset))
+        if request and request.peer_id == peer_id:
+            self._release(request)
+
+    def ban(self, peer_id):
+        """
+        Stop downloading from the given peer, for good.
+        """
+        logging.warning('Banning peer {id} for sending corrupt data'.format(
+            id=peer_id))
+        self.banned.add(peer_id)
+        self.release_requests(peer_id)
+        self.remove_peer(peer_id)
+        if self.on_ban:
+            self.on_ban(peer_id)
+
+    def _on_hash_failure(self, piece):
+        contributors = {b.peer for b in piece.blocks} - {None}
+        if len(contributors) == 1:
+            # No doubt about who sent the corrupt data
+            self.ban(contributors.pop())
+            return
+        for block in piece.blocks:
+            if block.peer is not None:
+                self._suspects[(piece.index, block.offset)][block.peer] = \
+                    sha1(block.data).digest()
+        piece.excluded |= contributors
+
+    def _ban_culprits(self, piece):
+        # Anyone that sent a block different from the one in the piece that
+        # passed the hash check sent corrupt data
+        for block in piece.blocks:
+            suspects = self._suspects.pop((piece.index, block.offset), {})
+            digest = sha1(block.data).digest() if suspects else None
+            for peer_id, suspect in suspects.items():
+                if suspect != digest and peer_id not in self.banned:
+                    self.ban(peer_id)
+        piece.excluded.clear()
+
+    def _others_have(self, piece, peer_id) -> bool:
+        return any(bitfield[piece.index] for other, bitfield
+                   in self.peers.items()
+                   if other != peer_id and other not in piece.excluded)
 
-    def _next_ongoing(self, peer_id) -> Block:
-        for piece in self.ongoing_pieces:
+    def release_requests(self, peer_id) -> [Block]:
+        """
+        Hand the blocks requested from the given peer back to the picker,
+        e.g. since the peer stopped sending them.
+
+        :return: The blocks released
+        """
+        released = [r for r in self.pending_blocks.values()
+                    if r.peer_id == peer_id]
+        for request in released:
+            self._release(request)
+        return [r.block for r in released]
+
+    def _release(self, request: PendingRequest):
+        block = request.block
+        request.active = False
+        del self.pending_blocks[(block.piece, block.offset)]
+        if block.status == Block.Pending:
+            block.status = Block.Missing
+
+    def _timer(self, peer_id) -> RequestTimer:
+        timer = self._timers.get(peer_id)
+        if timer is None:
+            timer = self._timers[peer_id] = RequestTimer()
+        return timer
+
+    def _add_pending(self, block: Block, peer_id, expires: bool = True):
+        key = (block.piece, block.offset)
+        previous = self.pending_blocks.get(key)
+        if previous:
+            previous.active = False
+        now = time.monotonic()
+        deadline = now + self.request_timeout(peer_id) if expires else None
+        request = PendingRequest(block, peer_id, now, deadline,
+                                 retry=block.retries > 0)
+        self.pending_blocks[key] = request
+        # Requests without a deadline never expire, they're left out of the
+        # heap till released
+        if expires:
+            heapq.heappush(self._deadlines, request)
+
+    def _expire_requests(self):
+        # Requests answered in the meantime are only dropped from the heap
+        # once they're due, which keeps receiving a block O(1)
+        now = time.monotonic()
+        expired = set()
+        while self._deadlines and self._deadlines[0].deadline <= now:
+            request = heapq.heappop(self._deadlines)
+            if not request.active:
+                continue
+            block = request.block
+            del self.pending_blocks[(block.piece, block.offset)]
+            if block.status == Block.Pending:
+                logging.info('Re-requesting block {block} for piece {piece}'
+                             .format(block=block.offset, piece=block.piece))
+                block.status = Block.Missing
+                block.retries += 1
+            expired.add(request.peer_id)
+        # A stalled peer has a whole pipeline of requests expiring at once,
+        # backed off once as for a single timer expiry
+        for peer_id in expired:
+            self._timer(peer_id).backoff()
+
+    def _next_ongoing(self, peer_id, pieces=None) -> Block:
+        ongoing = self.picker.ongoing(self, self.ongoing_pieces)
+        if self.priority_pieces:
+            ongoing = sorted(ongoing,
+                             key=lambda p: p.index not in self.priority_pieces)
+        for piece in ongoing:
+            if pieces is not None and piece.index not in pieces:
+                continue
+            if not self.picker.allows(self, peer_id, piece):
+                continue
             if self.peers[peer_id][piece.index]:
+                if peer_id in piece.excluded and \
+                        self._others_have(piece, peer_id):
+                    # Let someone else supply the blocks of a piece this
+                    # peer may have corrupted
+                    continue
                 block = piece.next_request()
                 if block:
-                    self.pending_blocks.append(
-                        PendingRequest(block, int(round(time.time() * 1000))))
                     return block
         return None
 
-    def _get_rarest_piece(self, peer_id):
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
-                continue
-            for p in self.peers:
-                if self.peers[p][piece.index]:
-                    piece_count[piece] += 1
+    def _pick_piece(self, peer_id, pieces=None):
+        if self.availability is not None and pieces is None and \
+                not self.priority_pieces and self.piece_priorities is None \
+                and self.picker.pick_vectorized:
+            index = self.picker.pick_vectorized(self, peer_id, self._wanted)
+            return self._start(self._pieces[index]) \
+                if index is not None else None
+
+        bitfield = self.peers[peer_id]
+        candidates = [p for p in self.missing_pieces if bitfield[p.index] and
+                      (pieces is None or p.index in pieces)]
+        if not candidates:
+            # The peer has nothing we're still missing
+            return None
+        wanted = [p for p in candidates if p.index in self.priority_pieces] \
+            if self.priority_pieces else None
+        if wanted:
+            piece = wanted[0]
+        else:
+            if self.piece_priorities:
+                top = max(self.piece_priorities[p.index] for p in candidates)
+                candidates = [p for p in candidates
+                              if self.piece_priorities[p.index] == top]
+            piece = self.picker.pick(self, peer_id, candidates)
+        return self._start(piece) if piece else None
 
-        rarest_piece = min(piece_count, key=lambda p: piece_count[p])
-        self.missing_pieces.remove(rarest_piece)
-        self.ongoing_pieces.append(rarest_piece)
-        return rarest_piece
+    def _start(self, piece: Piece) -> Piece:
+        self.missing_pieces.remove(piece)
+        self.ongoing_pieces.append(piece)
+        piece.started = time.monotonic()
+        if self._wanted is not None:
+            self._wanted[piece.index] = False
+        return piece
 
     def _next_missing(self, peer_id) -> Block:
         for index, piece in enumerate(self.missing_pieces):
             if self.peers[peer_id][piece.index]:
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
-                return piece.next_request()
+                return self._start(piece).next_request()
         return None
 
     def _write(self, piece):
-        pos = piece.index * self.torrent.piece_length
-        os.lseek(self.fd, pos, os.SEEK_SET)
-        os.write(self.fd, piece.data)
+        # Data of skipped files in pieces at a file boundary is dropped
+        offset = piece.index * self.torrent.piece_length
+        self.storage.write(offset, piece.data, skip=self._skipped_files)
+        dropped = self._skipped_files & {
+            index for index, _, _ in self.storage.spans(offset, piece.length)}
+        if dropped:
+            self._dropped[piece.index] = dropped
 
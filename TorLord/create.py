@@ -0,0 +1,209 @@
+import mmap
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+from TorLord import bencoding
+
+# The piece length of a new torrent is a power of two within these bounds
+MIN_PIECE_LENGTH = 2 ** 15
+MAX_PIECE_LENGTH = 2 ** 24
+
+# The piece length is chosen to keep the number of pieces below this, the
+# metainfo stays small while a piece is still quick to fetch and verify
+TARGET_PIECES = 1500
+
+# The bytes hashed by a worker process at a time
+HASH_TASK_SIZE = 64 * 1024 * 1024
+
+# Content smaller than this is hashed without worker processes, starting
+# them takes longer than the hashing
+MIN_PARALLEL_SIZE = 256 * 1024 * 1024
+
+# Written to the metainfo as the program that created it
+CREATED_BY = 'TorLord'
+
+# The files being hashed, set once in each worker process
+_files = None
+
+
+def piece_length_for(size: int) -> int:
+    """
+    The piece length for a torrent of `size` bytes.
+    """
+    length = MIN_PIECE_LENGTH
+    while length < MAX_PIECE_LENGTH and size > length * TARGET_PIECES:
+        length *= 2
+    return length
+
+
+def create_torrent(path: str, announce: str, piece_length: int = None,
+                   url_list: [str] = None, comment: str = None,
+                   private: bool = False, workers: int = None,
+                   now: float = None) -> OrderedDict:
+    """
+    Build the metainfo for sharing the file or directory at `path`.
+
+    The pieces are hashed by a pool of worker processes, each reading its
+    share of the content through mmap, so the hashing runs on every core
+    instead of one.
+
+    :param path: The file or directory to share
+    :param announce: The announce URL of the tracker
+    :param piece_length: The piece length, chosen from the size of the
+                         content when not given
+    :param url_list: The URLs of web seeds holding the content (BEP 19)
+    :param comment: A free form comment
+    :param private: Mark the torrent private, peers are only to be found
+                    through the tracker
+    :param workers: The number of processes hashing the pieces, one per CPU
+                    by default
+    :param now: The creation date, the current time by default
+    :return: The metainfo dict, to be bencoded with `save_torrent`
+    """
+    path = os.path.abspath(path)
+    files = _walk(path)
+    total = sum(length for _, _, length in files)
+    if total == 0:
+        raise ValueError('Nothing to share in {path}'.format(path=path))
+    if piece_length is None:
+        piece_length = piece_length_for(total)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if total < MIN_PARALLEL_SIZE:
+        workers = 1
+    pieces = hash_pieces([(name, length) for name, _, length in files],
+                         piece_length, workers)
+
+    info = OrderedDict()
+    if os.path.isdir(path):
+        info[b'files'] = [
+            OrderedDict([(b'length', length),
+                         (b'path', [part.encode('utf-8') for part in parts])])
+            for _, parts, length in files]
+    else:
+        info[b'length'] = total
+    info[b'name'] = os.path.basename(path).encode('utf-8')
+    info[b'piece length'] = piece_length
+    info[b'pieces'] = pieces
+    if private:
+        info[b'private'] = 1
+
+    # The keys are kept sorted, as bencoded dicts need to be
+    meta_info = OrderedDict([(b'announce', announce.encode('utf-8'))])
+    if comment:
+        meta_info[b'comment'] = comment.encode('utf-8')
+    meta_info[b'created by'] = CREATED_BY.encode('utf-8')
+    meta_info[b'creation date'] = int(time.time() if now is None else now)
+    meta_info[b'info'] = info
+    if url_list:
+        meta_info[b'url-list'] = [url.encode('utf-8') for url in url_list]
+    return meta_info
+
+
+def save_torrent(meta_info: OrderedDict, filename: str):
+    """
+    Write the metainfo to a .torrent file.
+    """
+    with open(filename, 'wb') as f:
+        f.write(bencoding.Encoder(meta_info).encode())
+
+
+def hash_pieces(files: [tuple], piece_length: int, workers: int = 1,
+                task_size: int = HASH_TASK_SIZE) -> bytes:
+    """
+    The SHA1 hashes of the pieces of the files' concatenated data.
+
+    :param files: The (path, length) of each file, in the torrent's order
+    :param piece_length: The piece length
+    :param workers: The number of processes to hash with, the pieces are
+                    hashed in this process when 1
+    :param task_size: The bytes hashed by a worker process at a time
+    :return: The 20 byte hashes of every piece, concatenated
+    """
+    total = sum(length for _, length in files)
+    count = (total + piece_length - 1) // piece_length
+    if workers <= 1:
+        return _hash_range(files, piece_length, 0, count)
+
+    # Tasks are piece aligned, and come back in order to be joined
+    step = max(1, task_size // piece_length)
+    tasks = [(first, min(first + step, count))
+             for first in range(0, count, step)]
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(workers, len(tasks)), initializer=_init_worker,
+                      initargs=(files, piece_length)) as pool:
+        return b''.join(pool.imap(_hash_task, tasks))
+
+
+def _init_worker(files: [tuple], piece_length: int):
+    global _files
+    _files = (files, piece_length)
+
+
+def _hash_task(task: tuple) -> bytes:
+    files, piece_length = _files
+    return _hash_range(files, piece_length, *task)
+
+
+def _hash_range(files: [tuple], piece_length: int, first: int,
+                last: int) -> bytes:
+    """
+    Hash the pieces `first` up to `last` (exclusive), reading the files
+    they cover through mmap rather than copying them into buffers.
+    """
+    start = first * piece_length
+    end = last * piece_length
+    hashes = []
+    digest = sha1()
+    filled = 0
+    offset = 0
+    for path, length in files:
+        if offset >= end:
+            break
+        if length == 0 or offset + length <= start:
+            offset += length
+            continue
+        position = max(start - offset, 0)
+        stop = min(end - offset, length)
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                while position < stop:
+                    size = min(piece_length - filled, stop - position)
+                    digest.update(view[position:position + size])
+                    filled += size
+                    position += size
+                    if filled == piece_length:
+                        hashes.append(digest.digest())
+                        digest = sha1()
+                        filled = 0
+            finally:
+                # The mmap can't be closed while a view of it is around
+                view.release()
+        offset += length
+    if filled:
+        # The last piece of the torrent is shorter
+        hashes.append(digest.digest())
+    return b''.join(hashes)
+
+
+def _walk(path: str) -> [tuple]:
+    """
+    The files to share at `path` as tuples of (path, path components
+    relative to `path`, length), in a stable order.
+    """
+    if not os.path.isdir(path):
+        return [(path, [os.path.basename(path)], os.path.getsize(path))]
+    files = []
+    for directory, _, names in os.walk(path):
+        for name in names:
+            full_path = os.path.join(directory, name)
+            if not os.path.isfile(full_path):
+                continue
+            parts = os.path.relpath(full_path, path).split(os.sep)
+            files.append((full_path, parts, os.path.getsize(full_path)))
+    return sorted(files, key=lambda f: f[1])
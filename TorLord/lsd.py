@@ -0,0 +1,163 @@
+import asyncio
+import binascii
+import logging
+import os
+import socket
+
+# The multicast group and port of Local Service Discovery (BEP 14)
+LSD_GROUP = '239.192.152.143'
+LSD_PORT = 6771
+
+# Seconds between announcing the torrents we're running
+LSD_INTERVAL = 5 * 60
+
+# The number of info hashes announced per message, keeping each message
+# within a single packet
+MAX_LSD_HASHES = 20
+
+
+class LocalServiceDiscovery(asyncio.DatagramProtocol):
+    """
+    Finds peers on the local network by announcing the torrents we're
+    running to a multicast group, and listening for the announces of other
+    hosts (BEP 14). No tracker is involved, so peers on the same subnet find
+    each other within seconds.
+    """
+    def __init__(self, port: int, on_peer, group: str = LSD_GROUP,
+                 lsd_port: int = LSD_PORT, interface: str = '0.0.0.0',
+                 interval: float = LSD_INTERVAL):
+        """
+        :param port: The port we're listening on for incoming peers
+        :param on_peer: Called with the info hash and (ip, port) of every
+                        peer discovered running a torrent we announce
+        :param group: The multicast group to announce to
+        :param lsd_port: The port of the multicast group
+        :param interface: The address of the local interface to announce and
+                          listen on, all interfaces by default
+        :param interval: Seconds between announces
+        """
+        self.port = port
+        self.on_peer = on_peer
+        self.group = group
+        self.lsd_port = lsd_port
+        self.interface = interface
+        self.interval = interval
+        # Tells our own announces, looped back to us, apart from others
+        self.cookie = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self.info_hashes = set()
+        self.transport = None
+        self._task = None
+
+    async def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Other clients on this host listen on the same port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.lsd_port))
+        interface = socket.inet_aton(self.interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        socket.inet_aton(self.group) + interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.setblocking(False)
+        self.transport, _ = \
+            await asyncio.get_event_loop().create_datagram_endpoint(
+                lambda: self, sock=sock)
+        self._task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    def add(self, info_hash: bytes):
+        """
+        Start announcing the torrent, the first time right away.
+        """
+        self.info_hashes.add(info_hash)
+        self.announce([info_hash])
+
+    def remove(self, info_hash: bytes):
+        self.info_hashes.discard(info_hash)
+
+    def announce(self, info_hashes=None):
+        if not self.transport:
+            return
+        info_hashes = sorted(self.info_hashes if info_hashes is None
+                             else info_hashes)
+        for i in range(0, len(info_hashes), MAX_LSD_HASHES):
+            message = encode_announce(self.group, self.lsd_port, self.port,
+                                      info_hashes[i:i + MAX_LSD_HASHES],
+                                      self.cookie)
+            self.transport.sendto(message, (self.group, self.lsd_port))
+
+    def datagram_received(self, data, address):
+        message = decode_announce(data)
+        if not message:
+            return
+        port, info_hashes, cookie = message
+        if cookie == self.cookie:
+            return
+        for info_hash in info_hashes:
+            if info_hash in self.info_hashes:
+                logging.info('Discovered local peer {ip}:{port}'.format(
+                    ip=address[0], port=port))
+                self.on_peer(info_hash, (address[0], port))
+
+    def error_received(self, exc):
+        logging.warning('Local service discovery failed: {error}'.format(
+            error=exc))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.announce()
+
+
+def encode_announce(group: str, lsd_port: int, port: int, info_hashes,
+                    cookie: str = None) -> bytes:
+    lines = ['BT-SEARCH * HTTP/1.1',
+             'Host: {group}:{port}'.format(group=group, port=lsd_port),
+             'Port: {port}'.format(port=port)]
+    lines.extend('Infohash: ' + info_hash.hex() for info_hash in info_hashes)
+    if cookie:
+        lines.append('cookie: ' + cookie)
+    return ('\r\n'.join(lines) + '\r\n\r\n\r\n').encode('ascii')
+
+
+def decode_announce(data: bytes):
+    """
+    :return: A tuple of (port, info hashes, cookie) or None if the data
+             isn't an announce
+    """
+    try:
+        lines = data.decode('ascii').split('\r\n')
+    except UnicodeDecodeError:
+        return None
+    if lines[0] != 'BT-SEARCH * HTTP/1.1':
+        return None
+    port = None
+    info_hashes = []
+    cookie = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == 'port':
+                port = int(value)
+            elif name == 'infohash' and len(value) == 40:
+                info_hashes.append(bytes.fromhex(value))
+            elif name == 'cookie':
+                cookie = value
+        except ValueError:
+            return None
+    if port is None or not 0 < port < 65536:
+        return None
+    return port, info_hashes, cookie
@@ -0,0 +1,246 @@
+import bisect
+import json
+import logging
+from collections import OrderedDict
+
+from aiohttp import web
+
+# Upper bounds (in seconds) of the histogram buckets used for latencies
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    """
+    A value that only ever goes up, such as a number of bytes.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """
+    Counts observed values, such as latencies, into buckets.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Family:
+    def __init__(self, type_: str, help_: str, factory):
+        self.type = type_
+        self.help = help_
+        self.factory = factory
+        self.series = OrderedDict()  # tuple of label pairs -> metric
+
+
+class MetricsRegistry:
+    """
+    Holds every metric by name and set of labels, e.g. the bytes received
+    from a given peer of a given torrent.
+    """
+    def __init__(self):
+        self._families = OrderedDict()
+
+    def counter(self, name: str, help_: str, **labels) -> Counter:
+        return self._get(name, 'counter', help_, Counter, labels)
+
+    def histogram(self, name: str, help_: str, buckets=DEFAULT_BUCKETS,
+                  **labels) -> Histogram:
+        return self._get(name, 'histogram', help_,
+                         lambda: Histogram(buckets), labels)
+
+    def remove(self, **labels):
+        """
+        Remove every series having all of the given labels, e.g. those of a
+        peer that disconnected.
+        """
+        wanted = set(labels.items())
+        for family in self._families.values():
+            for key in [k for k in family.series if wanted <= set(k)]:
+                del family.series[key]
+
+    def collect(self):
+        """
+        :return: A list of (name, type, help, [(labels, metric)]) tuples
+        """
+        return [(name, family.type, family.help,
+                 [(OrderedDict(key), metric)
+                  for key, metric in family.series.items()])
+                for name, family in self._families.items()]
+
+    def _get(self, name, type_, help_, factory, labels):
+        family = self._families.get(name)
+        if family is None:
+            family = _Family(type_, help_, factory)
+            self._families[name] = family
+        elif family.type != type_:
+            raise ValueError('Metric {name} is a {type}'.format(
+                name=name, type=family.type))
+        key = tuple(sorted(labels.items()))
+        metric = family.series.get(key)
+        if metric is None:
+            metric = family.factory()
+            family.series[key] = metric
+        return metric
+
+
+# The registry used unless another one is given
+default_registry = MetricsRegistry()
+
+
+class TorrentMetrics:
+    """
+    The metrics kept for a single torrent and each of its peers.
+    """
+    def __init__(self, info_hash: bytes, registry: MetricsRegistry = None):
+        self.registry = registry if registry else default_registry
+        self.torrent = info_hash.hex()
+        r, t = self.registry, self.torrent
+        self.bytes_in = r.counter(
+            'torlord_torrent_received_bytes_total',
+            'Bytes received from all peers', torrent=t)
+        self.bytes_out = r.counter(
+            'torlord_torrent_sent_bytes_total',
+            'Bytes sent to all peers', torrent=t)
+        self.wasted_bytes = r.counter(
+            'torlord_wasted_bytes_total',
+            'Bytes of pieces discarded since they failed the hash check',
+            torrent=t)
+        self.duplicate_bytes = r.counter(
+            'torlord_duplicate_bytes_total',
+            'Bytes of blocks received that we already had', torrent=t)
+        self.hash_failures = r.counter(
+            'torlord_hash_failures_total',
+            'Pieces failing the hash check', torrent=t)
+        self.request_rtt = r.histogram(
+            'torlord_request_rtt_seconds',
+            'Time from requesting a block until it is received', torrent=t)
+        self.hash_time = r.histogram(
+            'torlord_hash_seconds',
+            'Time spent checking the hash of a complete piece', torrent=t)
+        self.write_time = r.histogram(
+            'torlord_write_seconds',
+            'Time spent writing a verified piece to disk', torrent=t)
+        self.piece_latency = r.histogram(
+            'torlord_piece_download_seconds',
+            'Time from starting a piece until it is verified', torrent=t)
+
+    def peer(self, address: str):
+        """
+        :return: The (bytes in, bytes out) counters for the given peer
+        """
+        return (self.registry.counter('torlord_peer_received_bytes_total',
+                                      'Bytes received from a peer',
+                                      torrent=self.torrent, peer=address),
+                self.registry.counter('torlord_peer_sent_bytes_total',
+                                      'Bytes sent to a peer',
+                                      torrent=self.torrent, peer=address))
+
+    def remove_peer(self, address: str):
+        self.registry.remove(torrent=self.torrent, peer=address)
+
+    def close(self):
+        self.registry.remove(torrent=self.torrent)
+
+
+class Exporter:
+    """
+    Renders the metrics of a registry in some format. Subclasses implement
+    `render`, `start` serves the rendered metrics over HTTP on `path`.
+    """
+    content_type = 'text/plain'
+    path = '/metrics'
+
+    def __init__(self, registry: MetricsRegistry = None):
+        self.registry = registry if registry else default_registry
+        self.runner = None
+
+    def render(self) -> str:
+        raise NotImplementedError()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 9100):
+        app = web.Application()
+        app.router.add_get(self.path, self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info('Serving metrics at http://{host}:{port}{path}'.format(
+            host=host, port=port, path=self.path))
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request):
+        return web.Response(body=self.render().encode('utf-8'),
+                            headers={'Content-Type': self.content_type})
+
+
+class PrometheusExporter(Exporter):
+    """
+    Renders the metrics in the Prometheus text exposition format.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def render(self) -> str:
+        lines = []
+        for name, type_, help_, series in self.registry.collect():
+            lines.append('# HELP {name} {help}'.format(name=name, help=help_))
+            lines.append('# TYPE {name} {type}'.format(name=name, type=type_))
+            for labels, metric in series:
+                if type_ == 'counter':
+                    lines.append(_sample(name, labels, metric.value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',),
+                                        metric.counts):
+                    cumulative += count
+                    lines.append(_sample(
+                        name + '_bucket',
+                        OrderedDict([('le', str(bound))] +
+                                    list(labels.items())),
+                        cumulative))
+                lines.append(_sample(name + '_sum', labels, metric.sum))
+                lines.append(_sample(name + '_count', labels, metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+class JsonExporter(Exporter):
+    """
+    Renders the metrics as JSON, for tools not speaking Prometheus.
+    """
+    content_type = 'application/json'
+
+    def render(self) -> str:
+        result = OrderedDict()
+        for name, type_, _, series in self.registry.collect():
+            result[name] = [
+                dict(labels=labels, value=metric.value)
+                if type_ == 'counter' else
+                dict(labels=labels, sum=metric.sum, count=metric.count,
+                     buckets=list(zip(metric.buckets + ('+Inf',),
+                                      metric.counts)))
+                for labels, metric in series]
+        return json.dumps(result)
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\')
+                               .replace('"', '\\"'))
+            for k, v in labels.items()) + '}'
+    return '{name} {value}'.format(name=name, value=value)
@@ -0,0 +1,135 @@
+import logging
+import os
+import socket
+import struct
+import time
+
+# The peers kept per torrent, the fastest ones win
+MAX_CACHED_PEERS = 50
+
+# Peers not seen for this many seconds (a week) are forgotten
+MAX_PEER_AGE = 7 * 24 * 60 * 60
+
+# A cached peer: IPv4 address, port, download rate (bytes per second) and
+# when it was last seen (seconds since the epoch), like the compact peers of
+# a tracker response with the rate and time appended
+_RECORD = struct.Struct('>4sHII')
+
+
+def default_directory() -> str:
+    """
+    Where peers are cached unless told otherwise, following the XDG base
+    directory specification.
+    """
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'torlord', 'peers')
+
+
+class CachedPeer:
+    __slots__ = ('address', 'rate', 'last_seen')
+
+    def __init__(self, address: tuple, rate: int, last_seen: int):
+        self.address = address
+        self.rate = rate
+        self.last_seen = last_seen
+
+
+class PeerCache:
+    """
+    Remembers the peers that sent us data in earlier sessions, one file per
+    torrent named after its info hash. A restarted torrent dials them right
+    away instead of waiting for the tracker to hand out peers, or for the
+    tracker to come back when it is down.
+    """
+    def __init__(self, directory: str = None,
+                 max_peers: int = MAX_CACHED_PEERS,
+                 max_age: int = MAX_PEER_AGE):
+        """
+        :param directory: The directory to keep the cache files in, see
+                          `default_directory`
+        :param max_peers: The number of peers kept per torrent
+        :param max_age: The seconds after which a peer not seen is forgotten
+        """
+        self.directory = directory if directory else default_directory()
+        self.max_peers = max_peers
+        self.max_age = max_age
+        self._peers = {}  # info_hash -> {address: CachedPeer}
+
+    def peers(self, info_hash: bytes, now: float = None) -> [tuple]:
+        """
+        The (ip, port) of the cached peers of the torrent, fastest first.
+        """
+        return [p.address for p in self._best(info_hash, now)]
+
+    def record(self, info_hash: bytes, address: tuple, rate: float,
+               now: float = None):
+        """
+        Remember the peer at `address` sent us data at `rate` bytes per
+        second.
+        """
+        try:
+            socket.inet_aton(address[0])
+        except OSError:
+            # Only IPv4 peers fit the compact format
+            return
+        now = int(now if now is not None else time.time())
+        self._load(info_hash)[address] = CachedPeer(address, int(rate), now)
+
+    def forget(self, info_hash: bytes, address: tuple):
+        """
+        Drop a peer, e.g. since we could no longer connect to it.
+        """
+        self._load(info_hash).pop(address, None)
+
+    def save(self, info_hash: bytes, now: float = None):
+        peers = self._best(info_hash, now)
+        data = bytearray(_RECORD.size * len(peers))
+        offset = 0
+        for peer in peers:
+            ip, port = peer.address
+            _RECORD.pack_into(data, offset, socket.inet_aton(ip), port,
+                              min(peer.rate, 0xffffffff), peer.last_seen)
+            offset += _RECORD.size
+        path = self._path(info_hash)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written aside and moved over the old file, so a crash never
+            # leaves a truncated cache behind
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            logging.warning('Unable to save the peer cache to {path}'.format(
+                path=path))
+
+    def _best(self, info_hash: bytes, now: float = None) -> [CachedPeer]:
+        now = now if now is not None else time.time()
+        peers = [p for p in self._load(info_hash).values()
+                 if now - p.last_seen <= self.max_age]
+        peers.sort(key=lambda p: (p.rate, p.last_seen), reverse=True)
+        return peers[:self.max_peers]
+
+    def _load(self, info_hash: bytes) -> dict:
+        peers = self._peers.get(info_hash)
+        if peers is not None:
+            return peers
+        peers = self._peers[info_hash] = {}
+        try:
+            with open(self._path(info_hash), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return peers
+        except OSError:
+            logging.warning('Unable to read the peer cache of {hash}'.format(
+                hash=info_hash.hex()))
+            return peers
+        for offset in range(0, len(data) - len(data) % _RECORD.size,
+                            _RECORD.size):
+            ip, port, rate, last_seen = _RECORD.unpack_from(data, offset)
+            address = (socket.inet_ntoa(ip), port)
+            peers[address] = CachedPeer(address, rate, last_seen)
+        return peers
+
+    def _path(self, info_hash: bytes) -> str:
+        return os.path.join(self.directory, info_hash.hex())
@@ -0,0 +1,122 @@
+import logging
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+from TorLord import bencoding
+
+# The id we ask peers to use for the ut_pex messages sent to us
+UT_PEX_ID = 1
+
+# Peers are sent the changes to the swarm at most once a minute, with at
+# most this many peers added and dropped per message (BEP 11)
+PEX_INTERVAL = 60
+MAX_PEX_PEERS = 50
+
+
+def encode_peers(peers: [tuple]) -> bytes:
+    """
+    Encode (ip, port) tuples in the compact format used by trackers.
+    """
+    return b''.join([socket.inet_aton(ip) + struct.pack('>H', port)
+                     for ip, port in peers])
+
+
+def is_ipv4(ip: str) -> bool:
+    try:
+        socket.inet_pton(socket.AF_INET, ip)
+    except OSError:
+        return False
+    return True
+
+
+def decode_peers(data: bytes) -> [tuple]:
+    return [(socket.inet_ntoa(data[i:i + 4]),
+             struct.unpack('>H', data[i + 4:i + 6])[0])
+            for i in range(0, len(data) - len(data) % 6, 6)]
+
+
+class PeerExchange:
+    """
+    Peer Exchange (ut_pex) over the extension protocol for a single
+    torrent: tells the connected peers about the other peers we're connected
+    to, and hands the peers they tell us about to `on_peers`.
+    """
+    def __init__(self, port: int, on_peers):
+        """
+        :param port: The port we're listening on for incoming peers
+        :param on_peers: Called with a list of (ip, port) tuples of peers
+                         learned about
+        """
+        self.port = port
+        self.on_peers = on_peers
+        self._sent = {}  # PeerConnection -> addresses it was told about
+        self._last_sent = {}  # PeerConnection -> when it was last sent to
+        self._last_received = {}  # PeerConnection -> when it last sent to us
+
+    def handshake(self) -> bytes:
+        """
+        The payload of our extended handshake.
+        """
+        return bytes(bencoding.Encoder(OrderedDict([
+            (b'm', OrderedDict([(b'ut_pex', UT_PEX_ID)])),
+            (b'p', self.port),
+            (b'v', b'TorLord')])).encode())
+
+    def update(self, peers: list, now: float = None):
+        """
+        Send every connected peer supporting ut_pex the peers connected or
+        dropped since it was last told, unless that was less than
+        `PEX_INTERVAL` seconds ago.
+
+        :param peers: Every `PeerConnection` of the torrent
+        """
+        now = time.monotonic() if now is None else now
+        # Only IPv4 peers fit the compact format of `added`
+        connected = {p.listen_address for p in peers
+                     if p.connected and p.listen_address and
+                     is_ipv4(p.listen_address[0])}
+        for peer in peers:
+            if not peer.connected or 'ut_pex' not in peer.extensions:
+                continue
+            if now - self._last_sent.get(peer, -PEX_INTERVAL) < PEX_INTERVAL:
+                continue
+            sent = self._sent.get(peer, set())
+            current = connected - {peer.listen_address}
+            added = sorted(current - sent)[:MAX_PEX_PEERS]
+            dropped = sorted(sent - current)[:MAX_PEX_PEERS]
+            if not added and not dropped:
+                continue
+            peer.send_extended(peer.extensions['ut_pex'], bytes(
+                bencoding.Encoder(OrderedDict([
+                    (b'added', encode_peers(added)),
+                    (b'added.f', bytes(len(added))),
+                    (b'dropped', encode_peers(dropped))])).encode()))
+            self._sent[peer] = (sent - set(dropped)) | set(added)
+            self._last_sent[peer] = now
+
+        # Forget about the peers that are gone
+        for state in (self._sent, self._last_sent, self._last_received):
+            for gone in [p for p in state if p not in peers]:
+                del state[gone]
+
+    def received(self, peer, payload: bytes, now: float = None):
+        """
+        Handle a ut_pex message from the given peer.
+        """
+        now = time.monotonic() if now is None else now
+        if now - self._last_received.get(peer, -PEX_INTERVAL) < \
+                PEX_INTERVAL / 2:
+            # Peers flooding us are ignored, they're to send once a minute
+            return
+        self._last_received[peer] = now
+        try:
+            message = bencoding.Decoder(payload).decode()
+            added = decode_peers(message.get(b'added', b''))
+        except (RuntimeError, EOFError, IndexError, TypeError,
+                AttributeError, OSError):
+            logging.info('Ignoring malformed ut_pex message')
+            return
+        if added:
+            self.on_peers(added[:MAX_PEX_PEERS])
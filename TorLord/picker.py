@@ -0,0 +1,129 @@
+import time
+from collections import defaultdict
+
+
+class RarestFirst:
+    """
+    Start the piece held by the fewest peers, which keeps the pieces spread
+    across the swarm. The default strategy of `PieceManager`.
+    """
+    def pick(self, manager, peer_id, candidates: list):
+        """
+        :param manager: The `PieceManager` picking
+        :param peer_id: The peer the piece is picked for
+        :param candidates: The missing pieces the peer has, in index order
+        :return: The piece to start, or None
+        """
+        if manager.availability is not None:
+            counts = manager.availability.counts
+            return min(candidates, key=lambda p: counts[p.index]) \
+                if candidates else None
+        piece_count = defaultdict(int)
+        for piece in candidates:
+            for bitfield in manager.peers.values():
+                if bitfield[piece.index]:
+                    piece_count[piece] += 1
+        if not piece_count:
+            return None
+        return min(piece_count, key=lambda p: piece_count[p])
+
+    def pick_vectorized(self, manager, peer_id, wanted):
+        """
+        Like `pick`, over the pieces set in the `wanted` mask by means of the
+        manager's `Availability`. Strategies not supporting this set it to
+        None.
+
+        :return: The index of the piece to start, or None
+        """
+        return manager.availability.rarest(peer_id, wanted)
+
+    def allows(self, manager, peer_id, piece) -> bool:
+        """
+        Whether blocks of the given piece, already started, may be requested
+        from the peer.
+        """
+        return True
+
+    def ongoing(self, manager, pieces: list) -> list:
+        """
+        The order to request the blocks of the pieces already started in.
+        """
+        return pieces
+
+
+class Sequential(RarestFirst):
+    """
+    Start the missing piece with the lowest index, so the data can be
+    consumed from the start while downloading.
+    """
+    def pick(self, manager, peer_id, candidates: list):
+        return candidates[0] if candidates else None
+
+    def pick_vectorized(self, manager, peer_id, wanted):
+        return manager.availability.first(peer_id, wanted)
+
+
+class Deadline(RarestFirst):
+    """
+    For streaming: each piece after the playback cursor is due at the time
+    playback reaches it. Pieces are started in the order they are due, and
+    blocks of pieces due within `urgent` seconds are only requested from the
+    fastest half of the peers (by round trip time), so a slow peer doesn't
+    hold up playback.
+    """
+    pick_vectorized = None
+
+    def __init__(self, rate: float, cursor: int = 0, urgent: float = 5):
+        """
+        :param rate: The playback rate in bytes per second
+        :param cursor: The offset (in bytes) playback is at
+        :param urgent: Pieces due within this many seconds are urgent
+        """
+        self.rate = rate
+        self.urgent = urgent
+        self.cursor = cursor
+        self.started = time.monotonic()
+
+    def seek(self, cursor: int):
+        """
+        Move the playback cursor, e.g. when the user skips ahead.
+        """
+        self.cursor = cursor
+        self.started = time.monotonic()
+
+    def deadline(self, manager, index: int) -> float:
+        """
+        The time (as `time.monotonic`) the piece is due, pieces before the
+        cursor are never due.
+        """
+        offset = index * manager.torrent.piece_length - self.cursor
+        if offset + manager.torrent.piece_length <= 0:
+            return float('inf')
+        return self.started + max(0, offset) / self.rate
+
+    def pick(self, manager, peer_id, candidates: list):
+        if not self._is_fast(manager, peer_id):
+            now = time.monotonic()
+            candidates = [p for p in candidates
+                          if self.deadline(manager, p.index) - now >
+                          self.urgent]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda p: (
+            self.deadline(manager, p.index), p.index))
+
+    def ongoing(self, manager, pieces: list) -> list:
+        return sorted(pieces, key=lambda p: (self.deadline(manager, p.index),
+                                             p.index))
+
+    def allows(self, manager, peer_id, piece) -> bool:
+        if self.deadline(manager, piece.index) - time.monotonic() > \
+                self.urgent:
+            return True
+        return self._is_fast(manager, peer_id)
+
+    def _is_fast(self, manager, peer_id) -> bool:
+        rtts = sorted(manager.peer_rtt(p) for p in manager.peers)
+        if len(rtts) < 2:
+            return True
+        return manager.peer_rtt(peer_id) <= rtts[(len(rtts) - 1) // 2]
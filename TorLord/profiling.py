@@ -0,0 +1,155 @@
+import asyncio
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from TorLord.metrics import default_registry
+
+# How often the event loop lag is sampled, in seconds
+LAG_INTERVAL = 0.1
+
+# Lag above this many seconds is logged as a warning
+LAG_WARNING = 0.5
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop is in running a callback scheduled at a
+    fixed interval. A lag of more than a few milliseconds means something is
+    blocking the loop, such as hashing or writing a piece.
+    """
+    def __init__(self, interval: float = LAG_INTERVAL, registry=None):
+        self.interval = interval
+        self.lag = (registry if registry else default_registry).histogram(
+            'torlord_loop_lag_seconds', 'How late the event loop runs a timer')
+        self.max_lag = 0
+        self.task = None
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0, loop.time() - expected)
+            self.lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > LAG_WARNING:
+                logging.warning('Event loop blocked for {lag:.3f}s'.format(
+                    lag=lag))
+
+
+class _NullSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class _Span:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+_null_span = _NullSpan()
+_spans = None  # stage -> histogram, None while disabled
+
+
+def enable_spans(registry=None):
+    """
+    Start timing the parse, pick, hash and write stages into the
+    `torlord_stage_seconds` histogram.
+    """
+    global _spans
+    registry = registry if registry else default_registry
+    _spans = {stage: registry.histogram('torlord_stage_seconds',
+                                        'Time spent in a hot path stage',
+                                        stage=stage)
+              for stage in ('parse', 'pick', 'hash', 'write')}
+
+
+def disable_spans():
+    global _spans
+    _spans = None
+
+
+def span(stage: str):
+    """
+    A context manager timing the given stage. While disabled the same no-op
+    instance is returned every time, so nothing is allocated or measured.
+    """
+    if _spans is None:
+        return _null_span
+    return _Span(_spans[stage])
+
+
+class Profiler:
+    """
+    Profiles the whole process until stopped and writes the result to
+    `path`: a cProfile dump when the path ends with .prof, otherwise stacks
+    sampled from the main thread in the collapsed format understood by
+    flamegraph.pl and speedscope.
+    """
+    def __init__(self, path: str, interval: float = 0.001):
+        self.path = path
+        self.interval = interval
+        self._profile = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._stacks = Counter()
+
+    def start(self):
+        if self.path.endswith('.prof'):
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._thread = threading.Thread(
+                target=self._sample, args=(threading.get_ident(),),
+                daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(self.path)
+        elif self._thread:
+            self._stopped.set()
+            self._thread.join()
+            with open(self.path, 'w') as f:
+                for stack, count in self._stacks.most_common():
+                    f.write('{stack} {count}\n'.format(stack=stack,
+                                                       count=count))
+        logging.info('Profile written to {path}'.format(path=self.path))
+
+    def _sample(self, thread_id):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{file}:{name}'.format(
+                    file=os.path.basename(code.co_filename),
+                    name=code.co_name))
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
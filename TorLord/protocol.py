@@ -1,16 +1,42 @@
 import asyncio
 import logging
 import struct
-from asyncio import Queue
-from concurrent.futures import CancelledError
+import time
+from asyncio import Queue, CancelledError
 
 import bitstring
 
+from TorLord import bencoding
+from TorLord.pex import UT_PEX_ID
+from TorLord.profiling import span
+from TorLord.tuning import SocketOptions
+
 # The default request size for blocks of pieces is 2^14 bytes.
 #       https://wiki.theory.org/BitTorrentSpecification
 #
 REQUEST_SIZE = 2 ** 14
 
+# The bit set in the reserved bytes of the handshake by peers supporting the
+# Fast Extension (BEP 6), as (byte, mask)
+FAST_EXTENSION = (7, 0x04)
+
+# The bit set by peers supporting the extension protocol (BEP 10)
+EXTENSION_PROTOCOL = (5, 0x10)
+
+# The number of blocks requested from a peer before waiting for any of them
+PIPELINE_DEPTH = 5
+
+# Small messages wait up to FLUSH_DELAY seconds to be sent along with others,
+# unless FLUSH_SIZE bytes are waiting. Senders are held back while more than
+# HIGH_WATER bytes wait to be sent to a peer reading slowly.
+FLUSH_DELAY = 0.01
+FLUSH_SIZE = 2 ** 14
+HIGH_WATER = 2 ** 16
+
+# A keep-alive is sent to peers nothing was sent to for this many seconds,
+# peers drop connections idle for two minutes
+KEEP_ALIVE_INTERVAL = 90
+
 
 class ProtocolError(BaseException):
     pass
@@ -18,7 +44,10 @@ class ProtocolError(BaseException):
 
 class PeerConnection:
     def __init__(self, queue: Queue, info_hash,
-                 peer_id, piece_manager, on_block_cb=None):
+                 peer_id, piece_manager, on_block_cb=None, inbound=None,
+                 download_limiter=None, upload_limiter=None,
+                 socket_options=None, metrics=None, pex=None,
+                 on_close=None):
         """
         :param queue: The async Queue containing available peers
         :param info_hash: The SHA1 hash for the meta-data's info
@@ -27,6 +56,20 @@ class PeerConnection:
                               to request
         :param on_block_cb: The callback function to call when a block is
                             received from the remote peer
+        :param inbound: An already accepted connection given as a tuple of
+                        (reader, writer, handshake). When set, this connection
+                        serves that single peer instead of taking peers from
+                        the queue
+        :param download_limiter: The `TokenBucket` throttling data received
+                                 from the remote peer
+        :param upload_limiter: The `TokenBucket` throttling data sent to the
+                               remote peer
+        :param socket_options: The `SocketOptions` used when connecting
+        :param metrics: The `TorrentMetrics` to count the bytes transferred in
+        :param pex: The `PeerExchange` of the torrent, None to disable the
+                    extension protocol
+        :param on_close: Called with this connection whenever a connection to
+                         a peer is closed, or could not be opened
         """
         self.my_state = []
         self.peer_state = []
@@ -38,88 +81,212 @@ class PeerConnection:
         self.reader = None
         self.piece_manager = piece_manager
         self.on_block_cb = on_block_cb
+        self.inbound = inbound
+        self.connected = False
+        self.download_limiter = download_limiter
+        self.upload_limiter = upload_limiter
+        self.socket_options = socket_options if socket_options \
+            else SocketOptions()
+        self.metrics = metrics
+        self.on_close = on_close
+        self.address = None
+        # When the handshake with the current peer completed and the number
+        # of block bytes it sent us since
+        self.connected_at = None
+        self.downloaded = 0
+        self.outbound = None
+        self._bytes_in = None
+        self._bytes_out = None
+        # Requests and cancels are packed into this buffer, reused for the
+        # lifetime of the connection
+        self._buffer = bytearray(Request.size * PIPELINE_DEPTH)
+        # The number of blocks requested and not yet received, when we
+        # started waiting for the next of them, and when we stopped
+        # requesting blocks since the peer wasn't sending them
+        self.requests = 0
+        self.waiting_since = None
+        self.snubbed_at = None
+        # Whether both sides support the Fast Extension and the extension
+        # protocol, the pieces we may request while choked and the pieces the
+        # peer suggests
+        self.fast = False
+        self.extended = False
+        self.allowed_fast = set()
+        self.suggested = set()
+        # The extension protocol: the peer's message ids by extension name
+        # and the address it accepts connections on
+        self.pex = pex
+        self.extensions = {}
+        self.listen_address = None
+        # What to do with each type of message received, a handler may
+        # return a coroutine to await before the next message
+        self._handlers = {
+            BitField: self._on_bitfield,
+            Interested: self._on_interested,
+            NotInterested: self._on_not_interested,
+            HaveAll: self._on_have_all,
+            HaveNone: self._on_have_none,
+            Choke: self._on_choke,
+            Unchoke: self._on_unchoke,
+            Have: self._on_have,
+            Piece: self._on_piece,
+            Request: self._on_request,
+            Cancel: self._on_cancel,
+            RejectRequest: self._on_reject_request,
+            AllowedFast: self._on_allowed_fast,
+            SuggestPiece: self._on_suggest_piece,
+            Extended: self._on_extended,
+        }
         self.future = asyncio.ensure_future(self._start())  # Start this worker-->worker is basically like a client
 
     async def _start(self):
         while 'stopped' not in self.my_state:
-            ip, port = await self.queue.get()
-            logging.info('Got assigned peer with: {ip}'.format(ip=ip))
+            self._reset()
+            if self.inbound:
+                self.reader, self.writer, _ = self.inbound
+                ip, port = self.writer.get_extra_info('peername')[:2]
+                logging.info('Accepted peer with: {ip}'.format(ip=ip))
+            else:
+                ip, port = await self.queue.get()
+                logging.info('Got assigned peer with: {ip}'.format(ip=ip))
+                self.listen_address = (ip, port)
+            self.address = '{ip}:{port}'.format(ip=ip, port=port)
+            self.connected_at = None
+            self.downloaded = 0
+            if self.metrics:
+                self._bytes_in, self._bytes_out = \
+                    self.metrics.peer(self.address)
 
             try:
-                self.reader, self.writer = await asyncio.open_connection(
-                    ip, port)
-                logging.info('Connection open to peer: {ip}'.format(ip=ip))
+                if not self.inbound:
+                    self.reader, self.writer = \
+                        await self.socket_options.open_connection(ip, port)
+                    logging.info('Connection open to peer: {ip}'.format(ip=ip))
                 buffer = await self._handshake
+                self.outbound = MessageQueue(self.writer)
+                self.connected = True
+                self.connected_at = time.monotonic()
                 # The default state for a connection is that peer is not
                 # interested and we are choked
                 self.my_state.append('choked')
 
-                # Let the peer know we're interested in downloading pieces
-                await self._send_interested()
-                self.my_state.append('interested')
+                if self.fast:
+                    # Peers supporting the Fast Extension must be told which
+                    # pieces we have right after the handshake, before any
+                    # other message
+                    await self._send(self._have_message(), flush=False)
+                if self.pex and self.extended:
+                    await self._send(Extended(0, self.pex.handshake())
+                                     .encode(), flush=False)
+                # Whether we're interested is told once we know the pieces
+                # the peer has
+                self.outbound.flush()
 
                 # Start reading responses as a stream of messages for as
                 # long as the connection is open and data is transmitted
-                async for message in PeerStreamIterator(self.reader, buffer):
+                async for message in PeerStreamIterator(
+                        self.reader, buffer, self.download_limiter,
+                        self.socket_options.read_size,
+                        self._on_read if self.metrics else None):
                     if 'stopped' in self.my_state:
                         break
-                    if type(message) is BitField:
-                        self.piece_manager.add_peer(self.remote_id,
-                                                    message.bitfield)
-                    elif type(message) is Interested:
-                        self.peer_state.append('interested')
-                    elif type(message) is NotInterested:
-                        if 'interested' in self.peer_state:
-                            self.peer_state.remove('interested')
-                    elif type(message) is Choke:
-                        self.my_state.append('choked')
-                    elif type(message) is Unchoke:
-                        if 'choked' in self.my_state:
-                            self.my_state.remove('choked')
-                    elif type(message) is Have:
-                        self.piece_manager.update_peer(self.remote_id,
-                                                       message.index)
-                    elif type(message) is KeepAlive:
-                        pass
-                    elif type(message) is Piece:
-                        self.my_state.remove('pending_request')
-                        self.on_block_cb(
-                            peer_id=self.remote_id,
-                            piece_index=message.index,
-                            block_offset=message.begin,
-                            data=message.block)
-                    elif type(message) is Request:
-                        logging.info('Ignoring the received Request message.')
-                    elif type(message) is Cancel:
-                        logging.info('Ignoring the received Cancel message.')
-
-                    # Send block request to remote peer if we're interested
-                    if 'choked' not in self.my_state:
-                        if 'interested' in self.my_state:
-                            if 'pending_request' not in self.my_state:
-                                self.my_state.append('pending_request')
-                                await self._request_piece()
+                    handler = self._handlers.get(type(message))
+                    if handler:
+                        pending = handler(message)
+                        if pending:
+                            await pending
+
+                    await self._request_next()
 
             except ProtocolError as e:
                 logging.exception('Protocol error')
-            except (ConnectionRefusedError, TimeoutError):
-                logging.warning('Unable to connect to peer')
             except (ConnectionResetError, CancelledError):
                 logging.warning('Connection closed')
-            except Exception as e:
+            except (OSError, TimeoutError):
+                logging.warning('Unable to connect to peer')
+            except Exception:
+                # Whatever went wrong with this peer, the worker goes on
+                # with the next one
                 logging.exception('An error occurred')
-                self.cancel()
-                raise e
             self.cancel()
+            if self.inbound:
+                break
+
+    def _reset(self):
+        # Nothing but being stopped carries over to the next peer
+        self.my_state = [s for s in self.my_state if s == 'stopped']
+        self.peer_state = []
+        self.remote_id = None
+        self.requests = 0
+        self.waiting_since = None
+        self.snubbed_at = None
+        self.fast = False
+        self.extended = False
+        self.allowed_fast = set()
+        self.suggested = set()
+        self.extensions = {}
+        self.outbound = None
 
     def cancel(self):
+        """
+        Close the connection to the current peer. The worker goes on with
+        the next peer from the queue, unless stopped.
+        """
         logging.info('Closing peer {id}'.format(id=self.remote_id))
-        if not self.future.done():
-            self.future.cancel()
+        if self.on_close and self.address:
+            self.on_close(self)
+        self.connected = False
+        if self.remote_id is not None:
+            # Another peer may be served by this worker next
+            self.piece_manager.release_requests(self.remote_id)
+            self.piece_manager.remove_peer(self.remote_id)
+        if self.outbound:
+            self.outbound.close()
         if self.writer:
             self.writer.close()
+        if self.metrics and self.address:
+            # Peers come and go, only the torrent totals are kept around
+            self.metrics.remove_peer(self.address)
+            self._bytes_in = self._bytes_out = None
 
-        self.queue.task_done()
+        # Inbound connections were never taken from the queue
+        if not self.inbound:
+            self.queue.task_done()
+
+    @property
+    def snubbed(self) -> bool:
+        return 'snubbed' in self.my_state
+
+    def is_snubbing(self, now: float, timeout: float) -> bool:
+        """
+        Whether we have been waiting for a block from this peer for more
+        than `timeout` seconds while not choked.
+        """
+        return 'pending_request' in self.my_state and \
+            'choked' not in self.my_state and not self.snubbed and \
+            now - self.waiting_since > timeout
+
+    def snub(self):
+        """
+        Stop requesting blocks from this peer since it doesn't send them.
+        The blocks requested are handed back to the piece manager, to be
+        requested from other peers, and cancelled with this peer.
+        """
+        logging.info('Peer {id} is snubbing us'.format(id=self.remote_id))
+        self.my_state.append('snubbed')
+        self.snubbed_at = time.monotonic()
+        self._clear_requests()
+        blocks = self.piece_manager.release_requests(self.remote_id)
+        if blocks:
+            asyncio.ensure_future(self._send_cancel(blocks))
+
+    def unsnub(self):
+        """
+        Give a snubbed peer another chance, as an optimistic unchoke would.
+        """
+        if self.snubbed:
+            self.my_state.remove('snubbed')
+            asyncio.ensure_future(self._request_next())
 
     def stop(self):
         # Set state to stopped and cancel our future to break out of the loop.
@@ -129,33 +296,309 @@ class PeerConnection:
         if not self.future.done():
             self.future.cancel()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
-            message = Request(block.piece, block.offset, block.length).encode()
+    def announce_have(self, index: int, suppress: bool = False):
+        """
+        Tell the peer we have the given piece, along with the other messages
+        sent within `FLUSH_DELAY`.
 
-            logging.debug('Requesting block {block} for piece {piece} '
-                          'of {length} bytes from peer {peer}'.format(
-                            piece=block.piece,
-                            block=block.offset,
-                            length=block.length,
-                            peer=self.remote_id))
+        :param suppress: Don't tell a peer that has the piece itself
+        """
+        if not self.connected:
+            return
+        if suppress:
+            bitfield = self.piece_manager.peers.get(self.remote_id)
+            if bitfield is not None and bitfield[index]:
+                return
+        self._queue(Have(index).encode())
+
+    def update_interest(self):
+        """
+        Tell the peer whether we're interested in it, when that changed since
+        the pieces it has or the pieces we want changed.
+        """
+        if not self.connected:
+            return
+        interested = self.piece_manager.interesting(self.remote_id)
+        if interested == ('interested' in self.my_state):
+            return
+        if interested:
+            self.my_state.append('interested')
+            message = Interested()
+        else:
+            # Lets the peer spend its unchoke slots on others
+            self.my_state.remove('interested')
+            message = NotInterested()
+        logging.debug('Sending message: %s', message)
+        self._queue(message.encode())
+        self.outbound.flush()
+
+    def keep_alive(self, now: float):
+        """
+        Send a keep-alive if nothing was sent to the peer for a while.
+        """
+        if self.connected and \
+                now - self.outbound.last_flush > KEEP_ALIVE_INTERVAL:
+            self._queue(KeepAlive().encode())
+
+    def _queue(self, data: bytes):
+        # For small control messages, queued right away so they're sent
+        # before anything sent after, and not subject to the rate limit
+        self.outbound.put(data)
+        if self._bytes_out:
+            self._bytes_out.inc(len(data))
+            self.metrics.bytes_out.inc(len(data))
+
+    async def _send(self, data: bytes, flush: bool = True):
+        """
+        Send a message, or with `flush` False queue it to be sent along with
+        the messages following within `FLUSH_DELAY`.
+        """
+        if self.upload_limiter:
+            await self.upload_limiter.consume(len(data))
+        self.outbound.put(data)
+        if flush:
+            self.outbound.flush()
+        if self._bytes_out:
+            self._bytes_out.inc(len(data))
+            self.metrics.bytes_out.inc(len(data))
+        await self.outbound.drain()
+
+    async def _request_next(self):
+        # Send block requests to remote peer if we're interested, up to
+        # PIPELINE_DEPTH at a time
+        if 'interested' not in self.my_state or \
+                self.requests >= PIPELINE_DEPTH or self.snubbed:
+            return
+        if 'choked' in self.my_state and not self.allowed_fast:
+            return
+        try:
+            await self._request_pieces()
+        except ConnectionError:
+            pass
+
+    def _request_done(self):
+        # A block requested was received or rejected
+        self.requests = max(0, self.requests - 1)
+        self.waiting_since = time.monotonic()
+        if not self.requests and 'pending_request' in self.my_state:
+            self.my_state.remove('pending_request')
+
+    def _clear_requests(self):
+        self.requests = 0
+        if 'pending_request' in self.my_state:
+            self.my_state.remove('pending_request')
+
+    async def _send_cancel(self, blocks):
+        # Every cancel is sent at once
+        await self._send_quietly(self._pack(
+            Cancel(block.piece, block.offset, block.length)
+            for block in blocks))
+
+    def send_extended(self, extended_id: int, payload: bytes):
+        """
+        Send an extension protocol message without waiting for it.
+        """
+        asyncio.ensure_future(self._send_quietly(
+            Extended(extended_id, payload).encode(), flush=False))
+
+    async def _send_quietly(self, data: bytes, flush: bool = True):
+        try:
+            await self._send(data, flush)
+        except ConnectionError:
+            pass
+
+    def _on_bitfield(self, message):
+        self.piece_manager.add_peer(self.remote_id, message.bitfield)
+        self.update_interest()
+
+    def _on_interested(self, message):
+        self.peer_state.append('interested')
+
+    def _on_not_interested(self, message):
+        if 'interested' in self.peer_state:
+            self.peer_state.remove('interested')
+
+    def _on_have_all(self, message):
+        self.piece_manager.add_peer(self.remote_id,
+                                    self._pieces_bitfield(True))
+        self.update_interest()
+
+    def _on_have_none(self, message):
+        self.piece_manager.add_peer(self.remote_id,
+                                    self._pieces_bitfield(False))
+        self.update_interest()
+
+    def _on_choke(self, message):
+        self.my_state.append('choked')
+        if not self.fast:
+            # Without the Fast Extension being choked means our requests are
+            # dropped. With it, each one is rejected explicitly.
+            self._release_requests()
+
+    def _on_unchoke(self, message):
+        if 'choked' in self.my_state:
+            self.my_state.remove('choked')
+
+    def _on_have(self, message):
+        self.piece_manager.update_peer(self.remote_id, message.index)
+        if 'interested' not in self.my_state:
+            self.update_interest()
+
+    def _on_piece(self, message):
+        self._request_done()
+        self.downloaded += len(message.block)
+        # A snubbed peer stays snubbed until the optimistic unsnub, blocks
+        # it sent before our cancels may still come in
+        self.on_block_cb(
+            peer_id=self.remote_id,
+            piece_index=message.index,
+            block_offset=message.begin,
+            data=message.block)
+
+    def _on_request(self, message):
+        if self.fast:
+            # We don't upload, so better tell right away
+            return self._send(RejectRequest(
+                message.index, message.begin, message.length).encode())
+        logging.info('Ignoring the received Request message.')
+
+    def _on_cancel(self, message):
+        logging.info('Ignoring the received Cancel message.')
+
+    def _on_reject_request(self, message):
+        self.piece_manager.reject_request(
+            self.remote_id, message.index, message.begin)
+        self._request_done()
+
+    def _on_allowed_fast(self, message):
+        self.allowed_fast.add(message.index)
+
+    def _on_suggest_piece(self, message):
+        self.suggested.add(message.index)
+
+    def _on_extended(self, message):
+        if not self.pex:
+            return
+        if message.extended_id == 0:
+            try:
+                handshake = bencoding.Decoder(message.payload).decode()
+                self.extensions = {
+                    name.decode('utf-8'): id_ for name, id_
+                    in handshake.get(b'm', {}).items() if id_}
+                port = handshake.get(b'p')
+            except (RuntimeError, EOFError, IndexError, TypeError,
+                    AttributeError, UnicodeDecodeError):
+                logging.info('Ignoring malformed extended handshake')
+                return
+            if self.inbound and isinstance(port, int) and 0 < port < 65536:
+                ip = self.writer.get_extra_info('peername')[0]
+                self.listen_address = (ip, port)
+        elif message.extended_id == UT_PEX_ID:
+            self.pex.received(self, message.payload)
+
+    def _next_block(self):
+        manager = self.piece_manager
+        if 'choked' in self.my_state:
+            # Only the allowed fast pieces may be requested while choked
+            return manager.next_request(self.remote_id,
+                                        pieces=self.allowed_fast)
+        if self.suggested:
+            block = manager.next_request(self.remote_id,
+                                         pieces=self.suggested)
+            if block:
+                return block
+            # Nothing of use left in the suggested pieces
+            self.suggested.clear()
+        return manager.next_request(self.remote_id)
+
+    def _release_requests(self):
+        self.piece_manager.release_requests(self.remote_id)
+        self._clear_requests()
+
+    def _pieces_bitfield(self, value: bool):
+        bitfield = bitstring.BitArray(length=self.piece_manager.total_pieces)
+        if value:
+            bitfield.set(True)
+        return bitfield
+
+    def _have_message(self):
+        bitfield = self.piece_manager.bitfield
+        if bitfield.all(True):
+            return HaveAll().encode()
+        if not bitfield.any(True):
+            return HaveNone().encode()
+        return BitField(bitfield.tobytes()).encode()
+
+    def _on_read(self, length: int):
+        if self._bytes_in:
+            self._bytes_in.inc(length)
+            self.metrics.bytes_in.inc(length)
+
+    async def _request_pieces(self):
+        with span('pick'):
+            blocks = []
+            while self.requests + len(blocks) < PIPELINE_DEPTH:
+                block = self._next_block()
+                if not block:
+                    break
+                blocks.append(block)
+        if not blocks:
+            return
+
+        # The requests are counted before sending them, so no other
+        # requests are made meanwhile
+        if not self.requests:
+            self.waiting_since = time.monotonic()
+            self.my_state.append('pending_request')
+        self.requests += len(blocks)
+        for block in blocks:
+            logging.debug('Requesting block %s for piece %s of %s bytes '
+                          'from peer %s', block.offset, block.piece,
+                          block.length, self.remote_id)
+        await self._send(self._pack(
+            Request(block.piece, block.offset, block.length)
+            for block in blocks))
+
+    def _pack(self, messages) -> bytes:
+        """
+        Encode requests or cancels, which share the same size, into the
+        connection's buffer.
 
-            self.writer.write(message)
-            await self.writer.drain()
+        :return: The messages encoded, copied out of the buffer once since
+                 the outbound queue holds on to them until flushed
+        """
+        messages = list(messages)
+        size = Request.size * len(messages)
+        if size > len(self._buffer):
+            # More cancels than a pipeline's worth, e.g. with allowed fast
+            # pieces requested too
+            self._buffer = bytearray(size)
+        offset = 0
+        for message in messages:
+            offset = message.encode_into(self._buffer, offset)
+        with memoryview(self._buffer) as view:
+            return bytes(view[:offset])
 
     @property
     async def _handshake(self):
         self.writer.write(Handshake(self.info_hash, self.peer_id).encode())
         await self.writer.drain()
 
-        buf = b''
-        tries = 1
-        while len(buf) < Handshake.length and tries < 10:
-            tries += 1
-            buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
-
-        response = Handshake.decode(buf[:Handshake.length])
+        if self.inbound:
+            # The remote handshake was read already when the connection was
+            # accepted, in order to know which torrent it was for.
+            response = self.inbound[2]
+            buf = b''
+        else:
+            buf = b''
+            tries = 1
+            while len(buf) < Handshake.length and tries < 10:
+                tries += 1
+                buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+            self._on_read(len(buf))
+
+            response = Handshake.decode(buf[:Handshake.length])
+            buf = buf[Handshake.length:]
         if not response:
             raise ProtocolError('Unable receive and parse a handshake')
         if not response.info_hash == self.info_hash:
@@ -163,28 +606,107 @@ class PeerConnection:
 
         # from the peer match the peer_id received from the tracker.
         self.remote_id = response.peer_id
+        self.fast = response.supports(FAST_EXTENSION)
+        self.extended = response.supports(EXTENSION_PROTOCOL)
         logging.info('Handshake with peer was successful')
 
         # We need to return the remaining buffer data, since we might have
         # read more bytes then the size of the handshake message and we need
         # those bytes to parse the next message.
-        return buf[Handshake.length:]
+        return buf
+
+
+class MessageQueue:
+    """
+    The messages waiting to be sent to a peer. Messages are collected and
+    written together, with a single system call, when flushed explicitly,
+    when `delay` seconds passed since the first was queued or once `size`
+    bytes are waiting.
+    """
+    def __init__(self, writer, delay: float = FLUSH_DELAY,
+                 size: int = FLUSH_SIZE, high_water: int = HIGH_WATER):
+        """
+        :param writer: The stream to write to
+        :param delay: The longest a message waits before being written
+        :param size: The number of bytes written as soon as they are queued
+        :param high_water: Senders wait in `drain` while more than this many
+                           bytes are not yet written to the socket
+        """
+        self.writer = writer
+        self.delay = delay
+        self.size = size
+        self.high_water = high_water
+        self.last_flush = time.monotonic()
+        self._messages = []
+        self._queued = 0
+        self._timer = None
+        transport = writer.transport
+        if transport:
+            transport.set_write_buffer_limits(high=high_water)
+
+    def put(self, data: bytes):
+        self._messages.append(data)
+        self._queued += len(data)
+        if self._queued >= self.size:
+            self.flush()
+        elif not self._timer:
+            self._timer = asyncio.get_event_loop().call_later(self.delay,
+                                                              self.flush)
+
+    def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._messages:
+            return
+        messages = self._messages
+        self._messages = []
+        self._queued = 0
+        self.last_flush = time.monotonic()
+        if not self.writer.is_closing():
+            self.writer.writelines(messages)
+
+    async def drain(self):
+        """
+        Wait while the peer is too slow to take the data written already.
+        """
+        transport = self.writer.transport
+        if transport.is_closing() or \
+                transport.get_write_buffer_size() > self.high_water:
+            await self.writer.drain()
 
-    async def _send_interested(self):
-        message = Interested()
-        logging.debug('Sending message: {type}'.format(type=message))
-        self.writer.write(message.encode())
-        await self.writer.drain()
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._messages = []
+        self._queued = 0
 
 
 class PeerStreamIterator:
     CHUNK_SIZE = 10 * 1024
 
-    def __init__(self, reader, initial: bytes = None):
+    def __init__(self, reader, initial: bytes = None, limiter=None,
+                 chunk_size: int = CHUNK_SIZE, on_read=None):
+        """
+        :param reader: The stream to read messages from
+        :param initial: Data already read from the stream, e.g. trailing the
+                        handshake
+        :param limiter: An optional `TokenBucket` limiting the read rate
+        :param chunk_size: The number of bytes to read from the stream at once
+        :param on_read: An optional callback given the number of bytes of
+                        every read from the stream
+        """
         self.reader = reader
-        self.buffer = initial if initial else b''
-
-    async def __aiter__(self):
+        self.buffer = bytearray(initial) if initial else bytearray()
+        # Where the next message starts in the buffer, the messages before
+        # are only dropped from the buffer when reading more data
+        self.position = 0
+        self.limiter = limiter
+        self.chunk_size = chunk_size
+        self.on_read = on_read
+
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
@@ -192,18 +714,26 @@ class PeerStreamIterator:
         # it and return the message. Until then keep reading from stream
         while True:
             try:
-                data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+                # Several messages are often received in a single read, make
+                # sure all of them are parsed before reading again
+                with span('parse'):
+                    message = self.parse()
+                if message:
+                    return message
+                data = await self.reader.read(self.chunk_size)
                 if data:
+                    if self.on_read:
+                        self.on_read(len(data))
+                    if self.limiter:
+                        # Not reading from the socket until the bytes read are
+                        # paid for is what throttles the remote peer
+                        await self.limiter.consume(len(data))
+                    if self.position:
+                        del self.buffer[:self.position]
+                        self.position = 0
                     self.buffer += data
-                    message = self.parse()
-                    if message:
-                        return message
                 else:
                     logging.debug('No data read from stream')
-                    if self.buffer:
-                        message = self.parse()
-                        if message:
-                            return message
                     raise StopAsyncIteration()
             except ConnectionResetError:
                 logging.debug('Connection closed by peer')
@@ -220,62 +750,35 @@ class PeerStreamIterator:
     def parse(self):
         # Each message is structured as:
         #     <length prefix><message ID><payload>
-        header_length = 4
-
-        if len(self.buffer) > 4:  # 4 bytes is needed to identify the message
-            message_length = struct.unpack('>I', self.buffer[0:4])[0]
-
-            if message_length == 0:
+        # and decoded in place, by the message type found in the table
+        buffer = self.buffer
+        while len(buffer) - self.position >= 4:
+            start = self.position
+            end = start + 4 + _LENGTH.unpack_from(buffer, start)[0]
+            if end == start + 4:
+                self.position = end
                 return KeepAlive()
-
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack('>b', self.buffer[4:5])[0]
-
-                def _consume():
-                    self.buffer = self.buffer[header_length + message_length:]
-
-                def _data():
-                    return self.buffer[:header_length + message_length]
-
-                if message_id is PeerMessage.BitField:
-                    data = _data()
-                    _consume()
-                    return BitField.decode(data)
-                elif message_id is PeerMessage.Interested:
-                    _consume()
-                    return Interested()
-                elif message_id is PeerMessage.NotInterested:
-                    _consume()
-                    return NotInterested()
-                elif message_id is PeerMessage.Choke:
-                    _consume()
-                    return Choke()
-                elif message_id is PeerMessage.Unchoke:
-                    _consume()
-                    return Unchoke()
-                elif message_id is PeerMessage.Have:
-                    data = _data()
-                    _consume()
-                    return Have.decode(data)
-                elif message_id is PeerMessage.Piece:
-                    data = _data()
-                    _consume()
-                    return Piece.decode(data)
-                elif message_id is PeerMessage.Request:
-                    data = _data()
-                    _consume()
-                    return Request.decode(data)
-                elif message_id is PeerMessage.Cancel:
-                    data = _data()
-                    _consume()
-                    return Cancel.decode(data)
-                else:
-                    logging.info('Unsupported message!')
-            else:
-                logging.debug('Not enough in buffer in order to parse')
+            if len(buffer) < end:
+                # Not enough in buffer in order to parse
+                return None
+            self.position = end
+            message_type = _MESSAGE_TYPES.get(buffer[start + 4])
+            if message_type:
+                return message_type.decode(buffer, start)
+            logging.info('Unsupported message!')
         return None
 
 
+# The messages are encoded and decoded with these, compiled once
+_LENGTH = struct.Struct('>I')
+_HEADER = struct.Struct('>Ib')  # Length and id, all a message without payload
+_HANDSHAKE = struct.Struct('>B19s8s20s20s')
+_INDEX = struct.Struct('>IbI')  # Have, SuggestPiece and AllowedFast
+_BLOCK = struct.Struct('>IbIII')  # Request, Cancel and RejectRequest
+_PIECE = struct.Struct('>IbII')  # The header of Piece, followed by the block
+_EXTENDED = struct.Struct('>IbB')  # The header of Extended
+
+
 class PeerMessage:
     # It provides messages between two peers
     Choke = 0
@@ -288,15 +791,29 @@ class PeerMessage:
     Piece = 7
     Cancel = 8
     Port = 9
+    # Fast Extension (BEP 6)
+    SuggestPiece = 13
+    HaveAll = 14
+    HaveNone = 15
+    RejectRequest = 16
+    AllowedFast = 17
+    # Extension protocol (BEP 10)
+    Extended = 20
     Handshake = None  # Handshake is not really part of the messages
     KeepAlive = None  # Keep-alive has no ID
 
+    __slots__ = ()
+
     def encode(self) -> bytes:
         pass
 
     @classmethod
-    def decode(cls, data: bytes):
-        pass
+    def decode(cls, data: bytes, offset: int = 0):
+        """
+        Decode the message starting at `offset` in `data`, by default the
+        message is recognized by its id alone.
+        """
+        return cls()
 
 
 class Handshake(PeerMessage):
@@ -305,31 +822,48 @@ class Handshake(PeerMessage):
     # which is equal to 68 bytes
     length = 49 + 19
 
-    def __init__(self, info_hash: bytes, peer_id: bytes):
+    __slots__ = ('info_hash', 'peer_id', 'reserved')
+
+    def __init__(self, info_hash: bytes, peer_id: bytes,
+                 reserved: bytes = None):
+        """
+        :param reserved: The 8 reserved bytes announcing the extensions
+                         supported, by default the ones supported by us
+        """
         if isinstance(info_hash, str):
             info_hash = info_hash.encode('utf-8')
         if isinstance(peer_id, str):
             peer_id = peer_id.encode('utf-8')
         self.info_hash = info_hash
         self.peer_id = peer_id
+        if reserved is None:
+            reserved = bytearray(8)
+            for byte, mask in (FAST_EXTENSION, EXTENSION_PROTOCOL):
+                reserved[byte] |= mask
+        self.reserved = bytes(reserved)
+
+    def supports(self, extension) -> bool:
+        """
+        Whether the given extension bit, e.g. `FAST_EXTENSION`, is set.
+        """
+        byte, mask = extension
+        return bool(self.reserved[byte] & mask)
 
     def encode(self) -> bytes:
-        return struct.pack(
-            '>B19s8x20s20s',
+        return _HANDSHAKE.pack(
             19,  # Single byte (B)
             b'BitTorrent protocol',  # String 19s
-            # Reserved 8x (pad byte, no value)
+            self.reserved,  # Reserved 8s, the extensions supported
             self.info_hash,  # String 20s
             self.peer_id)  # String 20s
 
     @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Handshake of length: {length}'.format(
-            length=len(data)))
-        if len(data) < (49 + 19):
+    def decode(cls, data: bytes, offset: int = 0):
+        logging.debug('Decoding Handshake of length: %s', len(data))
+        if len(data) - offset < (49 + 19):
             return None
-        parts = struct.unpack('>B19s8x20s20s', data)
-        return cls(info_hash=parts[2], peer_id=parts[3])
+        parts = _HANDSHAKE.unpack_from(data, offset)
+        return cls(info_hash=parts[3], peer_id=parts[4], reserved=parts[2])
 
     def __str__(self):
         return 'Handshake'
@@ -338,100 +872,139 @@ class Handshake(PeerMessage):
 #This decodes what was encoded above
 
 class KeepAlive(PeerMessage):
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _KEEP_ALIVE  # A message length of zero
+
     def __str__(self):
         return 'KeepAlive'
 
 
 class BitField(PeerMessage):
+    __slots__ = ('bitfield',)
+
     def __init__(self, data):
         self.bitfield = bitstring.BitArray(bytes=data)
 
     def encode(self) -> bytes:
-        bits_length = len(self.bitfield)
-        return struct.pack('>Ib' + str(bits_length) + 's',
-                           1 + bits_length,
-                           PeerMessage.BitField,
-                           self.bitfield)
+        data = self.bitfield.tobytes()
+        return _HEADER.pack(1 + len(data), PeerMessage.BitField) + data
 
     @classmethod
-    def decode(cls, data: bytes):
-        message_length = struct.unpack('>I', data[:4])[0]
-        logging.debug('Decoding BitField of length: {length}'.format(
-            length=message_length))
-
-        parts = struct.unpack('>Ib' + str(message_length - 1) + 's', data)
-        return cls(parts[2])
+    def decode(cls, data: bytes, offset: int = 0):
+        message_length = _LENGTH.unpack_from(data, offset)[0]
+        return cls(bytes(data[offset + 5:offset + 4 + message_length]))
 
     def __str__(self):
         return 'BitField'
 
 
 class Interested(PeerMessage):
+    __slots__ = ()
+
     def encode(self) -> bytes:
-        return struct.pack('>Ib',
-                           1,  # Message length
-                           PeerMessage.Interested)
+        return _INTERESTED
 
     def __str__(self):
         return 'Interested'
 
 
 class NotInterested(PeerMessage):
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _NOT_INTERESTED
+
     def __str__(self):
         return 'NotInterested'
 
 
 class Choke(PeerMessage):  #Basically tells other peers to stop send req msgs until unchocked
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _CHOKE
+
     def __str__(self):
         return 'Choke'
 
 
 class Unchoke(PeerMessage):
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _UNCHOKE
+
     def __str__(self):
         return 'Unchoke'
 
 
 class Have(PeerMessage):
+    message_id = PeerMessage.Have
+    size = _INDEX.size
+
+    __slots__ = ('index',)
+
     def __init__(self, index: int):
         self.index = index
 
     def encode(self):
-        return struct.pack('>IbI',
-                           5,  # Message length
-                           PeerMessage.Have,
+        return _INDEX.pack(5,  # Message length
+                           self.message_id,
                            self.index)
 
+    def encode_into(self, buffer, offset: int) -> int:
+        """
+        Encode the message into `buffer` at `offset`, e.g. to send several
+        messages at once.
+
+        :return: The offset following the message
+        """
+        _INDEX.pack_into(buffer, offset, 5, self.message_id, self.index)
+        return offset + _INDEX.size
+
     @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Have of length: {length}'.format(
-            length=len(data)))
-        index = struct.unpack('>IbI', data)[2]
-        return cls(index)
+    def decode(cls, data: bytes, offset: int = 0):
+        return cls(_INDEX.unpack_from(data, offset)[2])
 
     def __str__(self):
         return 'Have'
 
 
 class Request(PeerMessage):  #I'll use this to request a part of a piece
+    message_id = PeerMessage.Request
+    size = _BLOCK.size
+
+    __slots__ = ('index', 'begin', 'length')
+
     def __init__(self, index: int, begin: int, length: int = REQUEST_SIZE):
         self.index = index
         self.begin = begin
         self.length = length
 
     def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           PeerMessage.Request,
+        return _BLOCK.pack(13,
+                           self.message_id,
                            self.index,
                            self.begin,
                            self.length)
 
+    def encode_into(self, buffer, offset: int) -> int:
+        """
+        Encode the message into `buffer` at `offset`, e.g. to send several
+        requests at once.
+
+        :return: The offset following the message
+        """
+        _BLOCK.pack_into(buffer, offset, 13, self.message_id, self.index,
+                         self.begin, self.length)
+        return offset + _BLOCK.size
+
     @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Request of length: {length}'.format(
-            length=len(data)))
+    def decode(cls, data: bytes, offset: int = 0):
         # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
+        parts = _BLOCK.unpack_from(data, offset)
         return cls(parts[2], parts[3], parts[4])
 
     def __str__(self):
@@ -441,54 +1014,153 @@ class Request(PeerMessage):  #I'll use this to request a part of a piece
 class Piece(PeerMessage):
     length = 9
 
+    __slots__ = ('index', 'begin', 'block')
+
     def __init__(self, index: int, begin: int, block: bytes):
         self.index = index
         self.begin = begin
         self.block = block
 
     def encode(self):
-        message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
-                           message_length,
+        return _PIECE.pack(Piece.length + len(self.block),
                            PeerMessage.Piece,
                            self.index,
-                           self.begin,
-                           self.block)
+                           self.begin) + self.block
 
     @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Piece of length: {length}'.format(
-            length=len(data)))
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's',
-                              data[:length + 4])
-        return cls(parts[2], parts[3], parts[4])
+    def decode(cls, data: bytes, offset: int = 0):
+        length, _, index, begin = _PIECE.unpack_from(data, offset)
+        # The block is copied out of the buffer only once
+        with memoryview(data) as view:
+            block = bytes(view[offset + _PIECE.size:offset + 4 + length])
+        return cls(index, begin, block)
 
     def __str__(self):
         return 'Piece'
 
 
-class Cancel(PeerMessage):
-    def __init__(self, index, begin, length: int = REQUEST_SIZE):
-        self.index = index
-        self.begin = begin
-        self.length = length
+class Cancel(Request):
+    message_id = PeerMessage.Cancel
+
+    __slots__ = ()
+
+    def __str__(self):
+        return 'Cancel'
+
+
+class SuggestPiece(Have):
+    """
+    Fast Extension: the peer suggests downloading this piece, e.g. since it
+    is cached.
+    """
+    message_id = PeerMessage.SuggestPiece
+
+    __slots__ = ()
+
+    def __str__(self):
+        return 'SuggestPiece'
+
+
+class HaveAll(PeerMessage):
+    """
+    Fast Extension: replaces the bitfield of a peer having every piece.
+    """
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _HAVE_ALL
+
+    def __str__(self):
+        return 'HaveAll'
+
+
+class HaveNone(PeerMessage):
+    """
+    Fast Extension: replaces the bitfield of a peer having no pieces.
+    """
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _HAVE_NONE
+
+    def __str__(self):
+        return 'HaveNone'
+
+
+class RejectRequest(Request):
+    """
+    Fast Extension: the peer won't serve the block requested.
+    """
+    message_id = PeerMessage.RejectRequest
+
+    __slots__ = ()
+
+    def __str__(self):
+        return 'RejectRequest'
+
+
+class AllowedFast(Have):
+    """
+    Fast Extension: this piece may be requested even while choked.
+    """
+    message_id = PeerMessage.AllowedFast
+
+    __slots__ = ()
+
+    def __str__(self):
+        return 'AllowedFast'
+
+
+class Extended(PeerMessage):
+    """
+    Extension protocol: a message of an extension, where the id is the one
+    the receiver gave the extension in its extended handshake. Id 0 is that
+    handshake.
+    """
+    __slots__ = ('extended_id', 'payload')
+
+    def __init__(self, extended_id: int, payload: bytes):
+        self.extended_id = extended_id
+        self.payload = payload
 
     def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           PeerMessage.Cancel,
-                           self.index,
-                           self.begin,
-                           self.length)
+        return _EXTENDED.pack(2 + len(self.payload),
+                              PeerMessage.Extended,
+                              self.extended_id) + self.payload
 
     @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Cancel of length: {length}'.format(
-            length=len(data)))
-        # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
-        return cls(parts[2], parts[3], parts[4])
+    def decode(cls, data: bytes, offset: int = 0):
+        length, _, extended_id = _EXTENDED.unpack_from(data, offset)
+        return cls(extended_id, bytes(data[offset + 6:offset + 4 + length]))
 
     def __str__(self):
-        return 'Cancel'
+        return 'Extended'
+
+
+# Messages without a payload are always the same bytes
+_KEEP_ALIVE = _LENGTH.pack(0)
+_CHOKE = _HEADER.pack(1, PeerMessage.Choke)
+_UNCHOKE = _HEADER.pack(1, PeerMessage.Unchoke)
+_INTERESTED = _HEADER.pack(1, PeerMessage.Interested)
+_NOT_INTERESTED = _HEADER.pack(1, PeerMessage.NotInterested)
+_HAVE_ALL = _HEADER.pack(1, PeerMessage.HaveAll)
+_HAVE_NONE = _HEADER.pack(1, PeerMessage.HaveNone)
+
+# The message types the parser decodes, by message id
+_MESSAGE_TYPES = {
+    PeerMessage.Choke: Choke,
+    PeerMessage.Unchoke: Unchoke,
+    PeerMessage.Interested: Interested,
+    PeerMessage.NotInterested: NotInterested,
+    PeerMessage.Have: Have,
+    PeerMessage.BitField: BitField,
+    PeerMessage.Request: Request,
+    PeerMessage.Piece: Piece,
+    PeerMessage.Cancel: Cancel,
+    PeerMessage.SuggestPiece: SuggestPiece,
+    PeerMessage.HaveAll: HaveAll,
+    PeerMessage.HaveNone: HaveNone,
+    PeerMessage.RejectRequest: RejectRequest,
+    PeerMessage.AllowedFast: AllowedFast,
+    PeerMessage.Extended: Extended,
+}
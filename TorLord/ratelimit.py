@@ -0,0 +1,141 @@
+import asyncio
+import time
+from collections import deque
+
+# Unless given explicitly, a bucket holds at most this many seconds worth of
+# tokens, which is how much traffic may burst above the configured rate.
+DEFAULT_BURST_TIME = 0.1
+
+
+class TokenBucket:
+    """
+    Limits the rate (in bytes per second) of the traffic passing through it.
+
+    Buckets form a hierarchy, such as global -> torrent -> peer, where the
+    traffic must get through every bucket from the leaf up to the root. A
+    bucket without a rate is unlimited and only forwards to its parent.
+
+    Callers that run out of tokens are queued in FIFO order and woken up by a
+    single timer scheduled for the moment enough tokens are available, i.e.
+    there is no polling involved. Suspending the caller in the read or write
+    path is what creates the backpressure towards the remote peer.
+    """
+    def __init__(self, rate: float = None, burst: int = None, parent=None):
+        """
+        :param rate: The number of bytes per second, None for unlimited or 0
+                     to pause all traffic
+        :param burst: The maximum number of tokens the bucket can hold
+        :param parent: The bucket one level up in the hierarchy
+        """
+        self.parent = parent
+        self._rate = rate
+        self._burst = burst
+        self._tokens = self.burst if rate else 0
+        self._updated = time.monotonic()
+        self._waiters = deque()  # (amount, future)
+        self._timer = None
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: float):
+        """
+        Change the rate of the bucket. Callers already waiting are
+        rescheduled to be woken up according to the new rate.
+        """
+        # Tokens accumulated up until now are credited at the old rate
+        self._refill()
+        self._rate = rate
+        if rate is not None:
+            self._tokens = min(self._tokens, self.burst)
+        self._schedule()
+
+    @property
+    def burst(self) -> float:
+        if self._burst is not None:
+            return self._burst
+        if not self._rate:
+            return 0
+        return max(self._rate * DEFAULT_BURST_TIME, 1)
+
+    @burst.setter
+    def burst(self, burst: int):
+        self._refill()
+        self._burst = burst
+        self._schedule()
+
+    async def consume(self, amount: int):
+        """
+        Wait until `amount` bytes are allowed to pass through this bucket and
+        all of its parents.
+        """
+        if self._rate is not None:
+            if self._waiters or not self._take(amount):
+                waiter = asyncio.get_event_loop().create_future()
+                self._waiters.append((amount, waiter))
+                if len(self._waiters) == 1:
+                    self._schedule()
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if (amount, waiter) in self._waiters:
+                        self._waiters.remove((amount, waiter))
+                        self._schedule()
+                    raise
+        if self.parent is not None:
+            await self.parent.consume(amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _take(self, amount: int) -> bool:
+        # An amount larger than the burst is let through once the bucket is
+        # full, the debt it leaves behind is paid by the following callers.
+        self._refill()
+        if self._rate == 0:
+            # Paused, whatever tokens are left
+            return False
+        if self._tokens >= min(amount, self.burst):
+            self._tokens -= amount
+            return True
+        return False
+
+    def _schedule(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and self._waiters[0][1].done():
+            # The waiting caller was cancelled
+            self._waiters.popleft()
+        if not self._waiters:
+            return
+
+        if self._rate is None:
+            # No longer limited, let everyone through
+            while self._waiters:
+                _, waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+        elif self._rate > 0:
+            amount = self._waiters[0][0]
+            self._refill()
+            deficit = min(amount, self.burst) - self._tokens
+            self._timer = asyncio.get_event_loop().call_later(
+                max(deficit / self._rate, 0), self._wake)
+
+    def _wake(self):
+        self._timer = None
+        while self._waiters:
+            amount, waiter = self._waiters[0]
+            if not waiter.done():
+                if not self._take(amount):
+                    break
+                waiter.set_result(None)
+            self._waiters.popleft()
+        self._schedule()
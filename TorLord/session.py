@@ -0,0 +1,283 @@
+import aiohttp
+import asyncio
+import logging
+
+from TorLord.client import TorrentClient, PEER_PRIORITY_LOCAL
+from TorLord.lsd import LocalServiceDiscovery
+from TorLord.metrics import default_registry, PrometheusExporter
+from TorLord.profiling import LoopLagMonitor
+from TorLord.protocol import Handshake
+from TorLord.ratelimit import TokenBucket
+from TorLord.tracker import Tracker, _calculate_peer_id
+from TorLord.tuning import SocketOptions
+
+# The total number of peer connections shared among all torrents
+MAX_SESSION_CONNECTIONS = 200
+
+# The total number of bytes (256 MB) that may be buffered in memory for
+# pieces under download, shared among all torrents
+MAX_SESSION_MEMORY = 256 * 1024 * 1024
+
+# How long an inbound peer gets to send its handshake before being dropped
+HANDSHAKE_TIMEOUT = 10
+
+
+class Session:
+    """
+    Runs many torrents within a single event loop.
+
+    All torrents share one pooled HTTP client for the tracker announce calls,
+    one listener for incoming peer connections and a global budget of peer
+    connections and memory. The budget is spread among the torrents based on
+    their priority and rebalanced whenever a torrent is added or removed.
+    """
+    def __init__(self, port: int = 6889, host: str = None,
+                 max_connections: int = MAX_SESSION_CONNECTIONS,
+                 max_memory: int = MAX_SESSION_MEMORY,
+                 download_rate: float = None, upload_rate: float = None,
+                 socket_options: SocketOptions = None,
+                 metrics=None, metrics_port: int = None, exporter=None,
+                 peer_cache=None, local_discovery: bool = False):
+        """
+        :param port: The port to listen on for incoming peers, or None to not
+                     accept incoming connections
+        :param host: The interface to listen on, all interfaces by default
+        :param max_connections: The number of peer connections for all
+                                torrents combined
+        :param max_memory: The number of bytes for all torrents combined used
+                           to buffer pieces under download
+        :param download_rate: The download limit (bytes per second) for all
+                              torrents combined, None for unlimited
+        :param upload_rate: The upload limit (bytes per second) for all
+                            torrents combined, None for unlimited
+        :param socket_options: The `SocketOptions` applied to all peer
+                               connections, incoming as well as outgoing
+        :param metrics: The `MetricsRegistry` the metrics of all torrents are
+                        kept in, defaults to the global one
+        :param metrics_port: The port on localhost to serve the metrics on,
+                             or None to not serve them
+        :param exporter: The `Exporter` used to serve the metrics, defaults
+                         to the Prometheus text format
+        :param peer_cache: The `PeerCache` shared by all torrents to remember
+                           peers across restarts, None to not remember them
+        :param local_discovery: Find peers on the local network through
+                                multicast announces (BEP 14), requires
+                                listening for incoming peers
+        """
+        self.port = port
+        self.host = host
+        self.max_connections = max_connections
+        self.max_memory = max_memory
+        self.peer_id = _calculate_peer_id()
+        self.download_limiter = TokenBucket(download_rate)
+        self.upload_limiter = TokenBucket(upload_rate)
+        self.socket_options = socket_options if socket_options \
+            else SocketOptions()
+        self.metrics = metrics if metrics else default_registry
+        self.metrics_port = metrics_port
+        self.exporter = exporter
+        self.peer_cache = peer_cache
+        self.local_discovery = local_discovery
+        self.lsd = None
+        self.lag_monitor = LoopLagMonitor(registry=self.metrics)
+        self.torrents = {}  # info_hash -> _SessionTorrent
+        # Torrents removed still telling their tracker they stopped
+        self._stopped_announces = []
+        self.http_client = None
+        self.server = None
+
+    async def start(self):
+        """
+        Create the shared HTTP client and start listening for peers.
+        """
+        self.http_client = aiohttp.ClientSession()
+        self.lag_monitor.start()
+        if self.port is not None:
+            self.server = await self.socket_options.start_server(
+                self._on_inbound, host=self.host, port=self.port)
+            # Pick up the actual port in case an ephemeral one was asked for
+            self.port = self.server.sockets[0].getsockname()[1]
+            logging.info('Listening for peers on port {port}'.format(
+                port=self.port))
+            if self.local_discovery:
+                await self._start_lsd()
+        if self.metrics_port is not None:
+            if not self.exporter:
+                self.exporter = PrometheusExporter(self.metrics)
+            await self.exporter.start('127.0.0.1', self.metrics_port)
+
+    def add(self, torrent, priority: int = 1) -> TorrentClient:
+        """
+        Add a torrent to the session and start downloading it.
+
+        :param torrent: The torrent to download
+        :param priority: The relative weight of this torrent when the session
+                         budget is divided among torrents
+        :return: The client downloading the torrent
+        """
+        if torrent.info_hash in self.torrents:
+            return self.torrents[torrent.info_hash].client
+        if priority < 1:
+            raise ValueError('Priority must be a positive integer')
+
+        tracker = Tracker(torrent,
+                          http_client=self.http_client,
+                          peer_id=self.peer_id,
+                          port=self.port if self.port else 6889)
+        client = TorrentClient(torrent, tracker=tracker,
+                               download_limiter=self.download_limiter,
+                               upload_limiter=self.upload_limiter,
+                               socket_options=self.socket_options,
+                               metrics=self.metrics,
+                               peer_cache=self.peer_cache)
+        entry = _SessionTorrent(client, priority)
+        self.torrents[torrent.info_hash] = entry
+        if self.lsd:
+            self.lsd.add(torrent.info_hash)
+        self._rebalance()
+        entry.task = asyncio.ensure_future(client.start())
+        entry.task.add_done_callback(self._on_done)
+        return client
+
+    def remove(self, info_hash):
+        """
+        Stop downloading the given torrent and hand its share of the budget
+        over to the remaining torrents.
+        """
+        entry = self.torrents.pop(info_hash, None)
+        if self.lsd:
+            self.lsd.remove(info_hash)
+        if entry:
+            entry.client.stop()
+            entry.client.metrics.close()
+            if entry.client.stopped_announce:
+                self._stopped_announces.append(
+                    entry.client.stopped_announce)
+            if not entry.task.done():
+                entry.task.cancel()
+            self._rebalance()
+
+    def set_priority(self, info_hash, priority: int):
+        if priority < 1:
+            raise ValueError('Priority must be a positive integer')
+        self.torrents[info_hash].priority = priority
+        self._rebalance()
+
+    def set_rate_limits(self, download: float = None, upload: float = None):
+        """
+        Change the session wide bandwidth limits (in bytes per second), None
+        means unlimited. Per torrent limits are set on each `TorrentClient`.
+        """
+        self.download_limiter.rate = download
+        self.upload_limiter.rate = upload
+
+    async def wait(self):
+        """
+        Wait until every torrent within this session has stopped.
+        """
+        tasks = [t.task for t in self.torrents.values() if t.task]
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def stop(self):
+        for info_hash in list(self.torrents):
+            self.remove(info_hash)
+        if self.server:
+            self.server.close()
+
+    async def close(self):
+        self.stop()
+        self.lag_monitor.stop()
+        if self.lsd:
+            self.lsd.close()
+            self.lsd = None
+        if self.server:
+            await self.server.wait_closed()
+            self.server = None
+        if self._stopped_announces:
+            # They time out on their own, so this won't take long
+            await asyncio.wait(self._stopped_announces)
+            self._stopped_announces = []
+        if self.http_client:
+            await self.http_client.close()
+            self.http_client = None
+        if self.exporter:
+            await self.exporter.close()
+
+    def _rebalance(self):
+        entries = list(self.torrents.values())
+        if not entries:
+            return
+        weights = [e.priority for e in entries]
+        connections = _divide(self.max_connections, weights)
+        memory = _divide(self.max_memory, weights)
+        for entry, conns, mem in zip(entries, connections, memory):
+            piece_length = entry.client.piece_manager.torrent.piece_length
+            # Each torrent is allowed at least a single connection and piece
+            # no matter how many torrents the session holds.
+            entry.client.set_limits(
+                max_peer_connections=max(1, conns),
+                max_ongoing_pieces=max(1, mem // piece_length))
+
+    async def _start_lsd(self):
+        lsd = LocalServiceDiscovery(self.port, self._on_local_peer)
+        try:
+            await lsd.start()
+        except OSError as e:
+            logging.warning('Unable to start local service discovery: '
+                            '{error}'.format(error=e))
+            lsd.close()
+            return
+        self.lsd = lsd
+        for info_hash in self.torrents:
+            lsd.add(info_hash)
+
+    def _on_local_peer(self, info_hash, peer):
+        entry = self.torrents.get(info_hash)
+        if entry:
+            entry.client.add_peer(peer, PEER_PRIORITY_LOCAL)
+
+    async def _on_inbound(self, reader, writer):
+        try:
+            data = await asyncio.wait_for(
+                reader.readexactly(Handshake.length), HANDSHAKE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError):
+            writer.close()
+            return
+
+        handshake = Handshake.decode(data)
+        entry = self.torrents.get(handshake.info_hash) if handshake else None
+        if not entry or not entry.client.add_inbound(reader, writer,
+                                                     handshake):
+            logging.info('Rejecting incoming peer {peer}'.format(
+                peer=writer.get_extra_info('peername')))
+            writer.close()
+
+    def _on_done(self, task):
+        if not task.cancelled() and task.exception():
+            logging.error('Torrent stopped with an error',
+                          exc_info=task.exception())
+
+
+class _SessionTorrent:
+    def __init__(self, client: TorrentClient, priority: int):
+        self.client = client
+        self.priority = priority
+        self.task = None
+
+
+def _divide(total: int, weights: [int]) -> [int]:
+    """
+    Split `total` into integer shares proportional to the given weights using
+    the largest remainder method, so the shares always sum up to `total`.
+    """
+    weight_sum = sum(weights)
+    exact = [total * w / weight_sum for w in weights]
+    shares = [int(e) for e in exact]
+    remaining = total - sum(shares)
+    by_remainder = sorted(range(len(weights)),
+                          key=lambda i: exact[i] - shares[i], reverse=True)
+    for i in by_remainder[:remaining]:
+        shares[i] += 1
+    return shares
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from TorLord.client import TorrentClient, MAX_PEER_CONNECTIONS
+from TorLord.protocol import Handshake
+from TorLord.session import HANDSHAKE_TIMEOUT
+from TorLord.torrent import Torrent
+from TorLord.tracker import Tracker
+from TorLord.tuning import SocketOptions, new_event_loop
+
+
+def shards(pieces: int, count: int) -> [range]:
+    """
+    Split the piece indexes into `count` contiguous ranges, with sizes
+    differing by at most a single piece.
+    """
+    size, extra = divmod(pieces, count)
+    ranges = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+
+class ShardedClient:
+    """
+    Downloads a torrent with several worker processes, each running its own
+    event loop and `TorrentClient` for a contiguous share of the pieces.
+    The workers connect to peers, parse, hash and write on their own, so
+    the download isn't bound to the single core one event loop runs on.
+
+    The pieces are partitioned up front: a worker done with its share does
+    not help out the others. Each worker listens on a port of its own and
+    announces itself to the tracker as a separate peer, telling what's left
+    of the whole torrent.
+    """
+    def __init__(self, torrent_path: str, workers: int,
+                 download_dir: str = '',
+                 max_peer_connections: int = MAX_PEER_CONNECTIONS,
+                 socket_options=None, use_uvloop: bool = False):
+        """
+        :param torrent_path: The .torrent file of the torrent to download
+        :param workers: The number of worker processes
+        :param download_dir: The directory to save the downloaded data in
+        :param max_peer_connections: The number of peers to connect to, split
+                                     among the workers
+        :param socket_options: The `SocketOptions` used by every worker
+        :param use_uvloop: Run the workers on uvloop, when installed
+        """
+        if workers < 1:
+            raise ValueError('At least a single worker is needed')
+        self.torrent_path = torrent_path
+        self.torrent = Torrent(torrent_path)
+        self.workers = workers
+        self.download_dir = download_dir
+        self.max_peer_connections = max_peer_connections
+        self.socket_options = socket_options
+        self.use_uvloop = use_uvloop
+        self.processes = []
+        self._context = multiprocessing.get_context('spawn')
+        # The bytes downloaded by each worker, each only writes its own
+        self._downloaded = self._context.RawArray('q', workers)
+
+    def start(self):
+        connections = max(1, self.max_peer_connections // self.workers)
+        for index, shard in enumerate(shards(len(self.torrent.pieces),
+                                             self.workers)):
+            if not shard:
+                # More workers than pieces
+                continue
+            process = self._context.Process(
+                target=_worker,
+                args=(self.torrent_path, shard, self.download_dir,
+                      connections, self.socket_options, self.use_uvloop,
+                      self._downloaded, index),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    @property
+    def bytes_downloaded(self) -> int:
+        return sum(self._downloaded)
+
+    @property
+    def complete(self) -> bool:
+        return self.bytes_downloaded == self.torrent.total_size
+
+    async def wait(self):
+        """
+        Wait until every worker has exited, because its share is downloaded
+        or it was stopped.
+        """
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, p.join)
+                               for p in self.processes])
+        for index, process in enumerate(self.processes):
+            if process.exitcode:
+                logging.error('Worker {index} exited with {code}'.format(
+                    index=index, code=process.exitcode))
+
+    def stop(self):
+        # Workers stop their client, and tell the tracker, on SIGTERM
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def _worker(torrent_path, shard, download_dir, max_peer_connections,
+            socket_options, use_uvloop, downloaded, index):
+    # Ctrl-C is handled by the parent, which stops the workers in turn
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = new_event_loop(use_uvloop)
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_download_shard(
+            torrent_path, shard, download_dir, max_peer_connections,
+            socket_options, downloaded, index))
+    finally:
+        loop.close()
+
+
+class _ShardClient(TorrentClient):
+    """
+    The client of a single worker. The tracker is told the bytes left of
+    the whole torrent as downloaded by all workers, and only told the
+    torrent completed by the worker finishing it.
+    """
+    def __init__(self, torrent, downloaded, **kwargs):
+        """
+        :param downloaded: The bytes downloaded by each worker
+        """
+        super().__init__(torrent, **kwargs)
+        self.downloaded = downloaded
+
+    def _bytes_left(self) -> int:
+        return max(self.tracker.torrent.total_size - sum(self.downloaded), 0)
+
+    async def _announce(self, event: str = None) -> bool:
+        if event == 'completed' and self._bytes_left():
+            # Only our share is done, the other workers are still at it
+            return True
+        return await super()._announce(event)
+
+
+async def _download_shard(torrent_path, shard, download_dir,
+                          max_peer_connections, socket_options, downloaded,
+                          index):
+    socket_options = socket_options if socket_options else SocketOptions()
+    torrent = Torrent(torrent_path)
+    client = None
+
+    async def _on_inbound(reader, writer):
+        try:
+            handshake = Handshake.decode(await asyncio.wait_for(
+                reader.readexactly(Handshake.length), HANDSHAKE_TIMEOUT))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError):
+            handshake = None
+        if not handshake or handshake.info_hash != torrent.info_hash or \
+                not client.add_inbound(reader, writer, handshake):
+            writer.close()
+
+    # Peers are accepted on a port of our own, the one announced
+    server = await socket_options.start_server(_on_inbound, port=0)
+    port = server.sockets[0].getsockname()[1]
+    client = _ShardClient(torrent, downloaded,
+                          tracker=Tracker(torrent, port=port),
+                          max_peer_connections=max_peer_connections,
+                          socket_options=socket_options,
+                          download_dir=download_dir)
+    manager = client.piece_manager
+    manager.set_shard(shard)
+    on_have = manager.on_have
+
+    def _on_have(piece):
+        on_have(piece)
+        downloaded[index] = manager.bytes_downloaded
+    manager.on_have = _on_have
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, client.stop)
+
+    try:
+        await client.start()
+    finally:
+        server.close()
+    if client.stopped_announce:
+        await client.stopped_announce
+    # Let the peers and the tracker client finish closing
+    pending = [t for t in asyncio.all_tasks()
+               if t is not asyncio.current_task()]
+    if pending:
+        await asyncio.wait(pending, timeout=1)
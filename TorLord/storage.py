@@ -0,0 +1,94 @@
+import bisect
+import os
+
+
+class Storage:
+    """
+    Maps the data of a torrent, a single range of bytes split into pieces, to
+    the files of the torrent on disk. Files are opened (and created) when
+    first written to or read from.
+    """
+    def __init__(self, torrent, download_dir: str = ''):
+        """
+        :param torrent: The torrent whose files to store
+        :param download_dir: The directory to save the files in, defaults to
+                             the current working directory
+        """
+        self.piece_length = torrent.piece_length
+        if torrent.multi_file:
+            # The files of a multi-file torrent are kept in a directory named
+            # after the torrent
+            root = os.path.join(download_dir, torrent.output_file)
+            self.paths = [os.path.join(root, f.name) for f in torrent.files]
+        else:
+            self.paths = [os.path.join(download_dir, torrent.output_file)]
+        self.lengths = [f.length for f in torrent.files]
+        # The offset of each file within the torrent's data
+        self.offsets = []
+        offset = 0
+        for length in self.lengths:
+            self.offsets.append(offset)
+            offset += length
+        self._fds = {}  # file index -> file descriptor
+
+    def spans(self, offset: int, length: int) -> [tuple]:
+        """
+        The parts of the files covered by the given range of the torrent's
+        data, as (file index, offset within the file, length) tuples.
+        """
+        spans = []
+        end = offset + length
+        index = max(0, bisect.bisect_right(self.offsets, offset) - 1)
+        while offset < end and index < len(self.offsets):
+            file_end = self.offsets[index] + self.lengths[index]
+            if offset < file_end:
+                span = min(end, file_end) - offset
+                spans.append((index, offset - self.offsets[index], span))
+                offset += span
+            index += 1
+        return spans
+
+    def pieces(self, index: int) -> range:
+        """
+        The indexes of the pieces holding data of the given file.
+        """
+        if not self.lengths[index]:
+            return range(0)
+        start = self.offsets[index]
+        end = start + self.lengths[index]
+        return range(start // self.piece_length,
+                     (end - 1) // self.piece_length + 1)
+
+    def write(self, offset: int, data: bytes, skip=()):
+        """
+        Write data at the given offset of the torrent's data.
+
+        :param skip: Indexes of files not to write to, data of a piece at the
+                     boundary of an unwanted file is dropped
+        """
+        position = 0
+        for index, file_offset, length in self.spans(offset, len(data)):
+            if index not in skip:
+                os.pwrite(self._fd(index), data[position:position + length],
+                          file_offset)
+            position += length
+
+    def read(self, offset: int, length: int) -> bytes:
+        return b''.join([os.pread(self._fd(index), span, file_offset)
+                         for index, file_offset, span in
+                         self.spans(offset, length)])
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    def _fd(self, index: int) -> int:
+        fd = self._fds.get(index)
+        if fd is None:
+            directory = os.path.dirname(self.paths[index])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.paths[index], os.O_RDWR | os.O_CREAT)
+            self._fds[index] = fd
+        return fd
@@ -0,0 +1,130 @@
+import io
+import logging
+
+from aiohttp import web
+
+# The number of bytes read from the torrent at once while serving a request,
+# a piece or two at the common piece sizes
+CHUNK_SIZE = 2 ** 18
+
+
+class TorrentReader:
+    """
+    A file-like object over (part of) the data of a torrent being downloaded.
+    Reads return data already downloaded right away, and otherwise wait for
+    the pieces needed, which are then downloaded before any other piece.
+    """
+    def __init__(self, client, offset: int = 0, size: int = None):
+        """
+        :param client: The `TorrentClient` downloading the torrent
+        :param offset: The offset within the torrent's data the reader
+                       starts at
+        :param size: The number of bytes readable, defaults to the rest of
+                     the torrent
+        """
+        total_size = client.piece_manager.torrent.total_size
+        self.client = client
+        self.offset = offset
+        self.size = total_size - offset if size is None else size
+        self.position = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        """
+        Read at most `n` bytes, or up to the end when `n` is negative.
+        """
+        remaining = max(0, self.size - self.position)
+        n = remaining if n < 0 else min(n, remaining)
+        data = await self.client.read(self.offset + self.position, n)
+        self.position += len(data)
+        return data
+
+    def seek(self, position: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        if position < 0:
+            raise ValueError('Negative seek position {position}'
+                             .format(position=position))
+        self.position = position
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+
+class RangeServer:
+    """
+    Serves the data of a torrent over HTTP while it is downloading, with
+    support for range requests so media players and other tools can seek
+    through it.
+    """
+    def __init__(self, client, content_type: str = 'application/octet-stream'):
+        """
+        :param client: The `TorrentClient` downloading the torrent
+        :param content_type: The Content-Type the data is served as
+        """
+        self.client = client
+        self.content_type = content_type
+        self.runner = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_get('/', self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info('Streaming torrent at http://{host}:{port}/'.format(
+            host=host, port=self.runner.addresses[0][1]))
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request):
+        total_size = self.client.piece_manager.torrent.total_size
+        try:
+            requested = request.http_range
+        except ValueError:
+            requested = slice(None, None)
+        start, stop = requested.start, requested.stop
+        if start is None and stop is None:
+            start, stop, status = 0, total_size, 200
+        else:
+            if start < 0:
+                # A suffix range, the last bytes of the data
+                start, stop = max(0, total_size + start), total_size
+            stop = total_size if stop is None else min(stop, total_size)
+            status = 206
+        # Everything that keeps the data from being read is answered before
+        # the headers are sent
+        if self.client.abort:
+            return web.Response(status=503)
+        if start >= stop or \
+                self.client.piece_manager.skips(start, stop - start):
+            return web.Response(status=416, headers={
+                'Content-Range': 'bytes */{size}'.format(size=total_size)})
+
+        response = web.StreamResponse(status=status)
+        response.content_type = self.content_type
+        response.content_length = stop - start
+        response.headers['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response.headers['Content-Range'] = 'bytes {start}-{end}/{size}' \
+                .format(start=start, end=stop - 1, size=total_size)
+        await response.prepare(request)
+        reader = TorrentReader(self.client, start, stop - start)
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                await response.write(data)
+        except (ValueError, OSError) as e:
+            # The status is sent already, the body can only be cut short
+            logging.warning('Streaming stopped: {error}'.format(error=e))
+            response.force_close()
+            return response
+        await response.write_eof()
+        return response
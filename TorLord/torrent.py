@@ -1,3 +1,4 @@
+import os
 from hashlib import sha1
 from collections import namedtuple
 
@@ -30,8 +31,17 @@ class Torrent:
         Identifies the files included in this torrent
         """
         if self.multi_file:
-            # TODO Add support for multi-file torrents
-            raise RuntimeError('Multi-file torrents is not supported!')
+            # The files are kept in a directory named after the torrent, each
+            # with a path relative to that directory
+            for f in self.meta_info[b'info'][b'files']:
+                path = [p.decode('utf-8') for p in f[b'path']]
+                if not path or any(p in ('', '.', '..') or os.sep in p
+                                   for p in path):
+                    raise RuntimeError('Invalid file path {path}'.format(
+                        path=path))
+                self.files.append(
+                    TorrentFile(os.path.join(*path), f[b'length']))
+            return
         self.files.append(
             TorrentFile(
                 self.meta_info[b'info'][b'name'].decode('utf-8'),
@@ -44,6 +54,17 @@ class Torrent:
         """
         return self.meta_info[b'announce'].decode('utf-8')
 
+    @property
+    def url_list(self) -> [str]:
+        """
+        The URLs of the web seeds holding the torrent's files (BEP 19), if
+        any.
+        """
+        urls = self.meta_info.get(b'url-list', [])
+        if isinstance(urls, bytes):
+            urls = [urls]
+        return [url.decode('utf-8') for url in urls if url]
+
     @property
     def multi_file(self) -> bool:
         """
@@ -68,9 +89,7 @@ class Torrent:
 
         :return: The total size (in bytes) for this torrent's data.
         """
-        if self.multi_file:
-            raise RuntimeError('Multi-file torrents is not supported!')
-        return self.files[0].length
+        return sum(f.length for f in self.files)
 
     @property
     def pieces(self):
@@ -96,6 +115,6 @@ class Torrent:
                'File length: {1}\n' \
                'Announce URL: {2}\n' \
                'Hash: {3}'.format(self.meta_info[b'info'][b'name'],
-                                  self.meta_info[b'info'][b'length'],
+                                  self.total_size,
                                   self.meta_info[b'announce'],
                                   self.info_hash)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import aiohttp
+import asyncio
 import random
 import logging
 import socket
@@ -14,15 +15,27 @@ class Tracker:
     under download or seeding state.
     """
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, http_client=None, peer_id=None, port=6889):
+        """
+        :param torrent: The torrent to announce
+        :param http_client: An optional `aiohttp.ClientSession` shared with
+                            other trackers, e.g. by a `Session`. When not
+                            given the tracker creates (and owns) its own.
+        :param peer_id: Our peer ID, a new one is generated if not given
+        :param port: The port we are listening on for incoming peers
+        """
         self.torrent = torrent
-        self.peer_id = _calculate_peer_id()
-        self.http_client = aiohttp.ClientSession()
+        self.peer_id = peer_id if peer_id else _calculate_peer_id()
+        self.port = port
+        self.http_client = http_client
+        self._owns_client = http_client is None
 
     async def connect(self,
-                      first: bool = None,
+                      event: str = None,
                       uploaded: int = 0,
-                      downloaded: int = 0):
+                      downloaded: int = 0,
+                      left: int = None,
+                      numwant: int = None):
         """
         Makes the announce call to the tracker to update with our statistics
         as well as get a list of available peers to connect to. --> Understood
@@ -30,24 +43,36 @@ class Tracker:
         If the call was successful, the list of peers will be updated as a
         result of calling this function. --> Pretty Clear
 
-        :param first: Whether or not this is the first announce call }--> Ok ok understanding
+        :param event: One of 'started', 'completed' or 'stopped', or None for
+                      a regular announce
         :param uploaded: The total number of bytes uploaded
         :param downloaded: The total number of bytes downloaded
+        :param left: The number of bytes still to download, defaults to what
+                     remains of the whole torrent after `downloaded`
+        :param numwant: The number of peers we ask for, or None for the
+                        tracker's default
         """
+        if left is None:
+            left = self.torrent.total_size - downloaded
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': self.port,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.total_size - downloaded,
+            'left': left,
             'compact': 1}
-        if first:
-            params['event'] = 'started'
+        if event:
+            params['event'] = event
+        if numwant is not None:
+            params['numwant'] = numwant
 
         url = self.torrent.announce + '?' + urlencode(params)
         logging.info('Connecting to tracker at: ' + url)
 
+        if self.http_client is None:
+            # Created lazily since aiohttp needs a running event loop
+            self.http_client = aiohttp.ClientSession()
         async with self.http_client.get(url) as response:
             if not response.status == 200:
                 raise ConnectionError('Unable to connect to tracker: status code {}'.format(response.status))
@@ -56,7 +81,10 @@ class Tracker:
             return TrackerResponse(bencoding.Decoder(data).decode()) #Tracker Response is what im learning rn!
 
     def close(self):
-        self.http_client.close()
+        # A shared client is closed by whoever handed it to us
+        if self._owns_client and self.http_client is not None:
+            asyncio.ensure_future(self.http_client.close())
+            self.http_client = None
 
     def raise_for_error(self, tracker_response):
         """
@@ -81,7 +109,7 @@ class Tracker:
         return {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': self.port,
             'uploaded': 0,
             'downloaded': 0,
             'left': 0,
@@ -135,6 +163,14 @@ class TrackerResponse:
         """
         return self.response.get(b'interval', 0)
 
+    @property
+    def min_interval(self) -> int:
+        """
+        The fewest seconds the client must wait before announcing again, or
+        None if the tracker doesn't say.
+        """
+        return self.response.get(b'min interval')
+
     @property
     def complete(self) -> int:
         """
@@ -157,7 +193,7 @@ class TrackerResponse:
         # The BitTorrent specification specifies two types of responses. One
         # where the peers field is a list of dictionaries and one where all
         # the peers are encoded in a single string
-        peers = self.response[b'peers']
+        peers = self.response.get(b'peers', b'')
         if type(peers) == list:
             # TODO Implement support for dictionary peer list
             logging.debug('Dictionary model peers are returned by tracker')
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import socket
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# The StreamReader buffer limit asyncio uses unless told otherwise
+DEFAULT_STREAM_LIMIT = 2 ** 16
+
+
+def new_event_loop(use_uvloop: bool = False):
+    """
+    Create a new event loop, running on uvloop when asked for and installed.
+    Falls back to the default asyncio event loop otherwise.
+    """
+    if use_uvloop:
+        if uvloop:
+            return uvloop.new_event_loop()
+        logging.warning('uvloop is not installed, using the default loop')
+    return asyncio.new_event_loop()
+
+
+class SocketOptions:
+    """
+    The tuning applied to peer sockets. Buffer sizes left as None keep the
+    operating system defaults.
+    """
+    def __init__(self, rcvbuf: int = None, sndbuf: int = None,
+                 nodelay: bool = False,
+                 stream_limit: int = DEFAULT_STREAM_LIMIT,
+                 read_size: int = 10 * 1024):
+        """
+        :param rcvbuf: The socket receive buffer size (SO_RCVBUF) in bytes
+        :param sndbuf: The socket send buffer size (SO_SNDBUF) in bytes
+        :param nodelay: Disable Nagle's algorithm (TCP_NODELAY) so small
+                        messages such as requests are sent right away
+        :param stream_limit: The number of bytes buffered by the StreamReader
+                             before it stops reading from the socket
+        :param read_size: The number of bytes to read from the stream at once
+        """
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.nodelay = nodelay
+        self.stream_limit = stream_limit
+        self.read_size = read_size
+
+    @classmethod
+    def tuned(cls):
+        """
+        Options suited for high bandwidth links.
+        """
+        return cls(rcvbuf=4 * 1024 * 1024, sndbuf=1024 * 1024, nodelay=True,
+                   stream_limit=1024 * 1024, read_size=64 * 1024)
+
+    def apply(self, sock: socket.socket):
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    async def open_connection(self, host, port):
+        """
+        Like `asyncio.open_connection` but with the options applied. The
+        buffer sizes are set before connecting since the TCP window scaling
+        is negotiated as part of the connect.
+        """
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        family, type_, proto, _, address = infos[0]
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setblocking(False)
+            self.apply(sock)
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        return await asyncio.open_connection(sock=sock,
+                                             limit=self.stream_limit)
+
+    async def start_server(self, client_connected_cb, host=None, port=None):
+        """
+        Like `asyncio.start_server` but with the options applied to every
+        accepted connection.
+        """
+        def _on_connected(reader, writer):
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                self.apply(sock)
+            return client_connected_cb(reader, writer)
+
+        server = await asyncio.start_server(_on_connected, host=host,
+                                            port=port,
+                                            limit=self.stream_limit)
+        # Accepted sockets inherit the buffer sizes of the listening socket
+        for sock in server.sockets:
+            self.apply(sock)
+        return server
@@ -0,0 +1,190 @@
+import aiohttp
+import asyncio
+import logging
+import os
+from urllib.parse import quote
+
+import bitstring
+
+from TorLord.protocol import REQUEST_SIZE
+
+# The number of requests kept in flight to a single web seed, each on a
+# pooled keep-alive connection
+WEBSEED_CONNECTIONS = 2
+
+# The most bytes asked for at once, as few range requests as the blocks
+# allow
+WEBSEED_RUN_SIZE = 4 * 1024 * 1024
+
+# Seconds to wait before asking a web seed again after a failed request, or
+# when there was nothing to ask it for
+WEBSEED_RETRY_INTERVAL = 30
+WEBSEED_IDLE_INTERVAL = 1
+
+# Web seeds failing this many requests in a row are given up on
+MAX_WEBSEED_FAILURES = 5
+
+
+class WebSeed:
+    """
+    An HTTP server holding the files of a torrent (BEP 19), downloaded from
+    like a peer having every piece: the blocks to fetch come from the same
+    picker as for the peers, and the data goes through the same hash check.
+
+    The blocks picked are merged into runs of contiguous data, each fetched
+    with range requests of the files it covers.
+    """
+    def __init__(self, url: str, torrent, piece_manager, http_client=None,
+                 connections: int = WEBSEED_CONNECTIONS, limiter=None,
+                 metrics=None):
+        """
+        :param url: The URL from the torrent's url-list
+        :param torrent: The torrent to download
+        :param piece_manager: The manager picking the blocks to request
+        :param http_client: The `aiohttp.ClientSession` to pool connections
+                            in, a web seed creates (and owns) its own when
+                            not given
+        :param connections: The number of requests kept in flight
+        :param limiter: The `TokenBucket` the data received is subject to
+        :param metrics: The `TorrentMetrics` to count the bytes received in
+        """
+        self.url = url
+        self.piece_manager = piece_manager
+        self.http_client = http_client
+        self._owns_client = http_client is None
+        self.connections = connections
+        self.limiter = limiter
+        self.metrics = metrics
+        self.piece_length = torrent.piece_length
+        self.urls = _file_urls(url, torrent)
+        self.failures = 0
+        self.tasks = []
+
+    @property
+    def peer_id(self) -> str:
+        # Stands in for the peer id of a wire peer with the piece manager
+        return self.url
+
+    def start(self):
+        if self._owns_client and self.http_client is None:
+            self.http_client = aiohttp.ClientSession()
+        bitfield = bitstring.BitArray(length=self.piece_manager.total_pieces)
+        bitfield.set(True)
+        self.piece_manager.add_peer(self.peer_id, bitfield)
+        self.tasks = [asyncio.ensure_future(self._run())
+                      for _ in range(self.connections)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.piece_manager.release_requests(self.peer_id)
+        self.piece_manager.remove_peer(self.peer_id)
+        if self._owns_client and self.http_client is not None:
+            asyncio.ensure_future(self.http_client.close())
+            self.http_client = None
+
+    async def _run(self):
+        manager = self.piece_manager
+        while not manager.complete:
+            if self.peer_id in manager.banned or \
+                    self.failures >= MAX_WEBSEED_FAILURES:
+                logging.warning('Giving up on web seed {url}'.format(
+                    url=self.url))
+                return
+            blocks = []
+            while len(blocks) * REQUEST_SIZE < WEBSEED_RUN_SIZE:
+                # The blocks of a run arrive together, however long the
+                # run takes, so they're only given back when it fails
+                block = manager.next_request(self.peer_id, expires=False)
+                if not block:
+                    break
+                blocks.append(block)
+            if not blocks:
+                await asyncio.sleep(WEBSEED_IDLE_INTERVAL)
+                continue
+
+            try:
+                for run in _runs(blocks, self.piece_length):
+                    await self._fetch(run)
+                self.failures = 0
+            except (aiohttp.ClientError, ConnectionError, ValueError,
+                    asyncio.TimeoutError) as e:
+                self.failures += 1
+                logging.warning('Web seed {url} failed: {error}'.format(
+                    url=self.url, error=e))
+                for block in blocks:
+                    manager.reject_request(self.peer_id, block.piece,
+                                           block.offset)
+                await asyncio.sleep(WEBSEED_RETRY_INTERVAL)
+
+    async def _fetch(self, run: [tuple]):
+        """
+        Fetch a run of contiguous blocks, given as (offset within the
+        torrent's data, block) tuples, and hand each block received to the
+        piece manager.
+        """
+        offset = run[0][0]
+        length = run[-1][0] + run[-1][1].length - offset
+        data = []
+        for index, file_offset, span in \
+                self.piece_manager.storage.spans(offset, length):
+            data.append(await self._get(self.urls[index], file_offset, span))
+        data = b''.join(data)
+        if self.limiter:
+            await self.limiter.consume(len(data))
+        if self.metrics:
+            self.metrics.bytes_in.inc(len(data))
+        for block_offset, block in run:
+            start = block_offset - offset
+            self.piece_manager.block_received(
+                self.peer_id, block.piece, block.offset,
+                data[start:start + block.length])
+
+    async def _get(self, url: str, offset: int, length: int) -> bytes:
+        headers = {'Range': 'bytes={start}-{end}'.format(
+            start=offset, end=offset + length - 1)}
+        async with self.http_client.get(url, headers=headers) as response:
+            if response.status == 206:
+                data = await response.read()
+            elif response.status == 200 and offset == 0:
+                # The server ignored the range, fine if it's what we asked for
+                data = (await response.read())[:length]
+            else:
+                raise ValueError('Unexpected status {status} for {url}'.format(
+                    status=response.status, url=url))
+        if len(data) != length:
+            raise ValueError('Got {got} bytes instead of {length}'.format(
+                got=len(data), length=length))
+        return data
+
+
+def _file_urls(url: str, torrent) -> [str]:
+    """
+    The URL of each file of the torrent. A URL ending with a slash is the
+    directory holding the torrent, any other URL is the single file itself.
+    """
+    name = quote(os.path.basename(torrent.output_file))
+    if not torrent.multi_file:
+        return [url + name if url.endswith('/') else url]
+    if not url.endswith('/'):
+        url += '/'
+    root = url + name + '/'
+    return [root + '/'.join(quote(part) for part in f.name.split(os.sep))
+            for f in torrent.files]
+
+
+def _runs(blocks, piece_length: int) -> [[tuple]]:
+    """
+    Group blocks into runs of contiguous data, each block given as a tuple
+    of (offset within the torrent's data, block).
+    """
+    runs = []
+    for offset, block in sorted(
+            ((b.piece * piece_length + b.offset, b) for b in blocks),
+            key=lambda run: run[0]):
+        if runs and runs[-1][-1][0] + runs[-1][-1][1].length == offset:
+            runs[-1].append((offset, block))
+        else:
+            runs.append([(offset, block)])
+    return runs
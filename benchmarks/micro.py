@@ -0,0 +1,310 @@
+"""
+Microbenchmarks for the hot primitives: the peer message codecs, the stream
+parser, bencoding and the piece picker of `PieceManager`.
+
+Results can be saved as a baseline and later runs compared against it, the
+run fails when any benchmark got slower than the allowed threshold.
+
+    python -m benchmarks.micro [--group GROUP ...] [--filter REGEX]
+                               [--save FILE] [--compare [FILE]]
+                               [--threshold 0.25]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+import bitstring
+
+from TorLord import bencoding
+from TorLord.availability import numpy
+from TorLord.client import PieceManager
+from TorLord.protocol import PeerStreamIterator, Handshake, KeepAlive, \
+    BitField, Interested, NotInterested, Choke, Unchoke, Have, Request, \
+    Piece, Cancel, REQUEST_SIZE
+from TorLord.torrent import TorrentFile
+
+# Where the baseline shipped with the repo is kept
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Each benchmark is repeated for at least this many seconds
+MIN_TIME = 0.5
+
+PICKER_SIZES = [1000, 100000, 1000000]
+PICKER_PEERS = 4
+
+
+def measure(fn, ops_per_call: int = 1, min_time: float = MIN_TIME,
+            max_calls: int = None) -> dict:
+    """
+    Call `fn` until `min_time` seconds have passed (or `max_calls` is
+    reached, whatever comes first) and return the rate it ran at.
+    """
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time and (max_calls is None or calls < max_calls):
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    ops = calls * ops_per_call
+    return {'ops_per_s': ops / elapsed, 'ns_per_op': 1e9 * elapsed / ops}
+
+
+def _messages():
+    """
+    One instance of every message that can be sent after the handshake.
+    """
+    return [KeepAlive(), Choke(), Unchoke(), Interested(), NotInterested(),
+            Have(1234), BitField(b'\xff' * 256),
+            Request(12, REQUEST_SIZE * 3), Piece(12, 0, b'\x00' * REQUEST_SIZE),
+            Cancel(12, REQUEST_SIZE * 3)]
+
+
+def bench_codec() -> dict:
+    results = OrderedDict()
+    handshake = Handshake(b'\x01' * 20, b'-TL0001-000000000000')
+    for message in [handshake] + _messages():
+        name = type(message).__name__
+        encoded = message.encode()
+        results['codec.encode.' + name] = measure(message.encode)
+        if 'decode' in type(message).__dict__:
+            results['codec.decode.' + name] = measure(
+                lambda: type(message).decode(encoded))
+        else:
+            # Messages without a payload are recognized by the parser alone
+            def parse():
+                PeerStreamIterator(None, encoded).parse()
+            results['codec.decode.' + name] = measure(parse)
+
+    # Requests are sent in batches, encoded into a single buffer
+    requests = [Request(12, offset * REQUEST_SIZE) for offset in range(16)]
+    buffer = bytearray(Request.size * len(requests))
+
+    def encode_into():
+        offset = 0
+        for request in requests:
+            offset = request.encode_into(buffer, offset)
+    results['codec.encode_into.Request'] = measure(
+        encode_into, ops_per_call=len(requests))
+    return results
+
+
+def bench_parse() -> dict:
+    # A stream dominated by blocks, as it is when downloading, interleaved
+    # with every other type of message
+    stream = []
+    for message in _messages():
+        stream.append(message.encode())
+        stream.extend([Piece(1, 0, b'\x00' * REQUEST_SIZE).encode()] * 4)
+    data = b''.join(stream)
+    count = len(_messages()) * 5
+
+    def parse():
+        iterator = PeerStreamIterator(None, data)
+        while iterator.parse():
+            pass
+    # A stream of small messages only, as exchanged when not downloading
+    # or with peers sending Have messages for every piece they complete
+    control = b''.join(m.encode() for m in [
+        Have(1234), Request(12, 0), Cancel(12, 0), Interested(),
+        Unchoke(), Have(1235), KeepAlive(), Request(12, REQUEST_SIZE)] * 16)
+
+    def parse_control():
+        iterator = PeerStreamIterator(None, control)
+        while iterator.parse():
+            pass
+    return {'parse.mixed_stream': measure(parse, ops_per_call=count),
+            'parse.control_stream': measure(parse_control,
+                                            ops_per_call=8 * 16)}
+
+
+def _metainfo_single_file(rnd) -> OrderedDict:
+    # Modelled after a Linux distribution ISO torrent: ~1.4 GB in 512 KB
+    # pieces
+    return OrderedDict([
+        (b'announce', b'http://torrent.ubuntu.com:6969/announce'),
+        (b'announce-list', [[b'http://torrent.ubuntu.com:6969/announce'],
+                            [b'http://ipv6.torrent.ubuntu.com:6969/announce']]),
+        (b'comment', b'Ubuntu CD releases.ubuntu.com'),
+        (b'creation date', 1461232732),
+        (b'info', OrderedDict([
+            (b'length', 1485881344),
+            (b'name', b'ubuntu-16.04-desktop-amd64.iso'),
+            (b'piece length', 524288),
+            (b'pieces', bytes(rnd.getrandbits(8)
+                              for _ in range(2835 * 20)))]))])
+
+
+def _metainfo_multi_file(rnd) -> OrderedDict:
+    # Modelled after a music collection: many small files in directories
+    files = [OrderedDict([(b'length', rnd.randint(10 ** 5, 10 ** 7)),
+                          (b'path', [('artist %d' % (i // 10)).encode(),
+                                     ('track %d.mp3' % i).encode()])])
+             for i in range(1000)]
+    total = sum(f[b'length'] for f in files)
+    pieces = (total + 2 ** 20 - 1) // 2 ** 20
+    return OrderedDict([
+        (b'announce', b'http://bt.example.com/announce'),
+        (b'creation date', 1457740800),
+        (b'info', OrderedDict([
+            (b'files', files),
+            (b'name', b'Showcasing Artists'),
+            (b'piece length', 2 ** 20),
+            (b'pieces', bytes(rnd.getrandbits(8)
+                              for _ in range(pieces * 20)))]))])
+
+
+def bench_bencoding() -> dict:
+    results = OrderedDict()
+    rnd = random.Random(42)
+    for name, meta_info in [('single_file', _metainfo_single_file(rnd)),
+                            ('multi_file', _metainfo_multi_file(rnd))]:
+        data = bytes(bencoding.Encoder(meta_info).encode())
+        results['bencoding.decode.' + name] = measure(
+            lambda: bencoding.Decoder(data).decode())
+        results['bencoding.encode.' + name] = measure(
+            lambda: bencoding.Encoder(meta_info).encode())
+    return results
+
+
+class _SyntheticTorrent:
+    """
+    Just enough of a torrent for `PieceManager`, where every piece is a
+    single block of zeros.
+    """
+    def __init__(self, pieces: int, directory: str):
+        self.piece_length = REQUEST_SIZE
+        self.total_size = pieces * REQUEST_SIZE
+        self.pieces = [sha1(b'\x00' * REQUEST_SIZE).digest()] * pieces
+        self.info_hash = b'\x00' * 20
+        self.output_file = os.path.join(directory, 'synthetic')
+        self.multi_file = False
+        self.files = [TorrentFile('synthetic', self.total_size)]
+
+
+def bench_picker(sizes=None) -> dict:
+    """
+    The pure Python picker, and the NumPy backed one when installed.
+    """
+    results = OrderedDict()
+    for size in sizes if sizes else PICKER_SIZES:
+        results.update(_bench_picker(size, 'picker', vectorized=False))
+        if numpy is not None:
+            results.update(_bench_picker(size, 'picker.numpy',
+                                         vectorized=True))
+    return results
+
+
+def _bench_picker(size: int, prefix: str, vectorized: bool) -> dict:
+    results = OrderedDict()
+    block = b'\x00' * REQUEST_SIZE
+    with tempfile.TemporaryDirectory() as directory:
+        manager = PieceManager(_SyntheticTorrent(size, directory))
+        if not vectorized:
+            manager.availability = None
+            manager._wanted = None
+        rnd = random.Random(size)
+        for peer in range(PICKER_PEERS):
+            # Peers have about 3/4 of all pieces
+            bits = bitstring.BitArray(
+                uint=rnd.getrandbits(size) | rnd.getrandbits(size),
+                length=size)
+            manager.add_peer(peer, bits)
+
+        requested = []
+
+        def next_request():
+            peer = len(requested) % PICKER_PEERS
+            block_ = manager.next_request(peer)
+            if block_:
+                requested.append((peer, block_))
+
+        def block_received():
+            peer, block_ = requested.pop()
+            manager.block_received(peer, block_.piece, block_.offset, block)
+
+        results['%s.next_request.%d' % (prefix, size)] = measure(
+            next_request, max_calls=size)
+        results['%s.block_received.%d' % (prefix, size)] = measure(
+            block_received, max_calls=len(requested))
+        manager.close()
+    return results
+
+
+BENCHMARKS = OrderedDict([('codec', bench_codec),
+                          ('parse', bench_parse),
+                          ('bencoding', bench_bencoding),
+                          ('picker', bench_picker)])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> [str]:
+    """
+    Compare the results with the baseline.
+
+    :return: The names of the benchmarks slower than the baseline by more
+             than the threshold (a fraction, e.g. 0.25 for 25%)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['ops_per_s'] / baseline[name]['ops_per_s']
+        print('{name:45} {ops:14.0f} ops/s {ratio:7.2f}x'.format(
+            name=name, ops=result['ops_per_s'], ratio=ratio))
+        if ratio < 1 - threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--group', choices=list(BENCHMARKS), nargs='+',
+                        default=list(BENCHMARKS),
+                        help='only run these groups of benchmarks')
+    parser.add_argument('--filter', default='.*',
+                        help='only report benchmarks with a matching name')
+    parser.add_argument('--picker-sizes', type=int, nargs='+',
+                        default=PICKER_SIZES,
+                        help='the number of pieces for the picker benchmarks')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as the baseline in FILE')
+    parser.add_argument('--compare', metavar='FILE', nargs='?',
+                        const=BASELINE,
+                        help='compare against the baseline in FILE')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='the slowdown allowed when comparing')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = OrderedDict()
+    for group in args.group:
+        fn = BENCHMARKS[group]
+        group_results = fn(args.picker_sizes) if group == 'picker' else fn()
+        for name, result in group_results.items():
+            if re.search(args.filter, name):
+                results[name] = result
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('Slower than the baseline: ' + ', '.join(regressions))
+            sys.exit(1)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Loopback benchmark comparing the default and the tuned peer socket settings,
+measuring the throughput of a stream of Piece messages together with the lag
+of the event loop while receiving them.
+
+    python -m benchmarks.socket_tuning [--size MB] [--uvloop]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from TorLord.protocol import PeerStreamIterator, Piece, REQUEST_SIZE
+from TorLord.tuning import SocketOptions, new_event_loop
+
+LAG_INTERVAL = 0.001
+
+
+async def _serve(size, reader, writer):
+    block = Piece(0, 0, b'\x00' * REQUEST_SIZE).encode()
+    for _ in range(size // REQUEST_SIZE):
+        writer.write(block)
+        await writer.drain()
+    writer.close()
+
+
+async def _sample_lag(samples):
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(loop.time() - expected, 0))
+
+
+async def _run(options: SocketOptions, size: int):
+    server = await options.start_server(
+        lambda r, w: _serve(size, r, w), host='127.0.0.1', port=0)
+    port = server.sockets[0].getsockname()[1]
+
+    samples = []
+    sampler = asyncio.ensure_future(_sample_lag(samples))
+    start = time.monotonic()
+    reader, writer = await options.open_connection('127.0.0.1', port)
+    received = 0
+    async for message in PeerStreamIterator(
+            reader, chunk_size=options.read_size):
+        received += len(message.block)
+        if received >= size:
+            break
+    elapsed = time.monotonic() - start
+    sampler.cancel()
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+    return {
+        'mb_per_s': received / elapsed / 2 ** 20,
+        'lag_mean_ms': 1000 * sum(samples) / max(len(samples), 1),
+        'lag_max_ms': 1000 * max(samples, default=0),
+    }
+
+
+def run(size: int, use_uvloop: bool = False) -> [dict]:
+    results = []
+    for name, options in [('default', SocketOptions()),
+                          ('tuned', SocketOptions.tuned())]:
+        loop = new_event_loop(use_uvloop)
+        try:
+            result = loop.run_until_complete(_run(options, size))
+        finally:
+            loop.close()
+        result['settings'] = name
+        result['loop'] = type(loop).__module__.split('.')[0]
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256,
+                        help='the number of MB to transfer per setting')
+    parser.add_argument('--uvloop', action='store_true',
+                        help='run on uvloop, when installed')
+    args = parser.parse_args()
+    print(json.dumps(run(args.size * 2 ** 20, args.uvloop), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+End-to-end benchmark downloading a synthetic torrent with `TorrentClient` from
+a swarm of local seeders, announced by a local HTTP tracker. The seeders and
+the tracker run in a separate process so the numbers reported only cover the
+client: throughput, CPU time per GB, peak RSS and the time to completion.
+
+    python -m benchmarks.swarm [--size MB] [--seeders N] [--workers N]
+                               [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import mmap
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+from TorLord import bencoding
+from TorLord.client import TorrentClient
+from TorLord.sharding import ShardedClient
+from TorLord.torrent import Torrent
+from TorLord.tuning import SocketOptions, new_event_loop
+from tests.swarm import Seeder, LocalTracker, create_content, write_torrent
+
+
+async def _run_swarm(data, piece_length, info_hash, seeders, conn):
+    peers = [Seeder(data, piece_length, info_hash,
+                    peer_id=('-SD0001-%012d' % i).encode('utf-8'))
+             for i in range(seeders)]
+    for peer in peers:
+        await peer.start()
+    tracker = LocalTracker([peer.address for peer in peers])
+    await tracker.start()
+    conn.send(tracker.announce)
+
+    # Serve until the parent tells us to stop
+    await asyncio.get_event_loop().run_in_executor(None, conn.recv)
+    for peer in peers:
+        peer.close()
+    await tracker.close()
+
+
+def _swarm_process(data_path, piece_length, info_hash, seeders, conn):
+    with open(data_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        asyncio.run(_run_swarm(data, piece_length, info_hash, seeders, conn))
+
+
+async def _download(torrent_path, download_dir, socket_options):
+    client = TorrentClient(Torrent(torrent_path),
+                           socket_options=socket_options,
+                           download_dir=download_dir)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    task = asyncio.ensure_future(client.start())
+    try:
+        while not client.piece_manager.complete:
+            if task.done():
+                task.result()  # Raises whatever made the client stop
+                raise RuntimeError('Client stopped before completing')
+            await asyncio.sleep(0.01)
+        elapsed = time.monotonic() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        client.stop()
+        task.cancel()
+        if client.stopped_announce:
+            await client.stopped_announce
+        # Let the peers and the tracker client finish closing
+        pending = [t for t in asyncio.all_tasks()
+                   if t is not asyncio.current_task()]
+        if pending:
+            await asyncio.wait(pending, timeout=1)
+
+    cpu = (after.ru_utime - before.ru_utime) + \
+        (after.ru_stime - before.ru_stime)
+    return elapsed, cpu, after.ru_maxrss
+
+
+async def _download_sharded(torrent_path, download_dir, socket_options,
+                            workers, use_uvloop):
+    client = ShardedClient(torrent_path, workers, download_dir=download_dir,
+                           socket_options=socket_options,
+                           use_uvloop=use_uvloop)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    client.start()
+    try:
+        # The workers exit once their share of the pieces is downloaded
+        await client.wait()
+        if not client.complete:
+            raise RuntimeError('Workers stopped before completing')
+        elapsed = time.monotonic() - start
+    finally:
+        client.stop()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    # Only the workers have exited, and are accounted for, so far
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (after.ru_utime - before.ru_utime) + \
+        (after.ru_stime - before.ru_stime) + \
+        children.ru_utime + children.ru_stime
+    return elapsed, cpu, max(after.ru_maxrss, children.ru_maxrss)
+
+
+def run(size: int, piece_length: int = 2 ** 18, seeders: int = 4,
+        use_uvloop: bool = False, tuned: bool = False,
+        workers: int = 1) -> dict:
+    """
+    Run a single download of `size` bytes from the local swarm, by a single
+    client or by `workers` processes when more than one.
+
+    :return: The results as a dict ready to be serialized as JSON
+    """
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        data_path, info = create_content(directory, size, piece_length)
+        info_hash = sha1(bencoding.Encoder(info).encode()).digest()
+
+        conn, child_conn = context.Pipe()
+        swarm = context.Process(target=_swarm_process,
+                                args=(data_path, piece_length, info_hash,
+                                      seeders, child_conn),
+                                daemon=True)
+        swarm.start()
+        try:
+            torrent_path = write_torrent(directory, info, conn.recv())
+            download_dir = os.path.join(directory, 'download')
+            os.mkdir(download_dir)
+
+            socket_options = SocketOptions.tuned() if tuned else None
+            loop = new_event_loop(use_uvloop)
+            try:
+                if workers > 1:
+                    download = _download_sharded(
+                        torrent_path, download_dir, socket_options,
+                        workers, use_uvloop)
+                else:
+                    download = _download(torrent_path, download_dir,
+                                         socket_options)
+                elapsed, cpu, max_rss = loop.run_until_complete(download)
+            finally:
+                loop.close()
+        finally:
+            conn.send('stop')
+            swarm.join(5)
+            if swarm.is_alive():
+                swarm.terminate()
+
+    return {
+        'size_mb': size / 2 ** 20,
+        'piece_length': piece_length,
+        'seeders': seeders,
+        'loop': 'uvloop' if use_uvloop else 'asyncio',
+        'tuned': tuned,
+        'workers': workers,
+        'seconds': elapsed,
+        'mb_per_s': size / 2 ** 20 / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / (size / 2 ** 30),
+        # ru_maxrss is reported in kilobytes on Linux, of the largest
+        # process when running several workers
+        'peak_rss_mb': max_rss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=128,
+                        help='the size of the torrent in MB')
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help='the piece length in KB')
+    parser.add_argument('--seeders', type=int, default=4,
+                        help='the number of local seeders')
+    parser.add_argument('--uvloop', action='store_true',
+                        help='run the client on uvloop, when installed')
+    parser.add_argument('--tuned', action='store_true',
+                        help='use the tuned peer socket options')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='download with this many worker processes')
+    parser.add_argument('--output',
+                        help='write the JSON results to this file as well')
+    args = parser.parse_args()
+
+    result = run(args.size * 2 ** 20, args.piece_length * 1024,
+                 args.seeders, args.uvloop, args.tuned, args.workers)
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
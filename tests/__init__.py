@@ -1,4 +1,9 @@
 import logging
+import os
+import tempfile
+from hashlib import sha1
+
+from TorLord.torrent import TorrentFile
 
 
 class NoLogging:
@@ -13,6 +18,36 @@ class NoLogging:
 
 no_logging = NoLogging()
 
+
+class FakeTorrent:
+    """
+    Stands in for `Torrent` without the need of a .torrent file on disk. The
+    content is written to a file within a temporary directory.
+    """
+    def __init__(self, data: bytes, piece_length: int = 2 ** 15,
+                 name: str = 'fake', files: [int] = None):
+        """
+        :param files: The lengths of the files the data is split into, for a
+                      multi-file torrent
+        """
+        self.data = data
+        self.piece_length = piece_length
+        self.total_size = len(data)
+        self.pieces = [sha1(data[i:i + piece_length]).digest()
+                       for i in range(0, len(data), piece_length)]
+        self.info_hash = sha1(name.encode('utf-8') + data).digest()
+        self.announce = 'http://127.0.0.1:9/announce'
+        self.url_list = []
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_file = os.path.join(self.directory.name, name)
+        self.multi_file = files is not None
+        if self.multi_file:
+            self.files = [TorrentFile('file{index}'.format(index=index),
+                                      length)
+                          for index, length in enumerate(files)]
+        else:
+            self.files = [TorrentFile(name, len(data))]
+
 if __name__ == '__main__':
     import unittest
 
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import socket
+import struct
+from collections import OrderedDict
+from hashlib import sha1
+
+from aiohttp import web
+
+from TorLord import bencoding
+from TorLord.protocol import Handshake, BitField, Unchoke, Request, Piece, \
+    PeerStreamIterator
+
+
+class Seeder:
+    """
+    A stand-in for a remote peer that has every piece of the torrent and
+    serves every block requested from it.
+    """
+    def __init__(self, data, piece_length: int, info_hash: bytes,
+                 peer_id: bytes = b'-SD0001-000000000000'):
+        """
+        :param data: The torrent content, any object supporting slicing such
+                     as bytes or a mmap
+        :param piece_length: The length of each piece
+        :param info_hash: The info hash of the torrent to seed
+        :param peer_id: The peer id to respond with in the handshake
+        """
+        self.data = data
+        self.piece_length = piece_length
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.server = None
+        pieces = (len(data) + piece_length - 1) // piece_length
+        bitfield = bytearray((pieces + 7) // 8)
+        for index in range(pieces):
+            bitfield[index // 8] |= 128 >> (index % 8)
+        self.bitfield = bytes(bitfield)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            handshake = Handshake.decode(
+                await reader.readexactly(Handshake.length))
+            if not handshake or handshake.info_hash != self.info_hash:
+                return
+            writer.write(Handshake(self.info_hash, self.peer_id).encode())
+            writer.write(BitField(self.bitfield).encode())
+            writer.write(Unchoke().encode())
+            async for message in PeerStreamIterator(reader):
+                if type(message) is Request:
+                    start = message.index * self.piece_length + message.begin
+                    writer.write(Piece(message.index, message.begin,
+                                       self.data[start:start + message.length])
+                                 .encode())
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class LocalTracker:
+    """
+    A stand-in for an HTTP tracker handing out the same (compact) list of
+    peers to everyone announcing. Every announce is kept in `announces`.
+    """
+    def __init__(self, peers: [tuple], interval: int = 1800,
+                 min_interval: int = None):
+        self.peers = peers
+        self.interval = interval
+        self.min_interval = min_interval
+        self.announces = []
+        self.runner = None
+        self.port = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_get('/announce', self._announce)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    @property
+    def announce(self) -> str:
+        return 'http://127.0.0.1:{port}/announce'.format(port=self.port)
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def _announce(self, request):
+        self.announces.append(dict(request.query))
+        peers = b''.join([socket.inet_aton(ip) + struct.pack('>H', port)
+                          for ip, port in self.peers])
+        response = OrderedDict([(b'complete', len(self.peers)),
+                                (b'incomplete', 0),
+                                (b'interval', self.interval),
+                                (b'peers', peers)])
+        if self.min_interval is not None:
+            response[b'min interval'] = self.min_interval
+        return web.Response(body=bytes(bencoding.Encoder(response).encode()))
+
+
+def create_content(directory: str, size: int, piece_length: int,
+                   name: str = 'payload'):
+    """
+    Write `size` random bytes to a file and build the matching info dict.
+
+    :return: A tuple of (path to the content, info dict)
+    """
+    path = os.path.join(directory, name)
+    hashes = []
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            piece = os.urandom(min(piece_length, remaining))
+            f.write(piece)
+            hashes.append(sha1(piece).digest())
+            remaining -= len(piece)
+    info = OrderedDict([(b'length', size),
+                        (b'name', name.encode('utf-8')),
+                        (b'piece length', piece_length),
+                        (b'pieces', b''.join(hashes))])
+    return path, info
+
+
+def write_torrent(directory: str, info: dict, announce: str) -> str:
+    path = os.path.join(directory, info[b'name'].decode('utf-8') + '.torrent')
+    meta_info = OrderedDict([(b'announce', announce.encode('utf-8')),
+                             (b'info', info)])
+    with open(path, 'wb') as f:
+        f.write(bencoding.Encoder(meta_info).encode())
+    return path
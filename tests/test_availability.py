@@ -0,0 +1,66 @@
+import os
+import random
+import unittest
+
+import bitstring
+
+from . import FakeTorrent
+from TorLord.availability import Availability, numpy
+from TorLord.client import PieceManager
+from TorLord.protocol import REQUEST_SIZE
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class AvailabilityTests(unittest.TestCase):
+    def setUp(self):
+        self.availability = Availability(10, capacity=1)
+        self.availability.add('a', bitstring.BitArray('0b1100000011').tobytes())
+        self.availability.add('b', bitstring.BitArray('0b0100000001').tobytes())
+
+    def test_counts(self):
+        self.assertEqual([1, 2, 0, 0, 0, 0, 0, 0, 1, 2],
+                         self.availability.counts.tolist())
+
+    def test_have_and_remove(self):
+        self.availability.have('b', 2)
+        self.availability.have('b', 2)
+        self.availability.remove('a')
+        self.assertEqual([0, 1, 1, 0, 0, 0, 0, 0, 0, 1],
+                         self.availability.counts.tolist())
+
+    def test_spare_bits_ignored(self):
+        self.availability.add('c', b'\xff\xff')
+        self.assertEqual(16, int(self.availability.counts.sum()))
+
+    def test_rarest(self):
+        wanted = self.availability.mask([1, 8, 9])
+        self.assertEqual(8, self.availability.rarest('a', wanted))
+        self.assertEqual(1, self.availability.first('a', wanted))
+        self.assertIsNone(self.availability.rarest(
+            'b', self.availability.mask([0, 8])))
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class VectorizedPickerTests(unittest.TestCase):
+    def test_same_order_as_pure_python(self):
+        torrent = FakeTorrent(os.urandom(64 * REQUEST_SIZE), REQUEST_SIZE)
+        managers = [PieceManager(torrent), PieceManager(torrent)]
+        managers[1].availability = None
+        managers[1]._wanted = None
+        rnd = random.Random(1)
+        for peer in range(4):
+            bitfield = bitstring.BitArray(uint=rnd.getrandbits(64),
+                                          length=64)
+            for manager in managers:
+                manager.add_peer(peer, bitstring.BitArray(bitfield))
+        for manager in managers:
+            manager.update_peer(0, 63)
+
+        picked = [[manager.next_request(peer % 4) for peer in range(40)]
+                  for manager in managers]
+        for manager in managers:
+            manager.close()
+        self.assertEqual([(b.piece, b.offset) if b else None
+                          for b in picked[1]],
+                         [(b.piece, b.offset) if b else None
+                          for b in picked[0]])
@@ -0,0 +1,65 @@
+import unittest
+from collections import OrderedDict
+
+from TorLord.bencoding import Decoder, Encoder
+
+
+class DecodingTests(unittest.TestCase):
+    def test_not_bytes(self):
+        with self.assertRaises(TypeError):
+            Decoder('i123e')
+
+    def test_empty(self):
+        with self.assertRaises(EOFError):
+            Decoder(b'').decode()
+
+    def test_integer(self):
+        self.assertEqual(123, Decoder(b'i123e').decode())
+
+    def test_string(self):
+        self.assertEqual(b'name', Decoder(b'4:name').decode())
+
+    def test_empty_string(self):
+        self.assertEqual(b'', Decoder(b'0:').decode())
+
+    def test_list(self):
+        self.assertEqual([b'spam', b'eggs', 123],
+                         Decoder(b'l4:spam4:eggsi123ee').decode())
+
+    def test_dict(self):
+        self.assertEqual(
+            OrderedDict([(b'cow', b'moo'), (b'spam', b'eggs')]),
+            Decoder(b'd3:cow3:moo4:spam4:eggse').decode())
+
+    def test_nested(self):
+        self.assertEqual(
+            OrderedDict([(b'files', [OrderedDict([(b'length', 5)])])]),
+            Decoder(b'd5:filesld6:lengthi5eeee').decode())
+
+
+class EncodingTests(unittest.TestCase):
+    def test_integer(self):
+        self.assertEqual(b'i123e', Encoder(123).encode())
+
+    def test_string(self):
+        self.assertEqual(b'4:name', Encoder('name').encode())
+
+    def test_bytes(self):
+        self.assertEqual(b'4:\x00\x01\x02\x03',
+                         Encoder(b'\x00\x01\x02\x03').encode())
+
+    def test_list(self):
+        self.assertEqual(b'l4:spam4:eggsi123ee',
+                         Encoder(['spam', 'eggs', 123]).encode())
+
+    def test_dict(self):
+        self.assertEqual(b'd3:cow3:moo4:spam4:eggse',
+                         Encoder(OrderedDict([('cow', 'moo'),
+                                              ('spam', 'eggs')])).encode())
+
+    def test_round_trip(self):
+        data = OrderedDict([(b'announce', b'http://localhost/announce'),
+                            (b'info', OrderedDict([(b'length', 1024),
+                                                   (b'name', b'file')]))])
+        self.assertEqual(data, Decoder(bytes(Encoder(data).encode()))
+                         .decode())
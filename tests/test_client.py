@@ -1,7 +1,20 @@
+import asyncio
+import os
+import time
 import unittest
 
-from . import no_logging
-from TorLord.client import Piece, Block
+import bitstring
+
+from . import no_logging, FakeTorrent
+from .swarm import Seeder, LocalTracker
+from TorLord.client import Piece, Block, PieceManager, RequestTimer, \
+    TorrentClient, MIN_REQUEST_TIMEOUT, PRIORITY_SKIP, PRIORITY_LOW, \
+    PRIORITY_NORMAL, PRIORITY_HIGH
+from TorLord.picker import Sequential, Deadline
+from TorLord import protocol
+from TorLord.protocol import REQUEST_SIZE, Handshake, BitField, Unchoke, \
+    Cancel, PeerStreamIterator
+from TorLord.tracker import Tracker
 
 
 class PieceTests(unittest.TestCase):
@@ -35,4 +48,467 @@ class PieceTests(unittest.TestCase):
         self.assertEqual(1, len([b for b in p.blocks
                                 if b.status is Block.Retrieved]))
         self.assertEqual(9, len([b for b in p.blocks
-                                if b.status is Block.Missing]))
\ No newline at end of file
+                                if b.status is Block.Missing]))
+
+class RequestTimerTests(unittest.TestCase):
+    def test_converges_to_rtt(self):
+        timer = RequestTimer()
+        for _ in range(50):
+            timer.update(2)
+        self.assertAlmostEqual(2, timer.timeout, places=2)
+
+    def test_bounded_below(self):
+        timer = RequestTimer()
+        timer.update(0.001)
+        self.assertEqual(MIN_REQUEST_TIMEOUT, timer.timeout)
+
+    def test_backoff(self):
+        timer = RequestTimer()
+        timer.update(2)
+        timeout = timer.timeout
+        timer.backoff()
+        self.assertEqual(2 * timeout, timer.timeout)
+
+
+class RequestExpiryTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE),
+                                   4 * REQUEST_SIZE)
+        self.manager = PieceManager(self.torrent)
+        self.manager.add_peer('slow', bitstring.BitArray('0b1'))
+        self.manager.add_peer('fast', bitstring.BitArray('0b1'))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_expired_block_requested_again(self):
+        self.manager._timer('slow').timeout = 0.01
+        block = self.manager.next_request('slow')
+        time.sleep(0.02)
+
+        with no_logging:
+            self.assertIs(block, self.manager.next_request('fast'))
+        self.assertEqual(1, block.retries)
+        # The slow peer is given more time from now on
+        self.assertEqual(0.02, self.manager.request_timeout('slow'))
+
+    def test_backoff_once_per_peer(self):
+        self.manager._timer('slow').timeout = 0.01
+        for _ in range(3):
+            self.manager.next_request('slow')
+        time.sleep(0.02)
+
+        with no_logging:
+            self.manager.next_request('fast')
+        self.assertEqual(0.02, self.manager.request_timeout('slow'))
+
+    def test_unexpiring_request_kept(self):
+        # Like a web seed's, the block is pending till received or released
+        self.manager._timer('slow').timeout = 0.01
+        block = self.manager.next_request('slow', expires=False)
+        time.sleep(0.02)
+
+        self.assertIsNot(block, self.manager.next_request('fast'))
+        self.assertEqual(0, block.retries)
+        self.assertEqual('slow', self.manager.pending_blocks[
+            (block.piece, block.offset)].peer_id)
+        self.assertEqual(0.01, self.manager.request_timeout('slow'))
+
+        self.manager.reject_request('slow', block.piece, block.offset)
+        self.assertIs(block, self.manager.next_request('fast'))
+
+    def test_pending_block_not_requested_twice(self):
+        block = self.manager.next_request('slow')
+        self.assertIsNot(block, self.manager.next_request('fast'))
+
+    def test_rtt_measured_per_peer(self):
+        block = self.manager.next_request('fast')
+        data = self.torrent.data[block.offset:block.offset + block.length]
+        with no_logging:
+            self.manager.block_received('fast', block.piece, block.offset,
+                                        data)
+        self.assertEqual(MIN_REQUEST_TIMEOUT,
+                         self.manager.request_timeout('fast'))
+        self.assertNotIn((block.piece, block.offset),
+                         self.manager.pending_blocks)
+
+
+class SilentSeeder(Seeder):
+    """
+    Unchokes, then never sends a block. Every message received is kept.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+
+    async def _serve(self, reader, writer):
+        try:
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(self.info_hash, self.peer_id).encode())
+            writer.write(BitField(self.bitfield).encode())
+            writer.write(Unchoke().encode())
+            async for message in PeerStreamIterator(reader):
+                self.received.append(message)
+        finally:
+            writer.close()
+
+
+class SnubTests(unittest.IsolatedAsyncioTestCase):
+    async def test_snubbed_peer_released(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE))
+        seeder = SilentSeeder(torrent.data, torrent.piece_length,
+                              torrent.info_hash)
+        await seeder.start()
+        client = TorrentClient(torrent, tracker=Tracker(torrent))
+        client.snub_timeout = 0
+        client.available_peers.put_nowait(seeder.address)
+        with no_logging:
+            peer = client._new_peer()
+            client.peers = [peer]
+            try:
+                while 'pending_request' not in peer.my_state:
+                    await asyncio.sleep(0.01)
+                client._check_snubbed()
+                self.assertTrue(peer.snubbed)
+                self.assertEqual({}, client.piece_manager.pending_blocks)
+                while not seeder.received or \
+                        type(seeder.received[-1]) is not Cancel:
+                    await asyncio.sleep(0.01)
+
+                # A block sent before the cancel arrives late
+                peer._on_piece(protocol.Piece(0, 0,
+                                              torrent.data[:REQUEST_SIZE]))
+                self.assertTrue(peer.snubbed)
+
+                # Given another chance, the peer is asked for a block again
+                client._last_unsnub -= 60
+                client._check_snubbed()
+                self.assertFalse(peer.snubbed)
+                await asyncio.sleep(0.05)
+                self.assertIn('pending_request', peer.my_state)
+            finally:
+                client.stop()
+                seeder.close()
+
+
+class WorkerTests(unittest.IsolatedAsyncioTestCase):
+    async def test_next_peer_after_failed_connect(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE)
+        seeder = Seeder(torrent.data, torrent.piece_length, torrent.info_hash)
+        await seeder.start()
+        client = TorrentClient(torrent, tracker=Tracker(torrent),
+                               max_peer_connections=2)
+        # Nothing listens on these, each worker fails to connect first
+        client.add_peer(('127.0.0.1', 9))
+        client.add_peer(('127.0.0.1', 10))
+        client.add_peer(seeder.address)
+        with no_logging:
+            client.peers = [client._new_peer() for _ in range(2)]
+            try:
+                await asyncio.wait_for(self._complete(client), 5)
+            finally:
+                client.stop()
+                seeder.close()
+
+    async def _complete(self, client):
+        while not client.piece_manager.complete:
+            await asyncio.sleep(0.01)
+
+
+class BanTests(unittest.IsolatedAsyncioTestCase):
+    async def test_banned_peer_disconnected(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE))
+        seeder = SilentSeeder(torrent.data, torrent.piece_length,
+                              torrent.info_hash)
+        await seeder.start()
+        client = TorrentClient(torrent, tracker=Tracker(torrent))
+        client.available_peers.put_nowait(seeder.address)
+        closed = []
+        with no_logging:
+            peer = client._new_peer()
+            peer.on_close = closed.append
+            client.peers = [peer]
+            try:
+                while not peer.connected:
+                    await asyncio.sleep(0.01)
+                client.piece_manager.on_ban(peer.remote_id)
+                await asyncio.wait([peer.future], timeout=5)
+                self.assertTrue(peer.future.done())
+                self.assertTrue(peer.writer.is_closing())
+                self.assertFalse(peer.connected)
+                self.assertEqual([peer], closed)
+                self.assertIn('127.0.0.1', client.banned_ips)
+            finally:
+                client.stop()
+                seeder.close()
+
+
+class AnnounceTests(unittest.IsolatedAsyncioTestCase):
+    async def _start(self, peers, **kwargs):
+        self.tracker = LocalTracker(peers, **kwargs)
+        await self.tracker.start()
+        self.torrent.announce = self.tracker.announce
+        self.client = TorrentClient(self.torrent,
+                                    tracker=Tracker(self.torrent),
+                                    max_peer_connections=4)
+        self.task = asyncio.ensure_future(self.client.start())
+
+    async def _stop(self):
+        self.client.stop()
+        await asyncio.wait_for(self.task, 5)
+        await self.client.stopped_announce
+        await self.tracker.close()
+
+    async def test_lifecycle_events(self):
+        self.torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE),
+                                   REQUEST_SIZE)
+        seeder = Seeder(self.torrent.data, self.torrent.piece_length,
+                        self.torrent.info_hash)
+        await seeder.start()
+        with no_logging:
+            await self._start([seeder.address])
+            try:
+                # The client stops once it has downloaded everything
+                await asyncio.wait_for(self.task, 5)
+            finally:
+                await self._stop()
+                seeder.close()
+        announces = self.tracker.announces
+        self.assertEqual(['started', 'completed', 'stopped'],
+                         [a['event'] for a in announces])
+        self.assertEqual(['4', '3', '0'], [a['numwant'] for a in announces])
+        self.assertEqual([str(4 * REQUEST_SIZE), '0', '0'],
+                         [a['left'] for a in announces])
+        self.assertEqual(str(4 * REQUEST_SIZE), announces[-1]['downloaded'])
+
+    async def test_reannounce_when_starving(self):
+        self.torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE),
+                                   REQUEST_SIZE)
+        seeder = Seeder(self.torrent.data, self.torrent.piece_length,
+                        self.torrent.info_hash)
+        await seeder.start()
+        with no_logging:
+            # A peer that can't be connected to, the client asks for more
+            # as soon as the minimum interval allows
+            await self._start([('127.0.0.1', 9)], min_interval=1)
+            try:
+                while not self.tracker.announces:
+                    await asyncio.sleep(0.01)
+                # Only handed out by the announce made when starving, and
+                # dialed by the workers left
+                self.tracker.peers = [seeder.address]
+                await asyncio.wait_for(self.task, 5)
+            finally:
+                await self._stop()
+                seeder.close()
+        events = [a.get('event') for a in self.tracker.announces]
+        self.assertEqual(['started', None, 'completed', 'stopped'], events)
+
+
+class HashFailureTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = FakeTorrent(os.urandom(2 * REQUEST_SIZE),
+                                   2 * REQUEST_SIZE)
+        self.manager = PieceManager(self.torrent)
+        self.banned = []
+        self.manager.on_ban = self.banned.append
+        for peer in ('good', 'bad'):
+            self.manager.add_peer(peer, bitstring.BitArray('0b1'))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def _receive(self, peer, corrupt=False):
+        block = self.manager.next_request(peer)
+        data = self.torrent.data[block.offset:block.offset + block.length]
+        if corrupt:
+            data = b'\x00' * len(data)
+        with no_logging:
+            self.manager.block_received(peer, block.piece, block.offset, data)
+        return block
+
+    def test_single_source_banned(self):
+        self._receive('bad', corrupt=True)
+        self._receive('bad', corrupt=True)
+        self.assertEqual(['bad'], self.banned)
+        self.assertIsNone(self.manager.next_request('bad'))
+
+    def test_culprit_found_on_retry(self):
+        self._receive('good')
+        self._receive('bad', corrupt=True)
+        self.assertEqual([], self.banned)
+
+        # The piece is downloaded again, but not from the suspects while
+        # another peer has it
+        self.manager.add_peer('other', bitstring.BitArray('0b1'))
+        self.assertIsNone(self.manager.next_request('bad'))
+        self._receive('other')
+        self._receive('other')
+
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(['bad'], self.banned)
+        self.assertNotIn('good', self.manager.banned)
+
+
+class PickerTests(unittest.TestCase):
+    def setUp(self):
+        # Eight pieces of a single block each
+        self.torrent = FakeTorrent(os.urandom(8 * REQUEST_SIZE),
+                                   REQUEST_SIZE)
+        self.manager = PieceManager(self.torrent)
+        # Piece 5 is the rarest
+        self.manager.add_peer('a', bitstring.BitArray('0xff'))
+        self.manager.add_peer('b', bitstring.BitArray('0xfb'))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_rarest_first(self):
+        self.assertEqual(5, self.manager.next_request('a').piece)
+
+    def test_sequential(self):
+        self.manager.picker = Sequential()
+        self.assertEqual([0, 1, 2],
+                         [self.manager.next_request('a').piece
+                          for _ in range(3)])
+
+    def test_changed_at_runtime(self):
+        self.manager.next_request('a')
+        self.manager.picker = Sequential()
+        self.assertEqual(0, self.manager.next_request('a').piece)
+
+    def test_deadline_from_cursor(self):
+        self.manager.picker = Deadline(rate=REQUEST_SIZE,
+                                       cursor=3 * REQUEST_SIZE)
+        self.assertEqual([3, 4, 5],
+                         [self.manager.next_request('a').piece
+                          for _ in range(3)])
+
+    def test_deadline_urgent_to_fast_peers(self):
+        self.manager.picker = Deadline(rate=REQUEST_SIZE, urgent=2)
+        self.manager._timer('a').update(0.05)
+        self.manager._timer('b').update(1)
+        # Pieces 0-2 are due within 2 seconds, not for the slow peer
+        self.assertEqual(3, self.manager.next_request('b').piece)
+        self.assertEqual(0, self.manager.next_request('a').piece)
+
+
+class FilePriorityTests(unittest.TestCase):
+    def setUp(self):
+        # Four single block pieces, the middle file spans pieces 1 and 2
+        self.torrent = FakeTorrent(
+            os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE,
+            files=[REQUEST_SIZE + 10, 2 * REQUEST_SIZE - 20, REQUEST_SIZE + 10])
+        self.manager = PieceManager(self.torrent)
+        self.manager.add_peer('peer', bitstring.BitArray('0xf'))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def _download(self):
+        while True:
+            block = self.manager.next_request('peer')
+            if not block:
+                return
+            start = block.piece * REQUEST_SIZE + block.offset
+            self.manager.block_received('peer', block.piece, block.offset,
+                                        self.torrent.data[start:start +
+                                                          block.length])
+
+    def test_skipped_pieces_left_out(self):
+        self.manager.set_file_priorities(
+            [PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_SKIP])
+        self.assertEqual([1, 2],
+                         [p.index for p in self.manager.missing_pieces])
+        self.manager.set_file_priorities(
+            [PRIORITY_NORMAL, PRIORITY_SKIP, PRIORITY_SKIP])
+        self.assertEqual([0, 1], [p.index for p in
+                                  self.manager.missing_pieces])
+        self.assertEqual([2, 3], [p.index for p in
+                                  self.manager.skipped_pieces])
+
+    def test_bytes_left(self):
+        self.assertEqual(4 * REQUEST_SIZE, self.manager.bytes_left)
+        self.manager.set_file_priorities(
+            [PRIORITY_NORMAL, PRIORITY_SKIP, PRIORITY_SKIP])
+        self.assertEqual(2 * REQUEST_SIZE, self.manager.bytes_left)
+        with no_logging:
+            self._download()
+        self.assertEqual(0, self.manager.bytes_left)
+
+    def test_higher_priority_first(self):
+        self.manager.set_file_priorities(
+            [PRIORITY_LOW, PRIORITY_LOW, PRIORITY_HIGH])
+        self.assertEqual([2, 3], sorted(self.manager.next_request('peer').piece
+                                        for _ in range(2)))
+
+    def test_boundary_pieces_not_written_to_skipped_files(self):
+        self.manager.set_file_priorities(
+            [PRIORITY_NORMAL, PRIORITY_SKIP, PRIORITY_SKIP])
+        with no_logging:
+            self._download()
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(2, len(self.manager.have_pieces))
+        directory = self.torrent.output_file
+        with open(os.path.join(directory, 'file0'), 'rb') as f:
+            self.assertEqual(self.torrent.data[:REQUEST_SIZE + 10], f.read())
+        self.assertFalse(os.path.exists(os.path.join(directory, 'file1')))
+        self.assertTrue(self.manager.skips(REQUEST_SIZE + 10, 1))
+        self.assertFalse(self.manager.skips(0, REQUEST_SIZE))
+
+    def test_boundary_pieces_downloaded_again_when_wanted(self):
+        self.manager.set_file_priorities(
+            [PRIORITY_NORMAL, PRIORITY_SKIP, PRIORITY_SKIP])
+        with no_logging:
+            self._download()
+        self.manager.set_file_priorities(
+            [PRIORITY_NORMAL, PRIORITY_NORMAL, PRIORITY_SKIP])
+        self.assertFalse(self.manager.complete)
+        self.assertFalse(self.manager.have(1))
+        with no_logging:
+            self._download()
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(self.torrent.data[REQUEST_SIZE + 10:
+                                           3 * REQUEST_SIZE - 10],
+                         self.manager.read(REQUEST_SIZE + 10,
+                                           2 * REQUEST_SIZE - 20))
+
+    def test_invalid_priorities(self):
+        with self.assertRaises(ValueError):
+            self.manager.set_file_priorities([PRIORITY_NORMAL])
+
+
+class InterestTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE)
+        self.manager = PieceManager(self.torrent)
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_interest_follows_bitfields(self):
+        self.manager.add_peer('peer', bitstring.BitArray('0x80'))
+        self.manager.add_peer('empty', bitstring.BitArray('0x00'))
+        self.assertTrue(self.manager.interesting('peer'))
+        self.assertFalse(self.manager.interesting('empty'))
+
+        block = self.manager.next_request('peer')
+        with no_logging:
+            self.manager.block_received('peer', 0, 0,
+                                        self.torrent.data[:REQUEST_SIZE])
+        self.assertEqual(0, block.piece)
+        self.assertFalse(self.manager.interesting('peer'))
+
+        self.manager.update_peer('empty', 0)
+        self.assertFalse(self.manager.interesting('empty'))
+        self.manager.update_peer('empty', 3)
+        self.assertTrue(self.manager.interesting('empty'))
+
+    def test_skipped_pieces_not_interesting(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE,
+                              files=[2 * REQUEST_SIZE, 2 * REQUEST_SIZE])
+        manager = PieceManager(torrent)
+        manager.add_peer('peer', bitstring.BitArray('0xc0'))
+        manager.set_file_priorities([PRIORITY_SKIP, PRIORITY_NORMAL])
+        self.assertFalse(manager.interesting('peer'))
+        manager.close()
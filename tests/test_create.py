@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from hashlib import sha1
+
+from TorLord.create import create_torrent, save_torrent, hash_pieces, \
+    piece_length_for, MIN_PIECE_LENGTH, MAX_PIECE_LENGTH
+from TorLord.torrent import Torrent
+
+
+def _hashes(data: bytes, piece_length: int) -> bytes:
+    return b''.join(sha1(data[i:i + piece_length]).digest()
+                    for i in range(0, len(data), piece_length))
+
+
+class PieceLengthTests(unittest.TestCase):
+    def test_piece_length(self):
+        self.assertEqual(MIN_PIECE_LENGTH, piece_length_for(1))
+        self.assertEqual(2 ** 20, piece_length_for(1500 * 2 ** 20))
+        self.assertEqual(2 ** 21, piece_length_for(1500 * 2 ** 20 + 1))
+        self.assertEqual(MAX_PIECE_LENGTH, piece_length_for(2 ** 50))
+
+
+class CreateTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _load(self, meta_info):
+        filename = os.path.join(self.directory.name, 'new.torrent')
+        save_torrent(meta_info, filename)
+        return Torrent(filename)
+
+    def test_single_file(self):
+        data = os.urandom(5 * 2 ** 15 + 10)
+        path = self._write('payload', data)
+        meta_info = create_torrent(path, 'http://tracker/announce',
+                                   url_list=['http://mirror/'], now=100)
+        torrent = self._load(meta_info)
+        self.assertFalse(torrent.multi_file)
+        self.assertEqual('payload', torrent.output_file)
+        self.assertEqual(len(data), torrent.total_size)
+        self.assertEqual(2 ** 15, torrent.piece_length)
+        self.assertEqual(_hashes(data, 2 ** 15), b''.join(torrent.pieces))
+        self.assertEqual('http://tracker/announce', torrent.announce)
+        self.assertEqual(['http://mirror/'], torrent.url_list)
+        self.assertEqual(100, torrent.meta_info[b'creation date'])
+
+    def test_multi_file(self):
+        sizes = [('b/second', 2 ** 15 - 3), ('a', 2 ** 14), ('b/empty', 0),
+                 ('c', 2 ** 16 + 7)]
+        contents = {name: os.urandom(size) for name, size in sizes}
+        for name, data in contents.items():
+            self._write(os.path.join('album', *name.split('/')), data)
+        meta_info = create_torrent(os.path.join(self.directory.name, 'album'),
+                                   'http://tracker/announce', private=True)
+        torrent = self._load(meta_info)
+        self.assertTrue(torrent.multi_file)
+        # The files are in path order, pieces spanning across them
+        names = ['a', 'b/empty', 'b/second', 'c']
+        self.assertEqual([os.path.join(*name.split('/')) for name in names],
+                         [f.name for f in torrent.files])
+        data = b''.join(contents[name] for name in names)
+        self.assertEqual(_hashes(data, 2 ** 15), b''.join(torrent.pieces))
+        self.assertEqual(1, torrent.meta_info[b'info'][b'private'])
+
+    def test_nothing_to_share(self):
+        path = self._write('empty', b'')
+        with self.assertRaises(ValueError):
+            create_torrent(path, 'http://tracker/announce')
+
+    def test_parallel(self):
+        data = os.urandom(9 * 2 ** 14 + 1)
+        files = [(self._write('first', data[:2 ** 14 + 5]), 2 ** 14 + 5),
+                 (self._write('second', data[2 ** 14 + 5:]),
+                  len(data) - 2 ** 14 - 5)]
+        expected = _hashes(data, 2 ** 14)
+        self.assertEqual(expected, hash_pieces(files, 2 ** 14))
+        self.assertEqual(expected, hash_pieces(files, 2 ** 14, workers=2,
+                                               task_size=2 ** 15))
@@ -0,0 +1,109 @@
+import asyncio
+import socket
+import unittest
+
+from . import FakeTorrent
+from TorLord.client import PeerQueue, TorrentClient, PEER_PRIORITY_LOCAL
+from TorLord.lsd import LocalServiceDiscovery, encode_announce, \
+    decode_announce, LSD_GROUP
+from TorLord.tracker import Tracker
+
+INFO_HASH = bytes(range(20))
+
+
+def _free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AnnounceTests(unittest.TestCase):
+    def test_encode_and_decode(self):
+        message = encode_announce(LSD_GROUP, 6771, 6881,
+                                  [INFO_HASH, b'\xff' * 20], 'abc')
+        self.assertTrue(message.startswith(b'BT-SEARCH * HTTP/1.1\r\n'))
+        self.assertEqual((6881, [INFO_HASH, b'\xff' * 20], 'abc'),
+                         decode_announce(message))
+
+    def test_invalid(self):
+        self.assertIsNone(decode_announce(b'\xff\xfe'))
+        self.assertIsNone(decode_announce(b'M-SEARCH * HTTP/1.1\r\n\r\n'))
+        self.assertIsNone(decode_announce(
+            b'BT-SEARCH * HTTP/1.1\r\nPort: abc\r\n\r\n'))
+        self.assertIsNone(decode_announce(
+            b'BT-SEARCH * HTTP/1.1\r\nInfohash: ' + b'0' * 40 + b'\r\n'))
+
+
+class PeerQueueTests(unittest.TestCase):
+    def test_priority_first(self):
+        queue = PeerQueue()
+        queue.put_nowait(('10.0.0.1', 1))
+        queue.put_nowait(('10.0.0.2', 2))
+        queue.put_nowait(('192.168.0.1', 3), PEER_PRIORITY_LOCAL)
+        self.assertEqual([('192.168.0.1', 3), ('10.0.0.1', 1),
+                          ('10.0.0.2', 2)],
+                         [queue.get_nowait() for _ in range(3)])
+
+
+class LoopbackDiscoveryTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        lsd_port = _free_udp_port()
+        self.found = {6881: [], 6882: []}
+        self.hosts = [LocalServiceDiscovery(
+            port, lambda h, p, port=port: self.found[port].append((h, p)),
+            lsd_port=lsd_port, interface='127.0.0.1')
+            for port in (6881, 6882)]
+        for host in self.hosts:
+            await host.start()
+
+    async def asyncTearDown(self):
+        for host in self.hosts:
+            host.close()
+
+    async def _wait_until_found(self, port):
+        while not self.found[port]:
+            await asyncio.sleep(0.01)
+
+    async def test_peers_found(self):
+        first, second = self.hosts
+        first.add(INFO_HASH)
+        second.add(b'\x01' * 20)
+        second.add(INFO_HASH)
+        await asyncio.wait_for(self._wait_until_found(6881), 5)
+        first.announce()
+        await asyncio.wait_for(self._wait_until_found(6882), 5)
+        await asyncio.sleep(0.05)
+        # Only the torrents both run are reported, the own announces are
+        # ignored
+        self.assertEqual({(INFO_HASH, ('127.0.0.1', 6882))},
+                         set(self.found[6881]))
+        self.assertEqual({(INFO_HASH, ('127.0.0.1', 6881))},
+                         set(self.found[6882]))
+
+
+class LocalPeerTests(unittest.TestCase):
+    def test_local_peers_first(self):
+        torrent = FakeTorrent(b'a' * 100000)
+        client = TorrentClient(torrent, tracker=Tracker(torrent))
+        client.banned_ips.add('192.168.0.3')
+        client.add_peer(('10.0.0.1', 6881))
+        client.add_peer(('192.168.0.2', 6881), PEER_PRIORITY_LOCAL)
+        client.add_peer(('192.168.0.3', 6881), PEER_PRIORITY_LOCAL)
+        self.assertEqual([('192.168.0.2', 6881), ('10.0.0.1', 6881)],
+                         [client.available_peers.get_nowait()
+                          for _ in range(client.available_peers.qsize())])
+        client.piece_manager.close()
+
+    def test_local_peers_kept_on_announce(self):
+        torrent = FakeTorrent(b'a' * 100000)
+        client = TorrentClient(torrent, tracker=Tracker(torrent))
+        client.add_peer(('192.168.0.2', 6881), PEER_PRIORITY_LOCAL)
+        client._replace_tracker_peers([('10.0.0.1', 6881),
+                                       ('10.0.0.2', 6881)])
+        # The next tracker response replaces only the peers of the last
+        client._replace_tracker_peers([('10.0.0.3', 6881),
+                                       ('192.168.0.2', 6881)])
+        self.assertEqual([('192.168.0.2', 6881), ('10.0.0.3', 6881)],
+                         [client.available_peers.get_nowait()
+                          for _ in range(client.available_peers.qsize())])
+        client.piece_manager.close()
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import unittest
+from asyncio import Queue
+
+import aiohttp
+import bitstring
+
+from . import no_logging, FakeTorrent
+from .swarm import Seeder
+from TorLord.client import PieceManager
+from TorLord.metrics import MetricsRegistry, TorrentMetrics, \
+    PrometheusExporter, JsonExporter
+from TorLord.protocol import PeerConnection, REQUEST_SIZE
+
+
+class RegistryTests(unittest.TestCase):
+    def test_same_labels_same_counter(self):
+        registry = MetricsRegistry()
+        registry.counter('bytes', 'Bytes', peer='a').inc(10)
+        registry.counter('bytes', 'Bytes', peer='a').inc(5)
+        registry.counter('bytes', 'Bytes', peer='b').inc(1)
+
+        series = registry.collect()[0][3]
+        self.assertEqual([15, 1], [metric.value for _, metric in series])
+
+    def test_remove_by_label(self):
+        registry = MetricsRegistry()
+        registry.counter('bytes', 'Bytes', torrent='t', peer='a')
+        registry.counter('bytes', 'Bytes', torrent='t', peer='b')
+        registry.remove(peer='a')
+
+        series = registry.collect()[0][3]
+        self.assertEqual([{'peer': 'b', 'torrent': 't'}],
+                         [dict(labels) for labels, _ in series])
+
+    def test_type_mismatch(self):
+        registry = MetricsRegistry()
+        registry.counter('x', 'X')
+        with self.assertRaises(ValueError):
+            registry.histogram('x', 'X')
+
+    def test_prometheus_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('rtt', 'RTT', buckets=(0.1, 1),
+                                       torrent='t')
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+
+        text = PrometheusExporter(registry).render()
+        self.assertIn('# TYPE rtt histogram', text)
+        self.assertIn('rtt_bucket{le="0.1",torrent="t"} 1', text)
+        self.assertIn('rtt_bucket{le="1",torrent="t"} 3', text)
+        self.assertIn('rtt_bucket{le="+Inf",torrent="t"} 4', text)
+        self.assertIn('rtt_count{torrent="t"} 4', text)
+
+
+class ExporterTests(unittest.IsolatedAsyncioTestCase):
+    async def test_served_over_http(self):
+        registry = MetricsRegistry()
+        registry.counter('torlord_test_total', 'Test', torrent='t').inc(3)
+        exporter = JsonExporter(registry)
+        with no_logging:
+            await exporter.start(port=0)
+        try:
+            port = exporter.runner.addresses[0][1]
+            async with aiohttp.ClientSession() as client:
+                async with client.get('http://127.0.0.1:{port}/metrics'
+                                      .format(port=port)) as response:
+                    result = await response.json()
+        finally:
+            await exporter.close()
+        self.assertEqual(3, result['torlord_test_total'][0]['value'])
+
+
+class PieceManagerMetricsTests(unittest.TestCase):
+    def setUp(self):
+        # The last piece is a single, short block
+        self.torrent = FakeTorrent(os.urandom(2 * REQUEST_SIZE + 100),
+                                   2 * REQUEST_SIZE)
+        self.metrics = TorrentMetrics(self.torrent.info_hash,
+                                      MetricsRegistry())
+        self.manager = PieceManager(self.torrent, metrics=self.metrics)
+        self.manager.add_peer('peer', bitstring.BitArray('0b11'))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def _download(self, data, blocks=3):
+        for _ in range(blocks):
+            block = self.manager.next_request('peer')
+            start = block.piece * self.torrent.piece_length + block.offset
+            self.manager.block_received('peer', block.piece, block.offset,
+                                        data[start:start + block.length])
+
+    def test_bytes_downloaded(self):
+        with no_logging:
+            self._download(self.torrent.data)
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(self.torrent.total_size,
+                         self.manager.bytes_downloaded)
+        self.assertEqual(3, self.metrics.request_rtt.count)
+        self.assertEqual(2, self.metrics.piece_latency.count)
+
+    def test_hash_failure_wasted(self):
+        with no_logging:
+            # Both blocks of the first piece
+            self._download(b'\x00' * self.torrent.total_size, blocks=2)
+        self.assertEqual(1, self.metrics.hash_failures.value)
+        self.assertEqual(2 * REQUEST_SIZE, self.metrics.wasted_bytes.value)
+        self.assertEqual(0, self.manager.bytes_downloaded)
+
+    def test_duplicate_block(self):
+        with no_logging:
+            self._download(self.torrent.data)
+            self.manager.block_received('peer', 0, 0, b'\x00' * REQUEST_SIZE)
+        self.assertEqual(REQUEST_SIZE, self.metrics.duplicate_bytes.value)
+
+
+class PeerMetricsTests(unittest.IsolatedAsyncioTestCase):
+    async def test_bytes_in_and_out(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE))
+        seeder = Seeder(torrent.data, torrent.piece_length, torrent.info_hash)
+        await seeder.start()
+        queue = Queue()
+        queue.put_nowait(seeder.address)
+
+        metrics = TorrentMetrics(torrent.info_hash, MetricsRegistry())
+        manager = PieceManager(torrent, metrics=metrics)
+        with no_logging:
+            peer = PeerConnection(queue, torrent.info_hash,
+                                  '-TL0001-000000000000', manager,
+                                  manager.block_received, metrics=metrics)
+            try:
+                while not manager.complete:
+                    await asyncio.sleep(0.01)
+                bytes_in, bytes_out = metrics.peer(peer.address)
+            finally:
+                peer.stop()
+                manager.close()
+                seeder.close()
+
+        self.assertGreater(bytes_in.value, torrent.total_size)
+        self.assertEqual(bytes_in.value, metrics.bytes_in.value)
+        # Have None, Interested and a request for each of the blocks
+        self.assertEqual(5 + 5 + 4 * 17, bytes_out.value)
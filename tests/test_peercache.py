@@ -0,0 +1,85 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from . import no_logging, FakeTorrent
+from .swarm import Seeder
+from TorLord.client import TorrentClient
+from TorLord.peercache import PeerCache
+from TorLord.protocol import REQUEST_SIZE
+from TorLord.tracker import Tracker
+
+INFO_HASH = b'\x01' * 20
+
+
+class PeerCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = PeerCache(self.directory.name, max_peers=2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fastest_first(self):
+        self.cache.record(INFO_HASH, ('10.0.0.1', 6881), 100, now=1000)
+        self.cache.record(INFO_HASH, ('10.0.0.2', 6881), 300, now=1000)
+        self.cache.record(INFO_HASH, ('10.0.0.3', 6881), 200, now=1000)
+        self.assertEqual([('10.0.0.2', 6881), ('10.0.0.3', 6881)],
+                         self.cache.peers(INFO_HASH, now=1000))
+
+    def test_saved_and_loaded(self):
+        self.cache.record(INFO_HASH, ('10.0.0.1', 6881), 100)
+        self.cache.record(INFO_HASH, ('10.0.0.2', 51413), 300)
+        self.cache.record(INFO_HASH, ('::1', 6881), 500)
+        self.cache.save(INFO_HASH)
+        self.assertEqual(2 * 14, os.path.getsize(
+            os.path.join(self.directory.name, INFO_HASH.hex())))
+
+        cache = PeerCache(self.directory.name)
+        self.assertEqual([('10.0.0.2', 51413), ('10.0.0.1', 6881)],
+                         cache.peers(INFO_HASH))
+        self.assertEqual([], cache.peers(b'\x02' * 20))
+
+    def test_expired_and_forgotten(self):
+        self.cache.max_age = 60
+        self.cache.record(INFO_HASH, ('10.0.0.1', 6881), 100, now=1000)
+        self.cache.record(INFO_HASH, ('10.0.0.2', 6881), 300, now=1000)
+        self.cache.record(INFO_HASH, ('10.0.0.3', 6881), 200, now=1100)
+        self.cache.forget(INFO_HASH, ('10.0.0.3', 6881))
+        self.assertEqual([('10.0.0.2', 6881), ('10.0.0.1', 6881)],
+                         self.cache.peers(INFO_HASH, now=1060))
+        self.assertEqual([], self.cache.peers(INFO_HASH, now=1061))
+
+
+class WarmStartTests(unittest.IsolatedAsyncioTestCase):
+    async def test_cached_peers_dialed_without_tracker(self):
+        # The tracker of the fake torrent can't be reached
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE)
+        seeder = Seeder(torrent.data, torrent.piece_length,
+                        torrent.info_hash)
+        await seeder.start()
+        with tempfile.TemporaryDirectory() as directory:
+            cache = PeerCache(directory)
+            cache.record(torrent.info_hash, ('127.0.0.1', 9), 100)
+            cache.record(torrent.info_hash, seeder.address, 10)
+            client = TorrentClient(torrent, tracker=Tracker(torrent),
+                                   max_peer_connections=2, peer_cache=cache)
+            with no_logging:
+                task = asyncio.ensure_future(client.start())
+                try:
+                    while not client.piece_manager.complete:
+                        await asyncio.wait_for(asyncio.sleep(0.01), 5)
+                    # The peer we couldn't connect to is forgotten, the
+                    # seeder's rate is updated
+                    client.stop()
+                    cache = PeerCache(directory)
+                    self.assertEqual([seeder.address],
+                                     cache.peers(torrent.info_hash))
+                    self.assertGreater(
+                        cache._load(torrent.info_hash)[seeder.address].rate,
+                        10)
+                finally:
+                    client.stop()
+                    task.cancel()
+                    seeder.close()
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import unittest
+from asyncio import Queue
+from collections import OrderedDict
+
+from . import no_logging, FakeTorrent
+from .swarm import Seeder
+from TorLord import bencoding
+from TorLord.client import PieceManager
+from TorLord.pex import PeerExchange, encode_peers, decode_peers, \
+    UT_PEX_ID, PEX_INTERVAL, MAX_PEX_PEERS
+from TorLord.protocol import PeerConnection, PeerStreamIterator, Handshake, \
+    BitField, Extended, HaveNone
+
+
+class StubPeer:
+    def __init__(self, address, ut_pex=True):
+        self.listen_address = address
+        self.connected = True
+        self.extensions = {'ut_pex': 7} if ut_pex else {}
+        self.sent = []
+
+    def send_extended(self, extended_id, payload):
+        self.sent.append((extended_id, bencoding.Decoder(payload).decode()))
+
+
+class PeerExchangeTests(unittest.TestCase):
+    def test_compact_peers(self):
+        peers = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+        self.assertEqual(peers, decode_peers(encode_peers(peers)))
+
+    def test_added_and_dropped(self):
+        pex = PeerExchange(6889, None)
+        a, b, c = (StubPeer(('10.0.0.%d' % i, 6881)) for i in range(1, 4))
+        pex.update([a, b, c], now=0)
+        extended_id, message = a.sent[-1]
+        self.assertEqual(7, extended_id)
+        self.assertEqual([b.listen_address, c.listen_address],
+                         decode_peers(message[b'added']))
+
+        c.connected = False
+        pex.update([a, b, c], now=1)
+        self.assertEqual(1, len(a.sent))  # Not within a minute
+
+        pex.update([a, b, c], now=PEX_INTERVAL)
+        message = a.sent[-1][1]
+        self.assertEqual(b'', message[b'added'])
+        self.assertEqual([c.listen_address],
+                         decode_peers(message[b'dropped']))
+
+    def test_ipv6_peers_left_out(self):
+        pex = PeerExchange(6889, None)
+        a, b = StubPeer(('10.0.0.1', 6881)), StubPeer(('10.0.0.2', 6881))
+        pex.update([a, b, StubPeer(('::1', 6881))], now=0)
+        self.assertEqual([b.listen_address],
+                         decode_peers(a.sent[-1][1][b'added']))
+
+    def test_not_sent_without_ut_pex(self):
+        pex = PeerExchange(6889, None)
+        a = StubPeer(('10.0.0.1', 6881), ut_pex=False)
+        pex.update([a, StubPeer(('10.0.0.2', 6881))], now=0)
+        self.assertEqual([], a.sent)
+
+    def test_received_limited(self):
+        learned = []
+        pex = PeerExchange(6889, learned.extend)
+        peers = [('10.0.%d.%d' % (i // 256, i % 256), 6881)
+                 for i in range(2 * MAX_PEX_PEERS)]
+        payload = bytes(bencoding.Encoder(
+            {b'added': encode_peers(peers)}).encode())
+        peer = object()
+        pex.received(peer, payload, now=0)
+        pex.received(peer, payload, now=1)  # Too soon, ignored
+        self.assertEqual(peers[:MAX_PEX_PEERS], learned)
+
+
+class PexSeeder(Seeder):
+    """
+    Supports ut_pex and tells about a couple of peers right away. Every
+    message received is kept.
+    """
+    peers = [('10.1.2.3', 6881), ('10.4.5.6', 6882)]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshake = None
+        self.received = []
+
+    async def _serve(self, reader, writer):
+        try:
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(self.info_hash, self.peer_id).encode())
+            writer.write(Extended(0, bytes(bencoding.Encoder(OrderedDict(
+                [(b'm', {b'ut_pex': 3})])).encode())).encode())
+            writer.write(Extended(UT_PEX_ID, bytes(bencoding.Encoder(
+                {b'added': encode_peers(self.peers)}).encode())).encode())
+            writer.write(BitField(self.bitfield).encode())
+            async for message in PeerStreamIterator(reader):
+                self.received.append(message)
+                if type(message) is Extended and message.extended_id == 0:
+                    self.handshake = bencoding.Decoder(
+                        message.payload).decode()
+        finally:
+            writer.close()
+
+
+class PexConnectionTests(unittest.IsolatedAsyncioTestCase):
+    async def test_peers_learned(self):
+        torrent = FakeTorrent(os.urandom(2 ** 15))
+        seeder = PexSeeder(torrent.data, torrent.piece_length,
+                           torrent.info_hash)
+        await seeder.start()
+        queue = Queue()
+        queue.put_nowait(seeder.address)
+        learned = []
+        manager = PieceManager(torrent)
+        with no_logging:
+            peer = PeerConnection(queue, torrent.info_hash,
+                                  '-TL0001-000000000000', manager,
+                                  manager.block_received,
+                                  pex=PeerExchange(6889, learned.extend))
+            try:
+                while not learned or not seeder.handshake:
+                    await asyncio.sleep(0.01)
+            finally:
+                peer.stop()
+                manager.close()
+                seeder.close()
+
+        self.assertEqual(PexSeeder.peers, learned)
+        self.assertEqual({'ut_pex': 3}, peer.extensions)
+        self.assertEqual(UT_PEX_ID, seeder.handshake[b'm'][b'ut_pex'])
+        self.assertEqual(6889, seeder.handshake[b'p'])
+        # The Fast Extension wants what we have told first (BEP 6)
+        self.assertEqual([HaveNone, Extended],
+                         [type(m) for m in seeder.received[:2]])
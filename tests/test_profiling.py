@@ -0,0 +1,76 @@
+import asyncio
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from . import no_logging
+from TorLord import profiling
+from TorLord.metrics import MetricsRegistry
+
+
+def _busy(duration):
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+
+class LoopLagMonitorTests(unittest.IsolatedAsyncioTestCase):
+    async def test_blocked_loop(self):
+        monitor = profiling.LoopLagMonitor(0.01, MetricsRegistry())
+        monitor.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)  # Blocks the loop
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+        self.assertGreater(monitor.max_lag, 0.15)
+        self.assertGreater(monitor.lag.count, 2)
+
+
+class SpanTests(unittest.TestCase):
+    def tearDown(self):
+        profiling.disable_spans()
+
+    def test_disabled_is_shared_noop(self):
+        self.assertIs(profiling.span('hash'), profiling.span('write'))
+
+    def test_enabled_records_stage(self):
+        registry = MetricsRegistry()
+        profiling.enable_spans(registry)
+        with profiling.span('hash'):
+            pass
+        histogram = registry.histogram('torlord_stage_seconds', '',
+                                       stage='hash')
+        self.assertEqual(1, histogram.count)
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_collapsed_stacks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.txt')
+            profiler = profiling.Profiler(path)
+            with no_logging:
+                profiler.start()
+                _busy(0.1)
+                profiler.stop()
+            with open(path) as f:
+                lines = f.read().splitlines()
+
+        self.assertTrue(any('test_profiling.py:_busy' in line
+                            for line in lines))
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+
+    def test_cprofile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.prof')
+            profiler = profiling.Profiler(path)
+            with no_logging:
+                profiler.start()
+                _busy(0.01)
+                profiler.stop()
+            stats = pstats.Stats(path)
+        self.assertTrue(any(name == '_busy'
+                            for _, _, name in stats.stats))
@@ -1,7 +1,17 @@
+import asyncio
+import os
 import unittest
+from asyncio import Queue
 
-from TorLord.protocol import PeerStreamIterator, Handshake, Have, Request, \
-    Piece, Interested, Cancel
+from . import no_logging, FakeTorrent
+from .swarm import Seeder
+from TorLord.client import PieceManager, TorrentClient
+from TorLord.protocol import PeerConnection, PeerStreamIterator, Handshake, \
+    Have, Request, Piece, Interested, Cancel, HaveAll, HaveNone, \
+    RejectRequest, AllowedFast, SuggestPiece, KeepAlive, Choke, Unchoke, \
+    NotInterested, BitField, Extended, MessageQueue, FAST_EXTENSION, \
+    REQUEST_SIZE
+from TorLord.tracker import Tracker
 
 
 class PeerStreamIteratorTests(unittest.TestCase):
@@ -10,6 +20,119 @@ class PeerStreamIteratorTests(unittest.TestCase):
         iterator.buffer = ""
         self.assertIsNone(iterator.parse())
 
+    def test_parse_every_message(self):
+        messages = [KeepAlive(), Choke(), Unchoke(), Interested(),
+                    NotInterested(), Have(7), BitField(b'\xf0\x01'),
+                    Request(1, 2, 3), Piece(4, 5, b'block'), Cancel(6, 7, 8),
+                    SuggestPiece(9), HaveAll(), HaveNone(),
+                    RejectRequest(10, 11, 12), AllowedFast(13),
+                    Extended(1, b'payload')]
+        iterator = PeerStreamIterator(
+            None, b''.join(bytes(m.encode()) for m in messages))
+
+        parsed = []
+        while True:
+            message = iterator.parse()
+            if not message:
+                break
+            parsed.append(message)
+        self.assertEqual([type(m) for m in messages],
+                         [type(m) for m in parsed])
+        self.assertEqual((4, 5, b'block'), (parsed[8].index, parsed[8].begin,
+                                            parsed[8].block))
+        self.assertEqual((6, 7, 8), (parsed[9].index, parsed[9].begin,
+                                     parsed[9].length))
+        self.assertEqual(b'payload', parsed[15].payload)
+        self.assertEqual('0xf001', parsed[6].bitfield)
+
+    def test_message_split_across_reads(self):
+        class Reader:
+            def __init__(self, chunks):
+                self.chunks = chunks
+
+            async def read(self, n):
+                return self.chunks.pop(0) if self.chunks else b''
+
+        data = Have(1).encode() + Piece(2, 0, b'x' * 100).encode()
+        iterator = PeerStreamIterator(Reader([data[9:20], data[20:]]),
+                                      data[:9])
+
+        async def read_all():
+            return [m async for m in iterator]
+        messages = asyncio.run(read_all())
+        self.assertEqual([Have, Piece], [type(m) for m in messages])
+        self.assertEqual(b'x' * 100, messages[1].block)
+
+    def test_unsupported_message_skipped(self):
+        iterator = PeerStreamIterator(None, b'\x00\x00\x00\x02\x63\x00' +
+                                      Interested().encode())
+        with no_logging:
+            self.assertIs(Interested, type(iterator.parse()))
+
+    def test_encode_into(self):
+        buffer = bytearray(Request.size + Have.size)
+        offset = Request(1, 2, 3).encode_into(buffer, 0)
+        Have(4).encode_into(buffer, offset)
+        self.assertEqual(Request(1, 2, 3).encode() + Have(4).encode(),
+                         buffer)
+
+
+class FakeWriter:
+    class Transport:
+        def __init__(self):
+            self.buffered = 0
+
+        def set_write_buffer_limits(self, high):
+            pass
+
+        def is_closing(self):
+            return False
+
+        def get_write_buffer_size(self):
+            return self.buffered
+
+    def __init__(self):
+        self.transport = FakeWriter.Transport()
+        self.writes = []
+        self.drained = 0
+
+    def writelines(self, data):
+        self.writes.append(b''.join(data))
+
+    def is_closing(self):
+        return False
+
+    async def drain(self):
+        self.drained += 1
+
+
+class MessageQueueTests(unittest.IsolatedAsyncioTestCase):
+    async def test_flushed_after_delay(self):
+        writer = FakeWriter()
+        queue = MessageQueue(writer, delay=0.01)
+        queue.put(Have(1).encode())
+        queue.put(KeepAlive().encode())
+        self.assertEqual([], writer.writes)
+        await asyncio.sleep(0.05)
+        self.assertEqual([Have(1).encode() + KeepAlive().encode()],
+                         writer.writes)
+
+    async def test_flushed_at_size(self):
+        writer = FakeWriter()
+        queue = MessageQueue(writer, delay=10, size=2 * Request.size)
+        queue.put(Request(1, 0).encode())
+        queue.put(Request(1, REQUEST_SIZE).encode())
+        self.assertEqual(1, len(writer.writes))
+        queue.close()
+
+    async def test_drain_above_high_water(self):
+        writer = FakeWriter()
+        queue = MessageQueue(writer, high_water=100)
+        await queue.drain()
+        writer.transport.buffered = 101
+        await queue.drain()
+        self.assertEqual(1, writer.drained)
+
 
 class HandshakeTests(unittest.TestCase):
     def test_construction(self):
@@ -17,9 +140,11 @@ class HandshakeTests(unittest.TestCase):
             info_hash=b"CDP;~y~\xbf1X#'\xa5\xba\xae5\xb1\x1b\xda\x01",
             peer_id=b"-qB3200-iTiX3rvfzMpr")
 
+        # The Fast Extension and the extension protocol are announced in the
+        # reserved bytes
         self.assertEqual(
             handshake.encode(),
-            b"\x13BitTorrent protocol\x00\x00\x00\x00\x00\x00\x00\x00"
+            b"\x13BitTorrent protocol\x00\x00\x00\x00\x00\x10\x00\x04"
             b"CDP;~y~\xbf1X#'\xa5\xba\xae5\xb1\x1b\xda\x01"
             b"-qB3200-iTiX3rvfzMpr")
 
@@ -35,6 +160,7 @@ class HandshakeTests(unittest.TestCase):
         self.assertEqual(
             b"-qB3200-iTiX3rvfzMpr",
             handshake.peer_id)
+        self.assertFalse(handshake.supports(FAST_EXTENSION))
 
 
 class HaveMessageTests(unittest.TestCase):
@@ -46,4 +172,153 @@ class HaveMessageTests(unittest.TestCase):
 
     def test_can_parse_have(self):
         have = Have.decode(b"\x00\x00\x00\x05\x04\x00\x00\x00!")
-        self.assertEqual(33, have.index)
\ No newline at end of file
+        self.assertEqual(33, have.index)
+
+class FastExtensionMessageTests(unittest.TestCase):
+    def _parse(self, message):
+        return PeerStreamIterator(None, message.encode()).parse()
+
+    def test_have_all_none(self):
+        self.assertIs(HaveAll, type(self._parse(HaveAll())))
+        self.assertIs(HaveNone, type(self._parse(HaveNone())))
+
+    def test_reject_request(self):
+        message = self._parse(RejectRequest(3, REQUEST_SIZE, 100))
+        self.assertIs(RejectRequest, type(message))
+        self.assertEqual((3, REQUEST_SIZE, 100),
+                         (message.index, message.begin, message.length))
+
+    def test_allowed_fast_and_suggest(self):
+        self.assertEqual(7, self._parse(AllowedFast(7)).index)
+        self.assertIs(SuggestPiece, type(self._parse(SuggestPiece(7))))
+
+
+class FastSeeder(Seeder):
+    """
+    Announces every piece with Have All and allows piece 0 to be downloaded
+    while choked. The first request is rejected.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+
+    async def _serve(self, reader, writer):
+        try:
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(self.info_hash, self.peer_id).encode())
+            writer.write(HaveAll().encode())
+            writer.write(AllowedFast(0).encode())
+            async for message in PeerStreamIterator(reader):
+                self.received.append(message)
+                if type(message) is not Request:
+                    continue
+                if len([m for m in self.received
+                        if type(m) is Request]) == 1:
+                    writer.write(RejectRequest(
+                        message.index, message.begin,
+                        message.length).encode())
+                    continue
+                start = message.index * self.piece_length + message.begin
+                writer.write(Piece(message.index, message.begin,
+                                   self.data[start:start + message.length])
+                             .encode())
+        finally:
+            writer.close()
+
+
+class FastExtensionTests(unittest.IsolatedAsyncioTestCase):
+    async def test_allowed_fast_while_choked(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), 2 * REQUEST_SIZE)
+        seeder = FastSeeder(torrent.data, torrent.piece_length,
+                            torrent.info_hash)
+        await seeder.start()
+        queue = Queue()
+        queue.put_nowait(seeder.address)
+        manager = PieceManager(torrent)
+        with no_logging:
+            peer = PeerConnection(queue, torrent.info_hash,
+                                  '-TL0001-000000000000', manager,
+                                  manager.block_received)
+            try:
+                while not manager.have_pieces:
+                    await asyncio.sleep(0.01)
+            finally:
+                peer.stop()
+                manager.close()
+                seeder.close()
+
+        self.assertTrue(peer.fast)
+        self.assertIn('choked', peer.my_state)
+        self.assertEqual([0], [p.index for p in manager.have_pieces])
+        # We told we have nothing, and asked for the rejected block again
+        self.assertIs(HaveNone, type(seeder.received[0]))
+        requests = [(m.index, m.begin) for m in seeder.received
+                    if type(m) is Request]
+        self.assertEqual(2, requests.count(requests[0]))
+
+
+class PartialSeeder(Seeder):
+    """
+    Has the first half of the pieces only, and records the messages
+    received.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+        bitfield = bytearray(self.bitfield)
+        pieces = (len(self.data) + self.piece_length - 1) // self.piece_length
+        for index in range(pieces // 2, pieces):
+            bitfield[index // 8] &= ~(128 >> (index % 8))
+        self.bitfield = bytes(bitfield)
+
+    async def _serve(self, reader, writer):
+        try:
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(self.info_hash, self.peer_id).encode())
+            writer.write(BitField(self.bitfield).encode())
+            writer.write(Unchoke().encode())
+            async for message in PeerStreamIterator(reader):
+                self.received.append(message)
+                if type(message) is Request:
+                    start = message.index * self.piece_length + message.begin
+                    writer.write(Piece(message.index, message.begin,
+                                       self.data[start:start + message.length])
+                                 .encode())
+        finally:
+            writer.close()
+
+
+class InterestTests(unittest.IsolatedAsyncioTestCase):
+    async def _download(self, suppress_have):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE)
+        seeder = PartialSeeder(torrent.data, torrent.piece_length,
+                               torrent.info_hash)
+        await seeder.start()
+        client = TorrentClient(torrent, tracker=Tracker(torrent))
+        client.suppress_have = suppress_have
+        client.available_peers.put_nowait(seeder.address)
+        with no_logging:
+            client.peers = [client._new_peer()]
+            try:
+                while len(client.piece_manager.have_pieces) < 2:
+                    await asyncio.sleep(0.01)
+                while type(seeder.received[-1]) is not NotInterested:
+                    await asyncio.sleep(0.01)
+            finally:
+                client.stop()
+                seeder.close()
+        return seeder.received
+
+    async def test_have_and_not_interested(self):
+        received = await self._download(suppress_have=False)
+        # Interested once the bitfield is known, no longer once we have
+        # every piece the seeder has
+        self.assertEqual([Interested, NotInterested],
+                         [type(m) for m in received
+                          if type(m) in (Interested, NotInterested)])
+        self.assertEqual([0, 1], sorted(m.index for m in received
+                                        if type(m) is Have))
+
+    async def test_have_suppressed(self):
+        received = await self._download(suppress_have=True)
+        self.assertEqual([], [m for m in received if type(m) is Have])
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+import unittest
+from asyncio import Queue
+
+from . import no_logging, FakeTorrent
+from .swarm import Seeder
+from TorLord.client import PieceManager
+from TorLord.protocol import PeerConnection, REQUEST_SIZE
+from TorLord.ratelimit import TokenBucket
+
+
+def _rate(transferred, elapsed, bucket):
+    # The burst initially held by the bucket came for free
+    return (transferred - bucket.burst) / elapsed
+
+
+async def _consume_for(bucket, duration, amount=REQUEST_SIZE):
+    consumed = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        await bucket.consume(amount)
+        consumed += amount
+    return consumed, time.monotonic() - start
+
+
+class TokenBucketTests(unittest.IsolatedAsyncioTestCase):
+    async def test_unlimited(self):
+        bucket = TokenBucket()
+        start = time.monotonic()
+        for _ in range(1000):
+            await bucket.consume(REQUEST_SIZE)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    async def test_rate(self):
+        bucket = TokenBucket(1024 * 1024)
+        rate = _rate(*await _consume_for(bucket, 0.5), bucket)
+        self.assertAlmostEqual(1024 * 1024, rate, delta=0.03 * 1024 * 1024)
+
+    async def test_parent_limits_child(self):
+        parent = TokenBucket(512 * 1024)
+        child = TokenBucket(parent=parent)
+        rate = _rate(*await _consume_for(child, 0.5), parent)
+        self.assertAlmostEqual(512 * 1024, rate, delta=0.03 * 512 * 1024)
+
+    async def test_rate_changed_while_waiting(self):
+        bucket = TokenBucket(0, burst=REQUEST_SIZE)  # Paused
+        waiter = asyncio.ensure_future(bucket.consume(REQUEST_SIZE))
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiter.done())
+
+        bucket.rate = 1024 * 1024
+        await asyncio.wait_for(waiter, 0.5)
+
+    async def test_paused(self):
+        paused = TokenBucket(0)
+        # Tokens still held when paused aren't spent either
+        drained = TokenBucket(1024 * 1024)
+        drained.rate = 0
+        waiters = [asyncio.ensure_future(bucket.consume(1))
+                   for bucket in (paused, drained)]
+        await asyncio.sleep(0.05)
+        self.assertFalse(any(waiter.done() for waiter in waiters))
+        for waiter in waiters:
+            waiter.cancel()
+
+    async def test_cancelled_waiter_skipped(self):
+        bucket = TokenBucket(1024, burst=1024)
+        await bucket.consume(1024)
+        cancelled = asyncio.ensure_future(bucket.consume(1024 * 1024))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        start = time.monotonic()
+        await bucket.consume(100)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class LoopbackSwarmTests(unittest.IsolatedAsyncioTestCase):
+    async def _download(self, torrent, seeders, download_limiter):
+        servers = []
+        queue = Queue()
+        for _ in range(seeders):
+            server = Seeder(torrent.data, torrent.piece_length,
+                            torrent.info_hash)
+            await server.start()
+            servers.append(server)
+            queue.put_nowait(server.address)
+
+        manager = PieceManager(torrent)
+        peers = [PeerConnection(queue, torrent.info_hash,
+                                '-TL0001-%012d' % i, manager,
+                                manager.block_received,
+                                download_limiter=TokenBucket(
+                                    parent=download_limiter))
+                 for i in range(seeders)]
+        try:
+            # Connecting isn't limited, only measure the transfer
+            while not any(peer.connected for peer in peers):
+                await asyncio.sleep(0.001)
+            start = time.monotonic()
+            while not manager.complete:
+                await asyncio.sleep(0.01)
+            return time.monotonic() - start
+        finally:
+            for peer in peers:
+                peer.stop()
+            manager.close()
+            for server in servers:
+                server.close()
+
+    async def test_torrent_download_rate(self):
+        rate = 4 * 1024 * 1024
+        torrent = FakeTorrent(os.urandom(6 * 1024 * 1024), 2 ** 18)
+        bucket = TokenBucket(rate)
+        with no_logging:
+            elapsed = await self._download(torrent, 3, bucket)
+
+        measured = _rate(torrent.total_size, elapsed, bucket)
+        self.assertAlmostEqual(rate, measured, delta=0.05 * rate)
+        with open(torrent.output_file, 'rb') as f:
+            self.assertEqual(torrent.data, f.read())
@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+
+from . import no_logging, FakeTorrent
+from TorLord.protocol import Handshake
+from TorLord.session import Session, _divide
+
+
+class DivideTests(unittest.TestCase):
+    def test_divide_by_weight(self):
+        self.assertEqual([2, 2, 6], _divide(10, [1, 1, 3]))
+
+    def test_divide_always_sums_to_total(self):
+        shares = _divide(200, [1, 2, 2, 5, 7, 1])
+        self.assertEqual(200, sum(shares))
+
+
+class SessionTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = Session(port=0, host='127.0.0.1',
+                               max_connections=10,
+                               max_memory=10 * 2 ** 15)
+        await self.session.start()
+
+    async def asyncTearDown(self):
+        with no_logging:
+            await self.session.close()
+
+    async def test_budget_by_priority(self):
+        with no_logging:
+            low = self.session.add(FakeTorrent(b'a' * 100000), priority=1)
+            high = self.session.add(FakeTorrent(b'b' * 100000), priority=4)
+
+        self.assertEqual(2, low.max_peer_connections)
+        self.assertEqual(8, high.max_peer_connections)
+        self.assertEqual(2, low.piece_manager.max_ongoing_pieces)
+        self.assertEqual(8, high.piece_manager.max_ongoing_pieces)
+
+    async def test_budget_rebalanced_on_remove(self):
+        torrent = FakeTorrent(b'a' * 100000)
+        with no_logging:
+            client = self.session.add(torrent)
+            self.session.add(FakeTorrent(b'b' * 100000))
+            self.session.remove(FakeTorrent(b'b' * 100000).info_hash)
+
+        self.assertEqual(1, len(self.session.torrents))
+        self.assertEqual(10, client.max_peer_connections)
+
+    async def test_trackers_share_http_client(self):
+        with no_logging:
+            first = self.session.add(FakeTorrent(b'a' * 100000))
+            second = self.session.add(FakeTorrent(b'b' * 100000))
+
+        self.assertIs(self.session.http_client, first.tracker.http_client)
+        self.assertIs(self.session.http_client, second.tracker.http_client)
+
+    async def test_inbound_peer_routed_by_info_hash(self):
+        torrent = FakeTorrent(b'a' * 100000)
+        with no_logging:
+            self.session.add(torrent)
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', self.session.port)
+            writer.write(Handshake(torrent.info_hash, b'-XX0001-123456789012')
+                         .encode())
+            data = await reader.readexactly(Handshake.length)
+            writer.close()
+
+        response = Handshake.decode(data)
+        self.assertEqual(torrent.info_hash, response.info_hash)
+        self.assertEqual(self.session.peer_id.encode('utf-8'),
+                         response.peer_id)
+
+    async def test_inbound_peer_for_unknown_torrent_rejected(self):
+        with no_logging:
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', self.session.port)
+            writer.write(Handshake(b'x' * 20, b'-XX0001-123456789012')
+                         .encode())
+            data = await reader.read()
+            writer.close()
+
+        self.assertEqual(b'', data)
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from hashlib import sha1
+
+from . import FakeTorrent
+from .swarm import Seeder, LocalTracker, create_content, \
+    write_torrent
+from TorLord import bencoding
+from TorLord.client import PieceManager
+from TorLord.protocol import REQUEST_SIZE
+from TorLord.sharding import ShardedClient, shards, _ShardClient
+from TorLord.tracker import Tracker
+
+
+class ShardTests(unittest.TestCase):
+    def test_shards(self):
+        self.assertEqual([range(0, 4), range(4, 7), range(7, 10)],
+                         shards(10, 3))
+        self.assertEqual([range(0, 1), range(1, 1)], shards(1, 2))
+
+    def test_pieces_outside_shard_left_out(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE - 10), REQUEST_SIZE)
+        manager = PieceManager(torrent)
+        manager.set_shard(range(2, 4))
+        self.assertEqual([2, 3], [p.index for p in manager.missing_pieces])
+        self.assertEqual(2 * REQUEST_SIZE - 10, manager.bytes_left)
+        manager.close()
+
+
+class ShardAnnounceTests(unittest.IsolatedAsyncioTestCase):
+    async def test_completed_with_whole_torrent(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE)
+        tracker = LocalTracker([])
+        await tracker.start()
+        torrent.announce = tracker.announce
+        downloaded = [2 * REQUEST_SIZE, 0]
+        client = _ShardClient(torrent, downloaded, tracker=Tracker(torrent))
+        try:
+            # Our share is done, the other worker's isn't
+            await client._announce('completed')
+            self.assertEqual([], tracker.announces)
+            await client._announce(None)
+            downloaded[1] = 2 * REQUEST_SIZE
+            await client._announce('completed')
+        finally:
+            client.stop()
+            await client.stopped_announce
+            await tracker.close()
+        self.assertEqual([(None, str(2 * REQUEST_SIZE)), ('completed', '0'),
+                          ('stopped', '0')],
+                         [(a.get('event'), a['left'])
+                          for a in tracker.announces])
+
+
+class ShardedClientTests(unittest.IsolatedAsyncioTestCase):
+    async def test_download(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, info = create_content(directory, 8 * REQUEST_SIZE,
+                                        REQUEST_SIZE)
+            info_hash = sha1(bencoding.Encoder(info).encode()).digest()
+            with open(path, 'rb') as f:
+                data = f.read()
+            seeder = Seeder(data, REQUEST_SIZE, info_hash)
+            await seeder.start()
+            tracker = LocalTracker([seeder.address])
+            await tracker.start()
+            download_dir = os.path.join(directory, 'download')
+            os.mkdir(download_dir)
+
+            client = ShardedClient(
+                write_torrent(directory, info, tracker.announce), 2,
+                download_dir=download_dir)
+            client.start()
+            try:
+                await asyncio.wait_for(client.wait(), 30)
+            finally:
+                client.stop()
+                seeder.close()
+                await tracker.close()
+            self.assertTrue(client.complete)
+            with open(os.path.join(download_dir, 'payload'), 'rb') as f:
+                self.assertEqual(data, f.read())
+            # Each worker announced itself, on the port it listens on
+            announces = tracker.announces
+            self.assertEqual(2, len({a['peer_id'] for a in announces}))
+            self.assertEqual(2, len({a['port'] for a in announces}))
+            self.assertNotIn('6889', {a['port'] for a in announces})
+            # Completed only once the whole torrent is, not by a worker done
+            # with its share alone
+            completed = [a for a in announces
+                         if a.get('event') == 'completed']
+            self.assertTrue(completed)
+            self.assertEqual({'0'}, {a['left'] for a in completed})
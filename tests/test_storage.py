@@ -0,0 +1,37 @@
+import os
+import unittest
+
+from . import FakeTorrent
+from TorLord.storage import Storage
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        # Files of 10, 0, 25 and 5 bytes in pieces of 16 bytes
+        self.torrent = FakeTorrent(os.urandom(40), 16, files=[10, 0, 25, 5])
+        self.storage = Storage(self.torrent)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_spans(self):
+        self.assertEqual([(0, 4, 6), (2, 0, 10)], self.storage.spans(4, 16))
+        self.assertEqual([(2, 24, 1), (3, 0, 5)], self.storage.spans(34, 10))
+
+    def test_pieces(self):
+        self.assertEqual(range(0, 1), self.storage.pieces(0))
+        self.assertEqual(range(0), self.storage.pieces(1))
+        self.assertEqual(range(0, 3), self.storage.pieces(2))
+        self.assertEqual(range(2, 3), self.storage.pieces(3))
+
+    def test_write_and_read(self):
+        self.storage.write(0, self.torrent.data)
+        self.assertEqual(self.torrent.data[8:38], self.storage.read(8, 30))
+        with open(os.path.join(self.torrent.output_file, 'file2'), 'rb') as f:
+            self.assertEqual(self.torrent.data[10:35], f.read())
+
+    def test_write_skips_files(self):
+        self.storage.write(0, self.torrent.data[:16], skip={0})
+        self.assertFalse(os.path.exists(
+            os.path.join(self.torrent.output_file, 'file0')))
+        self.assertEqual(self.torrent.data[10:16], self.storage.read(10, 6))
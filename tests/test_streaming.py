@@ -0,0 +1,151 @@
+import asyncio
+import os
+import unittest
+
+import aiohttp
+import bitstring
+
+from . import no_logging, FakeTorrent
+from .swarm import Seeder
+from TorLord.client import TorrentClient, PieceManager, PRIORITY_SKIP, \
+    PRIORITY_NORMAL
+from TorLord.protocol import REQUEST_SIZE
+from TorLord.streaming import RangeServer
+from TorLord.tracker import Tracker
+
+
+class PriorityTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = FakeTorrent(os.urandom(8 * REQUEST_SIZE), REQUEST_SIZE)
+        self.manager = PieceManager(self.torrent)
+        self.manager.add_peer('peer', bitstring.BitArray('0xff'))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_prioritized_piece_first(self):
+        self.manager.prioritize(5)
+        self.assertEqual(5, self.manager.next_request('peer').piece)
+
+    def test_prioritized_despite_ongoing_limit(self):
+        self.manager.max_ongoing_pieces = 1
+        self.manager.next_request('peer')
+        self.manager.prioritize(5)
+        self.assertEqual(5, self.manager.next_request('peer').piece)
+
+    def test_waiters_woken_and_data_freed(self):
+        async def download():
+            waiter = asyncio.ensure_future(self.manager.wait_for(3))
+            await asyncio.sleep(0)
+            block = self.manager.next_request('peer')
+            start = block.piece * REQUEST_SIZE
+            self.manager.block_received('peer', block.piece, block.offset,
+                                        self.torrent.data[start:start +
+                                                          REQUEST_SIZE])
+            await asyncio.wait_for(waiter, 1)
+
+        with no_logging:
+            asyncio.run(download())
+        self.assertTrue(self.manager.have(3))
+        self.assertEqual(set(), self.manager.priority_pieces)
+        self.assertIsNone(self.manager.have_pieces[0].blocks[0].data)
+        self.assertEqual(self.torrent.data[3 * REQUEST_SIZE:][:10],
+                         self.manager.read(3 * REQUEST_SIZE, 10))
+
+
+class StreamingTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.torrent = FakeTorrent(os.urandom(6 * REQUEST_SIZE + 100),
+                                   2 * REQUEST_SIZE)
+        self.seeder = Seeder(self.torrent.data, self.torrent.piece_length,
+                             self.torrent.info_hash)
+        await self.seeder.start()
+        self.client = TorrentClient(self.torrent,
+                                    tracker=Tracker(self.torrent))
+        self.client.available_peers.put_nowait(self.seeder.address)
+        with no_logging:
+            self.client.peers = [self.client._new_peer()]
+
+    async def asyncTearDown(self):
+        with no_logging:
+            self.client.stop()
+        self.seeder.close()
+
+    async def test_read_waits_for_pieces(self):
+        offset = 3 * REQUEST_SIZE + 7
+        with no_logging:
+            data = await asyncio.wait_for(self.client.read(offset, 3000), 5)
+        self.assertEqual(self.torrent.data[offset:offset + 3000], data)
+
+    async def test_reader(self):
+        reader = self.client.open(offset=100)
+        reader.seek(-50, os.SEEK_END)
+        with no_logging:
+            data = await asyncio.wait_for(reader.read(), 5)
+        self.assertEqual(self.torrent.data[-50:], data)
+        self.assertEqual(reader.size, reader.tell())
+
+    async def test_range_request(self):
+        server = RangeServer(self.client)
+        with no_logging:
+            await server.start()
+            try:
+                url = 'http://127.0.0.1:{port}/'.format(
+                    port=server.runner.addresses[0][1])
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(url, headers={
+                            'Range': 'bytes=70000-70099'}) as response:
+                        status = response.status
+                        content_range = response.headers['Content-Range']
+                        data = await response.read()
+                    async with session.get(url, headers={
+                            'Range': 'bytes=900000-'}) as response:
+                        unsatisfiable = response.status
+            finally:
+                await server.close()
+
+        self.assertEqual(206, status)
+        self.assertEqual('bytes 70000-70099/{size}'.format(
+            size=self.torrent.total_size), content_range)
+        self.assertEqual(self.torrent.data[70000:70100], data)
+        self.assertEqual(416, unsatisfiable)
+
+
+class UnreadableTests(unittest.IsolatedAsyncioTestCase):
+    """
+    Requests for data that can't be read, the torrent has no peers.
+    """
+    async def asyncSetUp(self):
+        self.torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE),
+                                   REQUEST_SIZE, files=[REQUEST_SIZE,
+                                                        3 * REQUEST_SIZE])
+        self.client = TorrentClient(self.torrent,
+                                    tracker=Tracker(self.torrent))
+        self.server = RangeServer(self.client)
+        await self.server.start()
+        self.url = 'http://127.0.0.1:{port}/'.format(
+            port=self.server.runner.addresses[0][1])
+
+    async def asyncTearDown(self):
+        with no_logging:
+            self.client.stop()
+            await self.server.close()
+
+    async def test_skipped_file(self):
+        self.client.set_file_priorities([PRIORITY_SKIP, PRIORITY_NORMAL])
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.url, headers={
+                    'Range': 'bytes=0-99'}) as response:
+                self.assertEqual(416, response.status)
+
+    async def test_stopped(self):
+        with no_logging:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(self.url) as response:
+                    self.assertEqual(200, response.status)
+                    # The data is waited for when the torrent stops
+                    self.client.stop()
+                    with self.assertRaises(aiohttp.ClientPayloadError):
+                        await response.read()
+                async with session.get(self.url) as response:
+                    self.assertEqual(503, response.status)
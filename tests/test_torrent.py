@@ -1,5 +1,9 @@
+import os
+import tempfile
 import unittest
+from collections import OrderedDict
 
+from TorLord import bencoding
 from TorLord.torrent import Torrent
 
 
@@ -42,5 +46,40 @@ class UbuntuTorrentTests(unittest.TestCase):
 
 class SXSWTorrentTests(unittest.TestCase):
     def test_instantiate(self):
-        with self.assertRaises(RuntimeError):
-            Torrent('tests/data/SXSW_2016_Showcasing_Artists_Part1.torrent')
\ No newline at end of file
+        t = Torrent('tests/data/SXSW_2016_Showcasing_Artists_Part1.torrent')
+        self.assertTrue(t.multi_file)
+
+
+def _write_torrent(directory, files):
+    meta_info = OrderedDict([
+        (b'announce', b'http://127.0.0.1/announce'),
+        (b'info', OrderedDict([
+            (b'files', [OrderedDict([(b'length', length), (b'path', path)])
+                        for path, length in files]),
+            (b'name', b'album'),
+            (b'piece length', 16),
+            (b'pieces', b'\x00' * 20 * 3)]))])
+    path = os.path.join(directory, 'album.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencoding.Encoder(meta_info).encode())
+    return path
+
+
+class MultiFileTorrentTests(unittest.TestCase):
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            t = Torrent(_write_torrent(directory, [
+                ([b'cd1', b'01.flac'], 30), ([b'cover.jpg'], 10)]))
+        self.assertTrue(t.multi_file)
+        self.assertEqual(2, len(t.files))
+        self.assertEqual(os.path.join('cd1', '01.flac'), t.files[0].name)
+        self.assertEqual(30, t.files[0].length)
+        self.assertEqual('cover.jpg', t.files[1].name)
+        self.assertEqual(40, t.total_size)
+        self.assertEqual('album', t.output_file)
+
+    def test_path_outside_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = _write_torrent(directory, [([b'..', b'evil'], 40)])
+            with self.assertRaises(RuntimeError):
+                Torrent(path)
@@ -41,6 +41,11 @@ class TrackerResponseTest(unittest.TestCase):
 
         self.assertEqual(240, response.incomplete)
 
+    def test_min_interval(self):
+        self.assertIsNone(TrackerResponse(self.ok_response).min_interval)
+        self.ok_response[b'min interval'] = 60
+        self.assertEqual(60, TrackerResponse(self.ok_response).min_interval)
+
     def test_successful_response_interval(self):
         response = TrackerResponse(self.ok_response)
 
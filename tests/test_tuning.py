@@ -0,0 +1,69 @@
+import asyncio
+import socket
+import unittest
+
+from . import no_logging
+from TorLord import tuning
+from TorLord.tuning import SocketOptions, new_event_loop
+
+
+class SocketOptionsTests(unittest.TestCase):
+    def test_apply(self):
+        options = SocketOptions(rcvbuf=256 * 1024, sndbuf=128 * 1024,
+                                nodelay=True)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            options.apply(sock)
+            self.assertEqual(1, sock.getsockopt(socket.IPPROTO_TCP,
+                                                socket.TCP_NODELAY))
+            # The kernel is free to round the buffer sizes up
+            self.assertGreaterEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                256 * 1024)
+            self.assertGreaterEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                128 * 1024)
+
+    def test_defaults_untouched(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            before = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            SocketOptions().apply(sock)
+            self.assertEqual(
+                before, sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+            self.assertEqual(0, sock.getsockopt(socket.IPPROTO_TCP,
+                                                socket.TCP_NODELAY))
+
+
+class LoopbackConnectionTests(unittest.IsolatedAsyncioTestCase):
+    async def test_tuned_connection(self):
+        options = SocketOptions.tuned()
+
+        async def echo(reader, writer):
+            writer.write(await reader.readexactly(5))
+            await writer.drain()
+            writer.close()
+
+        server = await options.start_server(echo, host='127.0.0.1', port=0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await options.open_connection('127.0.0.1', port)
+        sock = writer.get_extra_info('socket')
+        writer.write(b'hello')
+
+        self.assertEqual(b'hello', await reader.readexactly(5))
+        self.assertEqual(1, sock.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY))
+        self.assertEqual(options.stream_limit, reader._limit)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+
+class EventLoopTests(unittest.TestCase):
+    def test_fallback_without_uvloop(self):
+        installed, tuning.uvloop = tuning.uvloop, None
+        try:
+            with no_logging:
+                loop = new_event_loop(use_uvloop=True)
+        finally:
+            tuning.uvloop = installed
+        self.assertIsInstance(loop, asyncio.AbstractEventLoop)
+        loop.close()
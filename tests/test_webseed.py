@@ -0,0 +1,125 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+
+from . import no_logging, FakeTorrent
+from TorLord.client import Block, TorrentClient
+from TorLord.protocol import REQUEST_SIZE
+from TorLord.torrent import TorrentFile
+from TorLord.tracker import Tracker
+from TorLord.webseed import _file_urls, _runs
+
+
+class FileUrlTests(unittest.TestCase):
+    def test_single_file(self):
+        torrent = FakeTorrent(b'data', name='some file')
+        self.assertEqual(['http://mirror/some%20file'],
+                         _file_urls('http://mirror/', torrent))
+        self.assertEqual(['http://mirror/other.iso'],
+                         _file_urls('http://mirror/other.iso', torrent))
+
+    def test_multi_file(self):
+        torrent = FakeTorrent(b'data', name='album', files=[2, 2])
+        torrent.files[1] = TorrentFile(os.path.join('cd 2', 'track'), 2)
+        self.assertEqual(['http://mirror/album/file0',
+                          'http://mirror/album/cd%202/track'],
+                         _file_urls('http://mirror', torrent))
+
+    def test_runs(self):
+        blocks = [Block(1, 0, REQUEST_SIZE),
+                  Block(0, REQUEST_SIZE, REQUEST_SIZE),
+                  Block(0, 0, REQUEST_SIZE), Block(3, 0, REQUEST_SIZE)]
+        runs = _runs(blocks, 2 * REQUEST_SIZE)
+        self.assertEqual([[blocks[2], blocks[1], blocks[0]], [blocks[3]]],
+                         [[block for _, block in run] for run in runs])
+
+
+class Mirror:
+    """
+    An HTTP server serving the files of a directory, with range requests.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.ranges = []
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self._serve)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = 'http://127.0.0.1:{port}/'.format(
+            port=site._server.sockets[0].getsockname()[1])
+
+    async def close(self):
+        await self.runner.cleanup()
+
+    async def _serve(self, request):
+        self.ranges.append((request.match_info['path'],
+                            request.headers.get('Range')))
+        path = os.path.join(self.directory, request.match_info['path'])
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+
+class WebSeedTests(unittest.IsolatedAsyncioTestCase):
+    async def _download(self, torrent):
+        mirror = Mirror(self.directory.name)
+        await mirror.start()
+        torrent.url_list = [mirror.url]
+        client = TorrentClient(torrent, tracker=Tracker(torrent))
+        with no_logging:
+            try:
+                # The tracker of the fake torrent can't be reached, there
+                # are no peers besides the web seed
+                await asyncio.wait_for(client.start(), 10)
+            finally:
+                client.stop()
+                await mirror.close()
+        return mirror.ranges
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def test_single_file(self):
+        torrent = FakeTorrent(os.urandom(8 * REQUEST_SIZE + 10),
+                              2 * REQUEST_SIZE)
+        self._write('fake', torrent.data)
+        ranges = await self._download(torrent)
+        with open(torrent.output_file, 'rb') as f:
+            self.assertEqual(torrent.data, f.read())
+        # Runs of blocks are fetched at once, not block by block
+        self.assertLess(len(ranges), 9)
+
+    async def test_multi_file(self):
+        torrent = FakeTorrent(os.urandom(4 * REQUEST_SIZE), REQUEST_SIZE,
+                              files=[REQUEST_SIZE + 10, 0,
+                                     3 * REQUEST_SIZE - 10])
+        self._write(os.path.join('fake', 'file0'),
+                    torrent.data[:REQUEST_SIZE + 10])
+        self._write(os.path.join('fake', 'file2'),
+                    torrent.data[REQUEST_SIZE + 10:])
+        ranges = await self._download(torrent)
+        for index, (start, end) in enumerate([(0, REQUEST_SIZE + 10),
+                                              (REQUEST_SIZE + 10, None)]):
+            path = os.path.join(torrent.output_file,
+                                'file{index}'.format(index=index * 2))
+            with open(path, 'rb') as f:
+                self.assertEqual(torrent.data[start:end], f.read())
+        self.assertNotIn('fake/file1', [path for path, _ in ranges])